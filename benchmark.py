@@ -0,0 +1,272 @@
+# ==========================================
+# --- ベンチマーク（images/ の実写真を使用） ---
+# ==========================================
+# 使い方:
+#   python benchmark.py                      # 全ケースを実行し bench_results.json に保存
+#   python benchmark.py --quick              # 件数を減らして短時間で実行
+#   python benchmark.py --only ledger label  # 名前に一致するケースだけ実行
+#   python benchmark.py --compare old.json   # 以前の結果と比較して表示
+#
+# 各ケースは同一プロセス内で repeat 回実行し、1回目を cold（初回のフォント読込・
+# ファイルキャッシュ等を含む）、2回目以降の中央値/最小値を warm として記録する。
+# 作業ファイルは一時ディレクトリに作られ、リポジトリ内のデータは変更しない。
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+CORPUS_DIR = REPO_DIR / "images"
+DEFAULT_OUTPUT = REPO_DIR / "bench_results.json"
+
+
+def load_app(workdir):
+    # アプリは相対パスで作業ファイルを扱うため、一時ディレクトリに移動してから読み込む
+    os.chdir(workdir)
+    os.environ.setdefault("QR_MANUAL_SERVER_PORT", "0")  # 起動中のアプリとポートが衝突しないようにする
+    sys.path.insert(0, str(REPO_DIR))
+    import equipment_qr_manager as app
+    app.ensure_work_dirs()
+    return app
+
+
+def bench_startup(repeat):
+    # 新しいプロセスでの import 時間（起動直後に画面が出るまでの下限）を計る
+    code = "import time; t = time.perf_counter(); import equipment_qr_manager; print((time.perf_counter() - t) * 1000)"
+    env = dict(os.environ, QR_MANUAL_SERVER_PORT="0")
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=os.getcwd(), env=dict(env, PYTHONPATH=str(REPO_DIR)), text=True, stderr=subprocess.DEVNULL)
+        times.append(float(out.strip().splitlines()[-1]))
+    warm = times[1:] or times
+    return {"cold_ms": round(times[0], 2), "warm_median_ms": round(statistics.median(warm), 2), "warm_min_ms": round(min(warm), 2), "repeat": repeat}
+
+
+def corpus_images():
+    return sorted(p for p in CORPUS_DIR.glob("*.jpg"))
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t) * 1000)
+    warm = times[1:] or times
+    return {
+        "cold_ms": round(times[0], 2),
+        "warm_median_ms": round(statistics.median(warm), 2),
+        "warm_min_ms": round(min(warm), 2),
+        "repeat": repeat,
+    }
+
+
+def bench_compress_corpus(app, images, repeat, profile="photo"):
+    def run():
+        total = 0
+        for p in images:
+            with open(p, "rb") as f:
+                data = app.compress_image(f, profile)
+            total += len(data or b"")
+        return total
+    res = measure(run, repeat)
+    res["images"] = len(images)
+    res["per_image_warm_ms"] = round(res["warm_median_ms"] / max(1, len(images)), 2)
+    return res
+
+
+def bench_manual(app, images, n_extras, repeat, workdir):
+    data = {
+        "id": "BENCH", "name": "ベンチマーク用 5t金型反転機", "power": "200V",
+        "memo": "定期点検時は必ずLOTOを実施すること。\n" * 3, "is_related_loto": True,
+        "img_exterior": str(images[0]), "img_outlet": str(images[1]), "img_label": str(images[2]),
+        "img_loto1": str(images[3]), "img_loto2": str(images[4]),
+    }
+    extras = [(str(images[(5 + i) % len(images)]), f"追加画像 {i + 1}") for i in range(n_extras)]
+    out = Path(workdir) / f"bench_manual_{n_extras}.jpg"
+    res = measure(lambda: app.create_manual_image_extended(data, extras, out), repeat)
+    res["extras"] = n_extras
+    res["output_bytes"] = out.stat().st_size
+    return res
+
+
+def bench_label(app, repeat):
+    qr = app.make_optimized_qr("https://example.com/manuals/BENCH.jpg")
+    data = {"name": "ベンチマーク用 5t金型反転機", "power": "200V", "img_qr": qr}
+    return measure(lambda: app.create_label_image(data), repeat)
+
+
+def bench_qr(app, repeat):
+    return measure(lambda: app.make_optimized_qr("https://cdn.jsdelivr.net/gh/equipment-portal/qr-manager@main/manuals/BENCH_20260101120000.jpg"), repeat)
+
+
+def prepare_labels(app, n):
+    # 実際のラベル画像を1枚描画し、n枚分の履歴としてパックに追記する
+    app.clear_history()
+    app.TEMP_LABEL_DIR.mkdir(exist_ok=True)
+    qr = app.make_optimized_qr("https://example.com/manuals/BENCH.jpg")
+    label = app.create_label_image({"name": "ベンチマーク用", "power": "100V", "img_qr": qr})
+    buf = io.BytesIO()
+    label.save(buf, format="PNG")
+    app.append_labels([(f"ベンチ{i}", buf.getvalue()) for i in range(n)])
+
+
+def bench_rebuild_excel(app, n, repeat):
+    prepare_labels(app, n)
+    res = measure(app.rebuild_excel, repeat)
+    res["labels"] = n
+    res["output_bytes"] = app.EXCEL_LABEL_PATH.stat().st_size
+    return res
+
+
+def synthetic_devices(n):
+    import pandas as pd
+    names = ["金型反転機", "射出成形機", "取出機", "温調機", "クレーン", "コンプレッサー"]
+    rows = []
+    for i in range(n):
+        did = f"{(i * 7919) % (n * 3) + 1}" + ("" if i % 5 else "HR")
+        rows.append({
+            "ID": did, "Name": f"{(i % 40) * 10 + 50}t{names[i % len(names)]}", "Power": "200V" if i % 3 else "100V",
+            "URL": f"https://cdn.jsdelivr.net/gh/equipment-portal/qr-manager@main/manuals/{did}_20260101120000.jpg",
+            "Updated": "2026-01-01 12:00:00", "memo": "定期点検" if i % 4 == 0 else "",
+        })
+    return pd.DataFrame(rows)
+
+
+def bench_ledger(app, n, repeat):
+    df = synthetic_devices(n)
+    holder = {}
+    res = measure(lambda: holder.__setitem__("data", app.create_formatted_ledger_excel(df.copy())), repeat)
+    res["rows"] = n
+    res["output_bytes"] = len(holder["data"])
+    return res
+
+
+def bench_rerun(app, n_devices, n_labels, repeat):
+    # AppTest で画面全体を再実行し、計測記録（metrics_runs.jsonl）から main() 全体と
+    # 各区画（st.fragment）の所要時間を読む。区画内の操作ではその区画の時間だけがかかる
+    from streamlit.testing.v1 import AppTest
+    csv_path = Path("bench_devices.csv")
+    synthetic_devices(n_devices).to_csv(csv_path, index=False, encoding="utf-8-sig")
+    app.install_devices_snapshot(csv_path)
+    prepare_labels(app, n_labels)
+    at = AppTest.from_file(str(REPO_DIR / "equipment_qr_manager.py"), default_timeout=300)
+    times, fragments = [], {}
+    for _ in range(repeat + 1):
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        with open(app.METRICS_FILE, "r", encoding="utf-8") as f:
+            rec = json.loads(f.readlines()[-1])
+        times.append(rec["dur_ms"])
+        for sp in rec.get("spans", []):
+            if sp["name"].startswith("断片:"): fragments.setdefault(sp["name"][3:], []).append(sp["dur_ms"])
+    times = times[1:]  # 1回目はキャッシュの準備を含むため除く
+    warm = times[1:] or times
+    return {
+        "cold_ms": round(times[0], 2), "warm_median_ms": round(statistics.median(warm), 2), "warm_min_ms": round(min(warm), 2), "repeat": repeat,
+        "devices": n_devices, "labels": n_labels,
+        "fragments_warm_median_ms": {k: round(statistics.median(v[2:] or v), 2) for k, v in fragments.items()},
+    }
+
+
+def environment_info():
+    info = {"python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine()}
+    try:
+        info["git_commit"] = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        info["git_commit"] = None
+    for mod in ("PIL", "pandas", "openpyxl", "qrcode", "streamlit"):
+        try:
+            info[mod] = __import__(mod).__version__
+        except Exception:
+            info[mod] = None
+    return info
+
+
+def compare(results, old_path):
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = {c["name"]: c for c in json.load(f)["cases"]}
+    print(f"\n--- {old_path} との比較（warm中央値） ---")
+    for case in results["cases"]:
+        prev = old.get(case["name"])
+        if not prev or "warm_median_ms" not in prev or "warm_median_ms" not in case:
+            continue
+        ratio = case["warm_median_ms"] / prev["warm_median_ms"] if prev["warm_median_ms"] else float("inf")
+        mark = "  ⚠ 遅くなっています" if ratio > 1.10 else ""
+        print(f"{case['name']:<32} {prev['warm_median_ms']:>10.1f} → {case['warm_median_ms']:>10.1f} ms  (x{ratio:.2f}){mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QR管理システムの処理ベンチマーク")
+    parser.add_argument("--output", default=str(DEFAULT_OUTPUT), help="結果JSONの出力先")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの実行回数（1回目がcold）")
+    parser.add_argument("--quick", action="store_true", help="件数を減らして短時間で実行する")
+    parser.add_argument("--only", nargs="*", default=None, help="名前にこの文字列を含むケースだけ実行する")
+    parser.add_argument("--compare", default=None, help="比較対象の以前の結果JSON")
+    args = parser.parse_args()
+
+    images = corpus_images()
+    if len(images) < 5:
+        sys.exit(f"ベンチマーク用の画像が不足しています: {CORPUS_DIR}")
+
+    workdir = tempfile.mkdtemp(prefix="qr_bench_")
+    t_import = time.perf_counter()
+    app = load_app(workdir)
+    import_ms = (time.perf_counter() - t_import) * 1000
+    # 短縮URLサービスへは接続しない
+    app.make_short_url = lambda url: "https://is.gd/bench0"
+
+    corpus = images[:20] if args.quick else images
+    label_counts = [13, 130] if args.quick else [13, 130, 1300]
+    ledger_rows = [100, 10_000] if args.quick else [100, 10_000, 100_000]
+
+    cases = [
+        ("startup/import", lambda: bench_startup(max(args.repeat, 3))),
+        ("compress_image/corpus", lambda: bench_compress_corpus(app, corpus, args.repeat)),
+        ("compress_image/document_lo", lambda: bench_compress_corpus(app, [p for p in corpus if "_lo" in p.name], args.repeat, "document")),
+        ("compress_image/label_lab", lambda: bench_compress_corpus(app, [p for p in corpus if "_lab_" in p.name], args.repeat, "label")),
+        *[(f"manual/extras_{n}", (lambda n=n: bench_manual(app, images, n, args.repeat, workdir))) for n in (0, 5, 20)],
+        ("label/create_label_image", lambda: bench_label(app, max(args.repeat, 5))),
+        ("qr/make_optimized_qr", lambda: bench_qr(app, max(args.repeat, 5))),
+        *[(f"rebuild_excel/{n}", (lambda n=n: bench_rebuild_excel(app, n, args.repeat))) for n in label_counts],
+        *[(f"ledger/{n}", (lambda n=n: bench_ledger(app, n, 1 if n >= 100_000 else args.repeat))) for n in ledger_rows],
+        ("rerun/main_500_devices", lambda: bench_rerun(app, 500, 20, max(args.repeat, 3))),
+    ]
+    if args.only:
+        cases = [c for c in cases if any(key in c[0] for key in args.only)]
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "import_ms": round(import_ms, 2),
+        "quick": args.quick,
+        "cases": [],
+    }
+    for name, fn in cases:
+        print(f"{name:<32}", end=" ", flush=True)
+        try:
+            res = fn()
+            print(f"cold {res['cold_ms']:>10.1f} ms / warm {res['warm_median_ms']:>10.1f} ms")
+        except Exception as e:
+            res = {"error": f"{type(e).__name__}: {e}"}
+            print(f"失敗: {res['error']}")
+        results["cases"].append({"name": name, **res})
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,51 @@
+import time
+APP_IMPORT_STARTED = time.perf_counter()
+
 import streamlit as st
-import pandas as pd
-import qrcode
 import os
 import urllib.request
 import urllib.parse
+import urllib.error
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 import io
 import base64
 import json
 import shutil
-
-# --- Excel操作用ライブラリ ---
-import openpyxl
-from openpyxl.drawing.image import Image as XLImage
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import PatternFill, Border, Side, Alignment, Font
-
-# --- 画像処理用ライブラリ ---
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+import hashlib
+import tempfile
+import zipfile
+import threading
+import contextlib
+import contextvars
+import collections
+import mmap
+import tracemalloc
+import importlib
+import atexit
+
+# --- 重いライブラリは初回使用時に読み込む ---
+# pandas / Pillow はモジュール属性に触れた時点で import し、
+# openpyxl（Excel出力）と qrcode（QR生成）は使用する関数内で import する
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return getattr(module, attr)
+
+pd = LazyModule("pandas")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
+ImageOps = LazyModule("PIL.ImageOps")
+ImageChops = LazyModule("PIL.ImageChops")
+ImageStat = LazyModule("PIL.ImageStat")
 
 # --- 初期設定 ---
 DB_CSV = Path("devices.csv")
@@ -28,46 +55,392 @@ EXCEL_LABEL_PATH = Path("print_labels.xlsx")
 LABEL_HISTORY_FILE = Path("label_history.json")
 TEMP_LABEL_DIR = Path("temp_labels")
 DRAFT_IMG_DIR = Path("draft_images")
+PREVIEW_DIR = Path("previews")
+DERIVATIVE_DIR = Path("derivatives")
+OUTBOX_DIR = Path("outbox")
+WORK_DIRS = [QR_DIR, MANUAL_DIR, TEMP_LABEL_DIR, DRAFT_IMG_DIR, PREVIEW_DIR, DERIVATIVE_DIR, OUTBOX_DIR]
+
+def ensure_work_dirs():
+    for d in WORK_DIRS:
+        d.mkdir(exist_ok=True)
+
+# --- フォント ---
+# 起動時にネットワークへは接続しない。QR_FONT_PATH（ファイルまたはフォルダを os.pathsep 区切り）→
+# 同梱フォント → OS標準の日本語フォント の順に探す
+BUNDLED_FONT_NAME = "BIZUDGothic-Regular.ttf"
+SYSTEM_CJK_FONTS = [
+    "C:/Windows/Fonts/BIZ-UDGothicR.ttc", "C:/Windows/Fonts/meiryo.ttc", "C:/Windows/Fonts/YuGothM.ttc", "C:/Windows/Fonts/msgothic.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc", "/System/Library/Fonts/Hiragino Sans GB.ttc", "/Library/Fonts/Arial Unicode.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc", "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc", "/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+]
+
+def font_search_path():
+    paths = [p for p in os.environ.get("QR_FONT_PATH", "").split(os.pathsep) if p]
+    paths += [BUNDLED_FONT_NAME, str(Path(__file__).resolve().parent / BUNDLED_FONT_NAME)]
+    return paths + SYSTEM_CJK_FONTS
+
+def resolve_font_path():
+    for p in font_search_path():
+        if os.path.isdir(p):
+            for ext in ("*.ttf", "*.ttc", "*.otf"):
+                found = sorted(Path(p).glob(ext))
+                if found: return str(found[0])
+        elif os.path.isfile(p):
+            return p
+    # 見つからない場合は ImageFont.truetype が失敗し、各処理で標準フォントに切り替わる
+    return BUNDLED_FONT_NAME
+
+cloud_font_path = resolve_font_path()
 
-for d in [QR_DIR, MANUAL_DIR, TEMP_LABEL_DIR, DRAFT_IMG_DIR]:
-    d.mkdir(exist_ok=True)
+def safe_filename(name):
+    keepcharacters = (' ', '.', '_', '-')
+    return "".join(c for c in name if c.isalnum() or c in keepcharacters).rstrip()
 
-cloud_font_path = "BIZUDGothic-Regular.ttf"
+# ==========================================
+# --- 処理時間・メモリ計測（診断パネル用） ---
+# ==========================================
+METRICS_FILE = Path("metrics_runs.jsonl")
+METRICS_KEEP_RUNS = 200
+PROFILE_DIR = Path("profiles")
+
+current_metrics_run = contextvars.ContextVar("current_metrics_run", default=None)
+current_metrics_span = contextvars.ContextVar("current_metrics_span", default=None)
+
+class MetricsRun:
+    def __init__(self, kind, track_memory=False):
+        self.kind = kind
+        self.track_memory = track_memory
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.error = None
+        self.critical_path = None
+
+    def add_span(self, rec):
+        with self.lock: self.spans.append(rec)
+
+    def to_dict(self):
+        rec = {
+            "kind": self.kind, "started": self.started, "dur_ms": round((time.perf_counter() - self.t0) * 1000, 2),
+            "track_memory": self.track_memory, "error": self.error, "spans": list(self.spans)
+        }
+        if self.critical_path: rec["critical_path"] = self.critical_path
+        return rec
+
+@contextlib.contextmanager
+def span(name, nbytes=0):
+    # 計測中の実行（metrics_run）が無ければ何も記録しない
+    run = current_metrics_run.get()
+    rec = {"name": name, "bytes": nbytes}
+    if run is None:
+        yield rec
+        return
+    parent = current_metrics_span.get()
+    token = current_metrics_span.set(rec)
+    # ピークは最も外側の計測でだけ測る。入れ子の計測や、他のスレッド・セッションの計測と
+    # 重なったものはピークを記録しない（reset_peak で互いの値を壊さないため）
+    mem = run.track_memory and parent is None and claim_memory_peak(rec)
+    if mem:
+        mem0 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    t = time.perf_counter()
+    try:
+        yield rec
+    except BaseException as e:
+        rec["error"] = type(e).__name__
+        raise
+    finally:
+        end = time.perf_counter()
+        current_metrics_span.reset(token)
+        rec["start_ms"] = round((t - run.t0) * 1000, 3)
+        rec["dur_ms"] = round((end - t) * 1000, 3)
+        rec["thread"] = threading.current_thread().name
+        if mem:
+            rec["peak_kb"] = round(max(0, tracemalloc.get_traced_memory()[1] - mem0) / 1024, 1)
+            release_memory_peak(rec)
+        run.add_span(rec)
+
+@st.cache_resource(show_spinner=False)
+def memory_tracking():
+    # tracemalloc のピークはプロセス全体で1つのため、ピークを測るのは同時に1つの計測だけにする。
+    # 全セッション・全スレッドで共有する（先読み等のスレッドから初めて呼ばれることがあるためスピナーは出さない）
+    return {"lock": threading.Lock(), "runs": 0, "started": False, "owner": None}
+
+def claim_memory_peak(rec):
+    mt = memory_tracking()
+    with mt["lock"]:
+        if mt["owner"] is not None or not tracemalloc.is_tracing(): return False
+        mt["owner"] = rec
+        return True
+
+def release_memory_peak(rec):
+    mt = memory_tracking()
+    with mt["lock"]:
+        if mt["owner"] is rec: mt["owner"] = None
+
+def start_memory_tracking():
+    # 実行が重なっても、最後の実行が終わるまで tracemalloc を止めない
+    mt = memory_tracking()
+    with mt["lock"]:
+        if mt["runs"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            mt["started"] = True
+        mt["runs"] += 1
+
+def stop_memory_tracking():
+    mt = memory_tracking()
+    with mt["lock"]:
+        mt["runs"] -= 1
+        if mt["runs"] == 0 and mt["started"]:
+            tracemalloc.stop()
+            mt["started"] = False
+
+@contextlib.contextmanager
+def metrics_run(kind, track_memory=False):
+    parent = current_metrics_run.get()
+    run = MetricsRun(kind, track_memory or (parent is not None and parent.track_memory))
+    if run.track_memory: start_memory_tracking()
+    with span(kind) if parent is not None else contextlib.nullcontext():
+        token = current_metrics_run.set(run)
+        span_token = current_metrics_span.set(None)
+        try:
+            yield run
+        except BaseException as e:
+            run.error = type(e).__name__
+            raise
+        finally:
+            current_metrics_span.reset(span_token)
+            current_metrics_run.reset(token)
+            if run.track_memory: stop_memory_tracking()
+            record_metrics_run(run)
 
-def setup_fonts():
-    if not os.path.exists(cloud_font_path):
+@st.cache_resource
+def startup_stats():
+    # プロセス起動後、最初の実行でだけ作られる（以降の再実行では同じ値を返す）
+    return {"import_ms": round((time.perf_counter() - APP_IMPORT_STARTED) * 1000, 1), "first_run_ms": None, "font": cloud_font_path}
+
+@st.cache_resource
+def metrics_store():
+    runs = collections.deque(maxlen=METRICS_KEEP_RUNS)
+    if METRICS_FILE.exists():
         try:
-            font_url = "https://github.com/googlefonts/morisawa-biz-ud-gothic/raw/main/fonts/ttf/BIZUDGothic-Regular.ttf"
-            urllib.request.urlretrieve(font_url, cloud_font_path)
-        except Exception as e:
-            pass
+            with open(METRICS_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    try: runs.append(json.loads(line))
+                    except ValueError: pass
+        except OSError: pass
+    return {"lock": threading.Lock(), "runs": runs, "appended": 0}
+
+def record_metrics_run(run):
+    store = metrics_store()
+    rec = run.to_dict()
+    with store["lock"]:
+        store["runs"].append(rec)
+        store["appended"] += 1
+        try:
+            # ファイルは追記のみ。一定件数ごとに直近分だけで書き直す
+            if store["appended"] >= METRICS_KEEP_RUNS:
+                tmp = METRICS_FILE.with_suffix(".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for r in store["runs"]: f.write(json.dumps(r, ensure_ascii=False) + "\n")
+                os.replace(tmp, METRICS_FILE)
+                store["appended"] = 0
+            else:
+                with open(METRICS_FILE, "a", encoding="utf-8") as f: f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"計測データの保存エラー: {e}")
+
+def get_metrics_runs():
+    store = metrics_store()
+    with store["lock"]: return list(store["runs"])
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals: return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(round(pct / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+def summarize_stage_metrics(runs):
+    stages = {}
+    for r in runs:
+        stages.setdefault(f"[{r['kind']}] 全体", []).append({"dur_ms": r["dur_ms"], "bytes": 0})
+        for s in r["spans"]: stages.setdefault(s["name"], []).append(s)
+    rows = []
+    for name, ss in stages.items():
+        durs = sorted(s["dur_ms"] for s in ss)
+        peaks = [s["peak_kb"] for s in ss if "peak_kb" in s]
+        rows.append({
+            "処理": name, "回数": len(ss),
+            "p50 (ms)": round(percentile(durs, 50), 1), "p95 (ms)": round(percentile(durs, 95), 1),
+            "平均データ量 (KB)": round(sum(s.get("bytes", 0) for s in ss) / len(ss) / 1024, 1),
+            "最大ピークメモリ (KB)": max(peaks) if peaks else None
+        })
+    return sorted(rows, key=lambda r: -r["p95 (ms)"])
+
+def metrics_to_chrome_trace(runs):
+    # chrome://tracing / Perfetto で開ける形式。実行ごとに1プロセスとして並べる
+    events = []
+    for pid, r in enumerate(runs, 1):
+        base_us = r["started"] * 1e6
+        label = f"{r['kind']} {datetime.fromtimestamp(r['started']).strftime('%m/%d %H:%M:%S')}"
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": label}})
+        events.append({"name": r["kind"], "ph": "X", "pid": pid, "tid": "run", "ts": base_us, "dur": r["dur_ms"] * 1000})
+        for s in r["spans"]:
+            args = {k: s[k] for k in ("bytes", "peak_kb", "error", "critical") if k in s}
+            events.append({"name": s["name"], "ph": "X", "pid": pid, "tid": s.get("thread", "main"),
+                           "ts": base_us + s["start_ms"] * 1000, "dur": s["dur_ms"] * 1000, "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def run_profiled(func):
+    # 1回分の再実行をcProfileで計測し、profiles/ に .prof を保存する
+    import cProfile
+    PROFILE_DIR.mkdir(exist_ok=True)
+    prof = cProfile.Profile()
+    try:
+        prof.runcall(func)
+    finally:
+        path = PROFILE_DIR / f"rerun_{datetime.now().strftime('%Y%m%d%H%M%S')}.prof"
+        prof.dump_stats(path)
+        st.session_state.last_profile_path = str(path)
 
-setup_fonts()
+# ==========================================
+# --- アップロード画像のメモ（1回のアップロードにつきデコード・圧縮は1回） ---
+# ==========================================
+# プレビュー・登録・バックアップで同じアップロードを何度も読み直さないよう、セッションごとに
+# 内容ハッシュ単位で「元データ・デコード済み画像・描画用の派生画像・圧縮済みJPEG（プロファイル別）」を保持する。
+# アップロード欄の file_id → 内容ハッシュの対応を覚えておき、ハッシュの計算も1回で済ませる。
+# 画面からアップロードが外れたものは次の再実行の開始時に破棄し、合計が上限を超えたら古いものから捨てる。
+UPLOAD_MEMO_MAX_MB = 512
+# 登録処理の各段階（別スレッド）には、画面のセッションの代わりにこの変数でメモを渡す
+current_upload_memo = contextvars.ContextVar("current_upload_memo", default=None)
+_upload_memo_lock = threading.RLock()
+
+def upload_memo():
+    # セッション外（コマンドライン・別スレッド）では None（毎回その場で処理する）
+    memo = current_upload_memo.get()
+    if memo is not None: return memo
+    try:
+        memo = st.session_state.get("upload_memo")
+        if memo is None:
+            memo = st.session_state["upload_memo"] = {"files": {}, "blobs": collections.OrderedDict()}
+        return memo
+    except Exception:
+        return None
 
-def safe_filename(name):
-    keepcharacters = (' ', '.', '_', '-')
-    return "".join(c for c in name if c.isalnum() or c in keepcharacters).rstrip()
+def upload_blob(f_obj):
+    memo = upload_memo()
+    fid = getattr(f_obj, "file_id", None)
+    if memo is not None:
+        with _upload_memo_lock:
+            sha = memo["files"].get(fid) if fid else None
+            if sha in memo["blobs"]:
+                memo["blobs"].move_to_end(sha)
+                return memo["blobs"][sha]
+    raw = f_obj.getvalue()
+    sha = hashlib.sha256(raw).hexdigest()
+    # lock: 同じ画像を複数の段階が同時に使うときに、デコード・派生画像の作成を1回にまとめる
+    blob = {"sha": sha, "raw": raw, "decoded": None, "render": None, "compressed": {}, "lock": threading.RLock()}
+    if memo is None: return blob
+    with _upload_memo_lock:
+        if fid: memo["files"][fid] = sha
+        blob = memo["blobs"].setdefault(sha, blob)
+        memo["blobs"].move_to_end(sha)
+        evict_upload_memo(memo)
+    return blob
+
+def upload_blob_bytes(blob):
+    size = len(blob["raw"]) + sum(len(v) for v in blob["compressed"].values())
+    for key in ("decoded", "render"):
+        if blob[key] is not None: size += blob[key].width * blob[key].height * len(blob[key].getbands())
+    return size
+
+def evict_upload_memo(memo):
+    # 直近に使ったもの（末尾）は残す
+    while len(memo["blobs"]) > 1 and sum(upload_blob_bytes(b) for b in memo["blobs"].values()) > UPLOAD_MEMO_MAX_MB * 1024 * 1024:
+        memo["blobs"].popitem(last=False)
+
+def prune_upload_memo(active_files):
+    # 現在アップロード欄に載っているファイル以外の記録を破棄する
+    memo = upload_memo()
+    if not memo: return
+    active = {getattr(f, "file_id", None) for f in active_files}
+    memo["files"] = {fid: sha for fid, sha in memo["files"].items() if fid in active}
+    keep = set(memo["files"].values())
+    for sha in [sha for sha in memo["blobs"] if sha not in keep]:
+        del memo["blobs"][sha]
+
+def active_uploads():
+    # 画像のアップロード欄（up_… / edit_ex_f_… / new_ex_img_…）の現在の値
+    files = []
+    for key in list(st.session_state.keys()):
+        if isinstance(key, str) and key.startswith(("up_", "edit_ex_f_", "new_ex_img_")):
+            val = st.session_state[key]
+            if hasattr(val, "file_id"): files.append(val)
+    return files
 
 # ==========================================
 # --- 画像自動圧縮＆最適化エンジン ---
 # ==========================================
-def compress_image(uploaded_file, max_size=1000):
+# 画像欄ごとに圧縮プロファイルを選ぶ。品質は max→min の範囲で予算（KB）に収まる最高値を探す
+# grayscale="auto" は彩度がほとんど無い画像（白黒の手順書スキャン等）だけグレースケールで保存する
+COMPRESS_PROFILES = {
+    "photo": {"label": "写真（機器外観・コンセント位置・追加画像）", "max_size": 1280, "quality": 80, "min_quality": 50, "budget_kb": 220, "subsampling": 2, "grayscale": False},
+    "document": {"label": "書類スキャン（LOTO手順書）", "max_size": 2000, "quality": 88, "min_quality": 60, "budget_kb": 450, "subsampling": 0, "grayscale": "auto"},
+    "label": {"label": "銘板・資産管理ラベル", "max_size": 1400, "quality": 88, "min_quality": 60, "budget_kb": 260, "subsampling": 0, "grayscale": False},
+}
+SLOT_COMPRESS_PROFILE = {"ext": "photo", "out": "photo", "lab": "label", "lo1": "document", "lo2": "document"}
+COMPRESS_DEFAULT_PROFILE = "photo"
+ACHROMATIC_THRESHOLD = 6  # 縮小画像でのRGB各チャンネル差の平均（0-255）
+
+def compress_profile_for_slot(slot):
+    # 追加画像（ex_0, ex_new_1 …）は写真として扱う
+    return SLOT_COMPRESS_PROFILE.get(slot, COMPRESS_DEFAULT_PROFILE)
+
+def is_near_achromatic(img, threshold=ACHROMATIC_THRESHOLD):
+    small = img.convert("RGB").resize((64, 64))
+    r, g, b = small.split()
+    diff = ImageChops.lighter(ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)), ImageChops.difference(r, b))
+    return ImageStat.Stat(diff).mean[0] < threshold
+
+def compress_image(uploaded_file, profile=COMPRESS_DEFAULT_PROFILE):
+    blob = upload_blob(uploaded_file) if hasattr(uploaded_file, "getvalue") else None
+    if blob is not None and profile in blob["compressed"]:
+        return blob["compressed"][profile]
+    with span("画像圧縮") as sp:
+        data = compress_image_raw(uploaded_file, profile, blob)
+        sp["bytes"] = len(data) if data else 0
+    if blob is not None and data: blob["compressed"][profile] = data
+    return data
+
+def compress_image_raw(uploaded_file, profile=COMPRESS_DEFAULT_PROFILE, blob=None):
+    prof = COMPRESS_PROFILES.get(profile, COMPRESS_PROFILES[COMPRESS_DEFAULT_PROFILE])
     try:
-        if hasattr(uploaded_file, 'read'):
-            file_bytes = uploaded_file.read()
-            img = Image.open(io.BytesIO(file_bytes))
-            uploaded_file.seek(0)
+        if blob is not None and blob["decoded"] is not None:
+            # プレビューでデコード済みなら、それを縮小して使う（メモ上の画像は書き換えない）
+            img = blob["decoded"].copy()
         else:
-            img = Image.open(uploaded_file)
-            
-        img = ImageOps.exif_transpose(img) 
-        if img.mode in ('RGBA', 'P'):
+            if blob is not None:
+                img = Image.open(io.BytesIO(blob["raw"]))
+            elif hasattr(uploaded_file, 'read'):
+                file_bytes = uploaded_file.read()
+                img = Image.open(io.BytesIO(file_bytes))
+                uploaded_file.seek(0)
+            else:
+                img = Image.open(uploaded_file)
+            # JPEGは目標サイズ付近までDCT段階で縮小してからデコードする
+            if img.format == "JPEG": img.draft("RGB", (prof["max_size"], prof["max_size"]))
+            img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
             img = img.convert('RGB')
-            
-        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        output = io.BytesIO()
-        img.save(output, format="JPEG", quality=75, optimize=True)
-        return output.getvalue()
+        if prof["grayscale"] == "auto" and img.mode == 'RGB' and is_near_achromatic(img):
+            img = img.convert('L')
+
+        img.thumbnail((prof["max_size"], prof["max_size"]), Image.Resampling.LANCZOS)
+        save_kwargs = {"optimize": True}
+        if img.mode == 'RGB': save_kwargs["subsampling"] = prof["subsampling"]
+        return encode_to_budget(img, "JPEG", prof["quality"], prof["min_quality"], prof["budget_kb"] * 1024, **save_kwargs)
     except Exception as e:
         print(f"圧縮エラー: {e}")
         return None
@@ -75,27 +448,448 @@ def compress_image(uploaded_file, max_size=1000):
 # ==========================================
 # --- URL短縮 ＆ 爆速QR生成 ---
 # ==========================================
+SHORTENER_URL = os.environ.get("QR_SHORTENER_URL", "https://is.gd/create.php?format=simple&url=")
+
 def make_short_url(long_url):
-    try:
-        api_url = f"https://is.gd/create.php?format=simple&url={urllib.parse.quote(long_url)}"
-        req = urllib.request.Request(api_url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req) as res:
-            return res.read().decode('utf-8')
-    except:
-        return long_url
+    with span("URL短縮(is.gd)"):
+        try:
+            api_url = f"{SHORTENER_URL}{urllib.parse.quote(long_url)}"
+            req = urllib.request.Request(api_url, headers={'User-Agent': 'Mozilla/5.0'})
+            with urllib.request.urlopen(req, timeout=10) as res:
+                return res.read().decode('utf-8')
+        except:
+            return long_url
+
+def make_optimized_qr(url, shorten=True):
+    # 固定URL（/d/{管理番号}）は十分短いので短縮サービスを通さない
+    short_url = make_short_url(url) if shorten else url
+    import qrcode
+    with span("QR生成"):
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=1)
+        qr.add_data(short_url)
+        qr.make(fit=True)
+        return qr.make_image(fill_color="black", back_color="white")
 
-def make_optimized_qr(url):
-    short_url = make_short_url(url)
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=1)
-    qr.add_data(short_url)
-    qr.make(fit=True)
-    return qr.make_image(fill_color="black", back_color="white")
+# ==========================================
+# --- マニュアル画像 出力プロファイル ---
+# ==========================================
+# subsampling: 0=4:4:4 / 1=4:2:2 / 2=4:2:0（白地に黒文字が中心のため4:2:0でも劣化が目立たない）
+MANUAL_ENCODE_PROFILES = {
+    "mobile": {"label": "モバイル最適化（プログレッシブJPEG）", "quality": 85, "min_quality": 55, "progressive": True, "subsampling": 2, "webp": False},
+    "mobile_webp": {"label": "モバイル最適化＋WebP（社内サーバー配信用）", "quality": 85, "min_quality": 55, "progressive": True, "subsampling": 2, "webp": True},
+    "baseline": {"label": "従来形式（ベースラインJPEG 品質85）", "quality": 85, "min_quality": 85, "progressive": False, "subsampling": None, "webp": False},
+}
+MANUAL_DEFAULT_PROFILE = "mobile"
+MANUAL_DEFAULT_BUDGET_KB = 1200
+WEBP_MAX_DIM = 16383  # WebPの仕様上の最大辺
+
+def encode_to_budget(img, fmt, quality, min_quality, byte_budget=None, step=5, **save_kwargs):
+    # 品質を5刻みで二分探索し、予算内に収まる最高品質のデータを返す（収まらなければ最小品質）
+    def enc(q):
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, quality=q, **save_kwargs)
+        return buf.getvalue()
+
+    data = enc(quality)
+    if not byte_budget or len(data) <= byte_budget or min_quality >= quality:
+        return data
+    smallest = enc(min_quality)
+    if len(smallest) > byte_budget:
+        return smallest
+    candidates = list(range(min_quality + step, quality, step))
+    best = smallest
+    lo, hi = 0, len(candidates) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        d = enc(candidates[mid])
+        if len(d) <= byte_budget:
+            best = d; lo = mid + 1
+        else:
+            hi = mid - 1
+    return best
+
+def save_manual_image(img, output_path, profile=MANUAL_DEFAULT_PROFILE, byte_budget_kb=MANUAL_DEFAULT_BUDGET_KB):
+    prof = MANUAL_ENCODE_PROFILES.get(profile, MANUAL_ENCODE_PROFILES[MANUAL_DEFAULT_PROFILE])
+    budget = int(byte_budget_kb * 1024) if byte_budget_kb else None
+    img = img.convert('RGB')
+    output_path = Path(output_path)
+
+    jpeg_kwargs = {"optimize": True, "progressive": prof["progressive"]}
+    if prof["subsampling"] is not None: jpeg_kwargs["subsampling"] = prof["subsampling"]
+    with span("JPEGエンコード") as sp:
+        jpeg_data = encode_to_budget(img, "JPEG", prof["quality"], prof["min_quality"], budget, **jpeg_kwargs)
+        sp["bytes"] = len(jpeg_data)
+    with open(output_path, "wb") as f: f.write(jpeg_data)
+    written = [output_path]
+
+    # 同名のWebP版はサーバー側でAcceptヘッダーを見て出し分ける
+    webp_path = output_path.with_suffix(".webp")
+    if prof["webp"] and max(img.size) <= WEBP_MAX_DIM:
+        with span("WebPエンコード") as sp:
+            webp_data = encode_to_budget(img, "WEBP", prof["quality"] - 10, prof["min_quality"] - 10, budget, method=0)
+            sp["bytes"] = len(webp_data)
+        with open(webp_path, "wb") as f: f.write(webp_data)
+        written.append(webp_path)
+    elif webp_path.exists():
+        try: webp_path.unlink()
+        except: pass
+    return written
 
 # ==========================================
 # --- マニュアル画像 生成関数 ---
 # ==========================================
-def create_manual_image(data, output_path):
-    W = 1600; margin = 80; content_w = W - margin * 2
+def load_source_image(src):
+    if isinstance(src, str):
+        pending = outbox_local_file(src) if src.startswith("http") else None
+        if pending is not None:
+            pil_img = Image.open(pending)
+        elif src.startswith("http"):
+            with span("画像取得(リモート)") as sp:
+                req = urllib.request.Request(src, headers={'User-Agent': 'Mozilla/5.0'})
+                with urllib.request.urlopen(req) as res:
+                    raw = res.read()
+                sp["bytes"] = len(raw)
+            pil_img = Image.open(io.BytesIO(raw))
+        else:
+            pil_img = Image.open(src)
+    elif hasattr(src, "getvalue"):
+        blob = upload_blob(src)
+        with blob["lock"]:
+            if blob["decoded"] is None:
+                with span("画像デコード(アップロード)", len(blob["raw"])):
+                    blob["decoded"] = ImageOps.exif_transpose(Image.open(io.BytesIO(blob["raw"]))).convert('RGB')
+        return blob["decoded"]
+    elif hasattr(src, 'read'):
+        file_bytes = src.read()
+        pil_img = Image.open(io.BytesIO(file_bytes))
+        src.seek(0)
+    else:
+        pil_img = Image.open(src)
+    return ImageOps.exif_transpose(pil_img).convert('RGB')
+
+# ==========================================
+# --- 描画用の派生画像（アップロード時に1回だけ作成） ---
+# ==========================================
+# 機器情報ページの画像欄と同じ幅（MANUAL_CONTENT_W）・向き補正済み・RGB の JPEG を
+# derivatives/ に保存し、描画時は縮小・拡大せずそのまま貼り付ける。
+# 縦横比は index.json に記録するため、区画の高さは画像を開かずに分かる。
+MANUAL_CONTENT_W = 1440
+DERIVATIVE_INDEX = DERIVATIVE_DIR / "index.json"
+DERIVATIVE_QUALITY = 92
+DERIVATIVE_UPLOAD_KEEP_DAYS = 7
+
+def derivative_key(ref):
+    # 保存済み画像は参照先（URL・パス＋更新時刻）、アップロード中のファイルは内容で識別する
+    try:
+        if isinstance(ref, str):
+            if ref.startswith("http"): base = f"url:{ref}"
+            else:
+                st_ = os.stat(ref)
+                base = f"path:{Path(ref).resolve()}:{st_.st_size}:{st_.st_mtime_ns}"
+            return "r_" + hashlib.sha1(base.encode("utf-8")).hexdigest()[:24]
+        if hasattr(ref, "getvalue"):
+            return "u_" + upload_blob(ref)["sha"][:24]
+    except OSError:
+        pass
+    return None
+
+@st.cache_resource
+def derivative_index():
+    data = {}
+    if DERIVATIVE_INDEX.exists():
+        try:
+            with open(DERIVATIVE_INDEX, "r", encoding="utf-8") as f: data = json.load(f)
+        except Exception: pass
+    return {"lock": threading.Lock(), "data": data}
+
+def save_derivative_index(idx):
+    tmp = DERIVATIVE_INDEX.with_name(f"index.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(idx["data"], f)
+    os.replace(tmp, DERIVATIVE_INDEX)
+
+def derivative_info(ref):
+    # {"w", "h", "aspect"}。未作成なら None
+    key = derivative_key(ref)
+    return derivative_index()["data"].get(key) if key else None
+
+def normalize_for_manual(pil_img):
+    if pil_img.width == MANUAL_CONTENT_W: return pil_img
+    h = max(1, round(MANUAL_CONTENT_W * pil_img.height / pil_img.width))
+    return pil_img.resize((MANUAL_CONTENT_W, h), Image.Resampling.LANCZOS)
+
+def store_derivative(keys, pil_img):
+    DERIVATIVE_DIR.mkdir(exist_ok=True)
+    der = normalize_for_manual(pil_img)
+    buf = io.BytesIO()
+    der.save(buf, format="JPEG", quality=DERIVATIVE_QUALITY, subsampling=0)
+    data = buf.getvalue()
+    idx = derivative_index()
+    with span("派生画像保存", len(data) * len(keys)), idx["lock"]:
+        for key in keys:
+            tmp = DERIVATIVE_DIR / f"{key}.{threading.get_ident()}.part"
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, DERIVATIVE_DIR / f"{key}.jpg")
+            idx["data"][key] = {"w": der.width, "h": der.height, "aspect": round(der.height / der.width, 6), "at": time.time()}
+        save_derivative_index(idx)
+    return der
+
+def link_derivative(src_key, keys, h):
+    idx = derivative_index()
+    with idx["lock"]:
+        for key in keys:
+            tmp = DERIVATIVE_DIR / f"{key}.{threading.get_ident()}.part"
+            shutil.copyfile(DERIVATIVE_DIR / f"{src_key}.jpg", tmp)
+            os.replace(tmp, DERIVATIVE_DIR / f"{key}.jpg")
+            idx["data"][key] = {"w": MANUAL_CONTENT_W, "h": h, "aspect": round(h / MANUAL_CONTENT_W, 6), "at": time.time()}
+        save_derivative_index(idx)
+
+def register_upload_derivative(file_obj, *refs):
+    # アップロードされた原寸画像から派生画像を作り、保存先の参照（URL・パス）でも引けるようにする
+    up_key = derivative_key(file_obj)
+    keys = [k for k in [up_key, *[derivative_key(r) for r in refs if r]] if k]
+    if not keys: return
+    blob = upload_blob(file_obj) if hasattr(file_obj, "getvalue") else None
+    with blob["lock"] if blob is not None else contextlib.nullcontext():
+        register_upload_derivative_locked(file_obj, blob, up_key, keys)
+
+def register_upload_derivative_locked(file_obj, blob, up_key, keys):
+    try:
+        # プレビュー時に作成済みなら、デコードし直さずに同じ派生画像を流用する
+        up_path = DERIVATIVE_DIR / f"{up_key}.jpg" if up_key else None
+        if up_path is not None and up_path.exists():
+            if blob is not None and blob["render"] is not None:
+                link_derivative(up_key, keys[1:], blob["render"].height)
+                return
+            with Image.open(up_path) as im:
+                if im.width == MANUAL_CONTENT_W:
+                    link_derivative(up_key, keys[1:], im.height)
+                    return
+        der = store_derivative(keys, load_source_image(file_obj))
+        if blob is not None: blob["render"] = der
+    except Exception as e:
+        print(f"派生画像の作成エラー: {e}")
+
+def load_render_image(ref):
+    if isinstance(ref, str): return load_shared_render_image(ref)
+    blob = upload_blob(ref) if hasattr(ref, "getvalue") else None
+    if blob is None: return load_render_image_uncached(ref)
+    with blob["lock"]:
+        if blob["render"] is None: blob["render"] = load_render_image_uncached(ref)
+        return blob["render"]
+
+def load_render_image_uncached(ref):
+    key = derivative_key(ref)
+    path = DERIVATIVE_DIR / f"{key}.jpg" if key else None
+    if path is not None and path.exists():
+        img = Image.open(path)
+        img.load()
+        if img.width == MANUAL_CONTENT_W: return img.convert("RGB")
+    pil_img = load_source_image(ref)
+    return store_derivative([key], pil_img) if key else normalize_for_manual(pil_img)
+
+def referenced_derivative_keys():
+    # 台帳の行が参照している画像（URL・パス）の派生画像のキー。パスは今の更新時刻で計算するため、
+    # 差し替えられる前の画像の派生画像は参照されていない扱いになる
+    refs = []
+    df = load_devices()
+    for col in ("img_exterior", "img_outlet", "img_label", "img_loto1", "img_loto2"):
+        if col in df.columns: refs += df[col].tolist()
+    if "extra_images" in df.columns:
+        for cell in df["extra_images"].tolist():
+            try: refs += [e.get("url") for e in json.loads(cell) if isinstance(e, dict)]
+            except (TypeError, ValueError): pass
+    return {derivative_key(r) for r in refs if stored_image_ref(r)}
+
+def cleanup_derivatives(keep_days=DERIVATIVE_UPLOAD_KEEP_DAYS):
+    # 期限を過ぎた派生画像のうち、保存されなかったアップロード（u_）と、台帳のどの行からも
+    # 参照されなくなった保存済み画像（r_）のものを削除する
+    limit = time.time() - keep_days * 86400
+    idx = derivative_index()
+    with idx["lock"]:
+        old = [k for k, rec in idx["data"].items() if rec.get("at", 0) < limit]
+    if not old: return
+    live = referenced_derivative_keys() if any(k.startswith("r_") for k in old) else set()
+    with idx["lock"]:
+        removed = False
+        for key in old:
+            rec = idx["data"].get(key)
+            if rec is None or rec.get("at", 0) >= limit or key in live: continue
+            try: (DERIVATIVE_DIR / f"{key}.jpg").unlink()
+            except FileNotFoundError: pass
+            del idx["data"][key]; removed = True
+        if removed: save_derivative_index(idx)
+
+# ==========================================
+# --- 描画用画像・画像区画のメモリキャッシュ（全セッション共通） ---
+# ==========================================
+# 保存済みの画像（URL・パス）は、デコード済みの派生画像と、見出し・枠付きの画像区画（タイル）を
+# 派生画像のキー単位でメモリに持つ。合計が上限を超えたら古いものから捨てる。
+# 同じ画像を別のスレッド（先読み・別の画面）が読み込み中なら、終わるのを待ってその結果を使う。
+RENDER_CACHE_MB = 256
+RENDER_CACHE_WAIT = 60
+# 画像区画のレイアウト: (見出しの文字サイズ, 見出しのy, 画像の上端, 画像の下の余白)
+SECTION_LAYOUTS = {"base": (55, 20, 90, 50), "extra": (65, 25, 100, 60)}
+
+@st.cache_resource
+def render_cache():
+    return {"lock": threading.Lock(), "items": collections.OrderedDict(), "bytes": 0, "loading": {}}
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+def render_cache_get(key):
+    cache = render_cache()
+    with cache["lock"]:
+        img = cache["items"].get(key)
+        if img is not None: cache["items"].move_to_end(key)
+        return img
+
+def render_cache_put(key, img):
+    cache = render_cache()
+    with cache["lock"]:
+        old = cache["items"].pop(key, None)
+        if old is not None: cache["bytes"] -= image_nbytes(old)
+        cache["items"][key] = img
+        cache["bytes"] += image_nbytes(img)
+        while len(cache["items"]) > 1 and cache["bytes"] > RENDER_CACHE_MB * 1024 * 1024:
+            _, dropped = cache["items"].popitem(last=False)
+            cache["bytes"] -= image_nbytes(dropped)
+    return img
+
+def load_shared_render_image(ref):
+    key = derivative_key(ref)
+    if key is None: return load_render_image_uncached(ref)
+    img = render_cache_get(("img", key))
+    if img is not None: return img
+    cache = render_cache()
+    with cache["lock"]:
+        waiter = cache["loading"].get(key)
+        owner = waiter is None
+        if owner: waiter = cache["loading"][key] = threading.Event()
+    if not owner:
+        waiter.wait(RENDER_CACHE_WAIT)
+        img = render_cache_get(("img", key))
+        return img if img is not None else load_render_image_uncached(ref)
+    try:
+        img = load_render_image_uncached(ref)
+        img.info["render_key"] = key  # 画像区画のキャッシュキーに使う
+        return render_cache_put(("img", key), img)
+    finally:
+        with cache["lock"]: cache["loading"].pop(key, None)
+        waiter.set()
+
+def section_title_font(layout):
+    try: return ImageFont.truetype(cloud_font_path, SECTION_LAYOUTS[layout][0])
+    except Exception: return ImageFont.load_default()
+
+def image_section_tile(pil_img, title, font, layout="base"):
+    # 見出し＋枠付きの画像区画。保存済みの画像なら作成済みのタイルを使い回す（貼り付け専用・書き換え禁止）
+    W = 1600; margin = 80; content_w = MANUAL_CONTENT_W
+    _, title_y, top, bottom = SECTION_LAYOUTS[layout]
+    render_key = pil_img.info.get("render_key")
+    font_path = getattr(font, "path", None)
+    font_id = (font_path if isinstance(font_path, str) else "default", getattr(font, "size", None))  # 標準フォントの path はファイルではない
+    tile_key = ("tile", render_key, title, layout, MANUAL_TEMPLATE_VERSION, font_id) if render_key else None
+    if tile_key:
+        tile = render_cache_get(tile_key)
+        if tile is not None: return tile
+
+    # 派生画像は既に content_w 幅なので、そのまま貼り付ける
+    pil_img = normalize_for_manual(pil_img)
+    new_h = pil_img.height
+    tile = Image.new('RGB', (W, top + new_h + bottom), 'white')
+    draw = ImageDraw.Draw(tile)
+    draw.text((margin, title_y), title, fill="black", font=font)
+    tile.paste(pil_img, (margin, top))
+    draw.rectangle([margin, top, margin + content_w, top + new_h], outline="gray", width=3)
+    return render_cache_put(tile_key, tile) if tile_key else tile
+
+# ==========================================
+# --- 選択した機器の先読み（プレビュー前に画像と区画を準備） ---
+# ==========================================
+# サイドバーで機器を選んだ時点で、その機器の画像（img_*・追加画像）を並列に取得・デコードして
+# 上のキャッシュに入れ、画像区画も作っておく。プレビュー作成時はほぼ貼り合わせだけになる。
+# 別の機器を選び直したら、前の先読みは取り消し（未着手の分は実行せず、実行中の分は結果を捨てる）。
+PREFETCH_WORKERS = 4
+
+@st.cache_resource
+def prefetch_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def stored_image_ref(ref):
+    if not isinstance(ref, str) or ref.strip() in ("", "nan", "None"): return None
+    return ref if ref.startswith("http") or os.path.isfile(ref) else None
+
+def device_prefetch_jobs(imgs, ex_imgs, is_related_loto):
+    data = {"is_related_loto": is_related_loto, "img_exterior": imgs.get("ext"), "img_outlet": imgs.get("out"),
+            "img_label": imgs.get("lab"), "img_loto1": imgs.get("lo1"), "img_loto2": imgs.get("lo2")}
+    jobs = [(ref, title, "base") for ref, title in manual_base_sources(data)]
+    jobs += [(e.get("url"), e.get("title", ""), "extra") for e in ex_imgs if isinstance(e, dict)]
+    return [(stored_image_ref(ref), title, layout) for ref, title, layout in jobs if stored_image_ref(ref)]
+
+def prefetch_one(ref, title, layout, cancel):
+    if cancel.is_set(): return "cancelled"
+    img = load_render_image(ref)
+    if cancel.is_set(): return "cancelled"
+    image_section_tile(img, title, section_title_font(layout), layout)
+    return "done"
+
+def run_device_prefetch(pool, jobs, cancel, track_memory=False):
+    with metrics_run("先読み", track_memory) as run:
+        # 各ジョブにはこの実行（計測中の metrics_run）のコンテキストを引き継ぐ
+        futures = [pool.submit(contextvars.copy_context().run, prefetch_one, *job, cancel) for job in jobs]
+        results = []
+        for fut in futures:
+            if cancel.is_set(): fut.cancel()  # 未着手の分は実行しない
+            try: results.append("cancelled" if fut.cancelled() else fut.result())
+            except Exception as e:
+                results.append("failed")
+                with run.lock: run.error = run.error or type(e).__name__
+        return {k: results.count(k) for k in ("done", "cancelled", "failed") if results.count(k)}
+
+def start_device_prefetch(imgs, ex_imgs, is_related_loto, track_memory=False):
+    # 前回の先読みを取り消し、新しい取り消し用トークンをセッションに置く
+    cancel_device_prefetch()
+    jobs = device_prefetch_jobs(imgs, ex_imgs, is_related_loto)
+    if not jobs: return None
+    cancel = threading.Event()
+    st.session_state["prefetch_cancel"] = cancel
+    # 共有のリソースはこの（画面の）スレッドで用意し、先読みのスレッドは画面のコンテキストを持たずに動かす
+    pool = prefetch_pool()
+    render_cache(); derivative_index()
+    threading.Thread(target=run_device_prefetch, args=(pool, jobs, cancel, track_memory), daemon=True, name="prefetch-device").start()
+    return cancel
+
+def cancel_device_prefetch():
+    cancel = st.session_state.pop("prefetch_cancel", None)
+    if cancel is not None: cancel.set()
+
+# 読み込みに失敗した画像の目印（未指定のNoneとは区別する）
+DECODE_FAILED = object()
+
+def decode_manual_sources(refs):
+    decoded = []
+    with span("画像読み込み・デコード"):
+        for ref in refs:
+            if not ref:
+                decoded.append(None); continue
+            try: decoded.append(load_render_image(ref))
+            except Exception: decoded.append(DECODE_FAILED)
+    return decoded
+
+def manual_base_sources(data):
+    loto_suffix = "（関連機器、付帯設備）" if data.get('is_related_loto') else ""
+    return [
+        (data.get('img_exterior'), "機器外観"),
+        (data.get('img_outlet'), "コンセント位置"),
+        (data.get('img_label'), "資産管理ラベル"),
+        (data.get('img_loto1'), f"LOTO手順書{loto_suffix} Page 1"),
+        (data.get('img_loto2'), f"LOTO手順書{loto_suffix} Page 2")
+    ]
+
+def render_manual_image(data, decoded=None):
+    W = 1600; margin = 80
     try:
         font_title = ImageFont.truetype(cloud_font_path, 80)
         font_sub = ImageFont.truetype(cloud_font_path, 55)
@@ -113,52 +907,21 @@ def create_manual_image(data, output_path):
     draw.text((margin + 20, 285), f"■ 使用電源: AC {data['power'] or '未設定'}", fill="white", font=font_text)
     sections.append(header_img)
 
-    def process_img_section(img_file, title):
-        if not img_file:
+    def process_img_section(pil_img, title):
+        if pil_img is None:
             sec_img = Image.new('RGB', (W, 200), 'white')
             s_draw = ImageDraw.Draw(sec_img)
             s_draw.text((margin, 20), title, fill="black", font=font_sub)
             s_draw.rectangle([margin, 90, W - margin, 190], outline="gray", width=3)
             s_draw.text((W // 2, 145), "画像なし", fill="gray", font=font_text, anchor="mm")
             return sec_img
-        
-        try:
-            if isinstance(img_file, str):
-                if img_file.startswith("http"):
-                    req = urllib.request.Request(img_file, headers={'User-Agent': 'Mozilla/5.0'})
-                    with urllib.request.urlopen(req) as res:
-                        pil_img = Image.open(io.BytesIO(res.read()))
-                else:
-                    pil_img = Image.open(img_file)
-            elif hasattr(img_file, 'read'):
-                file_bytes = img_file.read()
-                pil_img = Image.open(io.BytesIO(file_bytes))
-                img_file.seek(0)
-            else:
-                pil_img = Image.open(img_file)
-            
-            pil_img = ImageOps.exif_transpose(pil_img).convert('RGB')
-            new_h = int(content_w * (pil_img.height / pil_img.width))
-            pil_img = pil_img.resize((content_w, new_h), Image.Resampling.LANCZOS)
-            
-            sec_img = Image.new('RGB', (W, 90 + new_h + 50), 'white')
-            s_draw = ImageDraw.Draw(sec_img)
-            s_draw.text((margin, 20), title, fill="black", font=font_sub)
-            sec_img.paste(pil_img, (margin, 90))
-            s_draw.rectangle([margin, 90, margin + content_w, 90 + new_h], outline="gray", width=3)
-            return sec_img
-        except: return None
+        if pil_img is DECODE_FAILED: return None
+        return image_section_tile(pil_img, title, font_sub, "base")
 
-    loto_suffix = "（関連機器、付帯設備）" if data.get('is_related_loto') else ""
-    img_list = [
-        (data.get('img_exterior'), "機器外観"),
-        (data.get('img_outlet'), "コンセント位置"),
-        (data.get('img_label'), "資産管理ラベル"),
-        (data.get('img_loto1'), f"LOTO手順書{loto_suffix} Page 1"),
-        (data.get('img_loto2'), f"LOTO手順書{loto_suffix} Page 2")
-    ]
-    for f, t in img_list:
-        sec = process_img_section(f, t)
+    img_list = manual_base_sources(data)
+    if decoded is None: decoded = decode_manual_sources([f for f, _ in img_list])
+    for pil_img, (_, t) in zip(decoded, img_list):
+        sec = process_img_section(pil_img, t)
         if sec: sections.append(sec)
 
     total_h = sum(s.height for s in sections) + 100
@@ -167,57 +930,37 @@ def create_manual_image(data, output_path):
     for s in sections:
         final_img.paste(s, (0, curr_y))
         curr_y += s.height
-    final_img.convert('RGB').save(output_path, format="JPEG", quality=85)
+    return final_img
 
-def create_manual_image_extended(data, extra_images, output_path):
-    W = 1600; margin = 80; content_w = W - margin * 2
-    try:
-        font_sub = ImageFont.truetype(cloud_font_path, 65)
-        font_text = ImageFont.truetype(cloud_font_path, 55)
-    except: font_sub = font_text = ImageFont.load_default()
-
-    create_manual_image(data, output_path)
-    base = Image.open(output_path)
-    added = []
-
-    for ex_f, ex_t in extra_images:
-        try:
-            if isinstance(ex_f, str):
-                if ex_f.startswith("http"):
-                    req = urllib.request.Request(ex_f, headers={'User-Agent': 'Mozilla/5.0'})
-                    with urllib.request.urlopen(req) as res: pil = Image.open(io.BytesIO(res.read()))
-                else: pil = Image.open(ex_f)
-            elif hasattr(ex_f, 'read'):
-                file_bytes = ex_f.read()
-                pil = Image.open(io.BytesIO(file_bytes))
-                ex_f.seek(0)
-            else: pil = Image.open(ex_f)
-
-            pil = ImageOps.exif_transpose(pil).convert('RGB')
-            nh = int(content_w * (pil.height / pil.width))
-            pil = pil.resize((content_w, nh), Image.Resampling.LANCZOS)
-            si = Image.new('RGB', (W, 160 + nh), 'white')
-            dr = ImageDraw.Draw(si)
-            dr.text((margin, 25), ex_t, fill="black", font=font_sub)
-            si.paste(pil, (margin, 100))
-            dr.rectangle([margin, 100, margin+content_w, 100+nh], outline="gray", width=3)
-            added.append(si)
-        except: continue
-
-    memo_val = data.get("memo", "なし")
+def wrap_memo_lines(memo_val, font, max_w):
     dummy_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
     lines = []
     line = ""
     for paragraph in memo_val.split('\n'):
         for char in paragraph:
-            if dummy_draw.textbbox((0, 0), line + char, font=font_text)[2] <= (content_w - 60):
+            if dummy_draw.textbbox((0, 0), line + char, font=font)[2] <= max_w:
                 line += char
             else:
                 lines.append(line)
                 line = char
         if line: lines.append(line); line = ""
     if not lines: lines = ["なし"]
+    return lines
+
+def render_extra_sections(data, extra_images, decoded=None):
+    W = 1600; margin = 80; content_w = MANUAL_CONTENT_W
+    try:
+        font_sub = ImageFont.truetype(cloud_font_path, 65)
+        font_text = ImageFont.truetype(cloud_font_path, 55)
+    except: font_sub = font_text = ImageFont.load_default()
+
+    if decoded is None: decoded = decode_manual_sources([f for f, _ in extra_images])
+    added = []
+    for pil, (_, ex_t) in zip(decoded, extra_images):
+        if pil is None or pil is DECODE_FAILED: continue
+        added.append(image_section_tile(pil, ex_t, font_sub, "extra"))
 
+    lines = wrap_memo_lines(data.get("memo", "なし"), font_text, content_w - 60)
     char_h = font_text.getbbox("あ")[3] - font_text.getbbox("あ")[1] if hasattr(font_text, 'getbbox') else font_text.getsize("あ")[1]
     line_step = char_h + 25
     memo_box_h = 110 + (len(lines) * line_step) + 60
@@ -227,18 +970,183 @@ def create_manual_image_extended(data, extra_images, output_path):
     md.rectangle([margin, 110, W - margin, memo_box_h - 20], outline=(242, 155, 33), width=6)
     for i, l in enumerate(lines): md.text((margin + 40, 140 + (i * line_step)), l, fill="black", font=font_text)
     added.append(ms)
+    return added
+
+# レイアウト・文言を変更したら上げる（プレビュー等のキャッシュキーに含まれる）
+MANUAL_TEMPLATE_VERSION = 1
+
+def hash_manual_inputs(data, extra_images, *options):
+    h = hashlib.sha256(f"template:{MANUAL_TEMPLATE_VERSION}".encode("utf-8"))
+
+    def add_ref(ref):
+        if not ref:
+            h.update(b"\0none")
+        elif isinstance(ref, str):
+            h.update(ref.encode("utf-8"))
+            if not ref.startswith("http") and os.path.exists(ref):
+                h.update(str(os.stat(ref).st_mtime_ns).encode("utf-8"))
+        elif hasattr(ref, "getvalue"):
+            h.update(bytes.fromhex(upload_blob(ref)["sha"]))
+        else:
+            h.update(repr(ref).encode("utf-8"))
+
+    for key in ("id", "name", "power", "memo", "is_related_loto"):
+        h.update(f"\0{key}={data.get(key)!r}".encode("utf-8"))
+    for ref, _ in manual_base_sources(data): add_ref(ref)
+    for ref, title in extra_images:
+        add_ref(ref); h.update(f"\0{title}".encode("utf-8"))
+    for opt in options: h.update(f"\0{opt!r}".encode("utf-8"))
+    return h.hexdigest()[:20]
+
+def create_manual_image(data, output_path, profile=MANUAL_DEFAULT_PROFILE, byte_budget_kb=MANUAL_DEFAULT_BUDGET_KB):
+    return save_manual_image(render_manual_image(data), output_path, profile, byte_budget_kb)
+
+def create_manual_image_extended(data, extra_images, output_path, profile=MANUAL_DEFAULT_PROFILE, byte_budget_kb=MANUAL_DEFAULT_BUDGET_KB, with_viewer=False):
+    # 各画像は一度だけデコードし、1枚画像とHTML版の両方で使い回す
+    base_sources = manual_base_sources(data)
+    base_decoded = decode_manual_sources([f for f, _ in base_sources])
+    extra_decoded = decode_manual_sources([f for f, _ in extra_images])
+
+    with span("マニュアル描画"):
+        base = render_manual_image(data, base_decoded)
+        added = render_extra_sections(data, extra_images, extra_decoded)
+
+        final = Image.new('RGB', (1600, base.height + sum(s.height for s in added) + 100), 'white')
+        final.paste(base, (0, 0))
+        cy = base.height
+        for s in added: final.paste(s, (0, cy)); cy += s.height
+    written = save_manual_image(final, output_path, profile, byte_budget_kb)
+
+    if with_viewer:
+        sections = [(t, pil) for pil, (_, t) in zip(base_decoded, base_sources)]
+        sections += [(t, pil) for pil, (_, t) in zip(extra_decoded, extra_images) if pil is not None]
+        with span("HTML版ページ生成"):
+            written += create_manual_viewer(data, sections, output_path, profile)
+    return written
 
-    final = Image.new('RGB', (W, base.height + sum(s.height for s in added) + 100), 'white')
-    final.paste(base, (0, 0))
-    cy = base.height
-    for s in added: final.paste(s, (0, cy)); cy += s.height
-    final.convert('RGB').save(output_path, format="JPEG", quality=85)
+# ==========================================
+# --- プレビュー画像（縮小版で表示・原寸はダウンロード時のみ） ---
+# ==========================================
+PREVIEW_WIDTH = 800
+PREVIEW_KEEP = 30
+
+def create_manual_preview(data, extra_images, profile=MANUAL_DEFAULT_PROFILE, byte_budget_kb=MANUAL_DEFAULT_BUDGET_KB):
+    # 入力内容のハッシュが同じなら前回の生成物をそのまま使う
+    r_hash = hash_manual_inputs(data, extra_images, profile, byte_budget_kb)
+    full_path = PREVIEW_DIR / f"preview_{r_hash}.jpg"
+    thumb_path = PREVIEW_DIR / f"preview_{r_hash}_sm.jpg"
+    if not (full_path.exists() and thumb_path.exists()):
+        create_manual_image_extended(data, extra_images, full_path, profile, byte_budget_kb)
+        img = Image.open(full_path)
+        img.draft('RGB', (PREVIEW_WIDTH, img.height * PREVIEW_WIDTH // img.width))
+        img = img.convert('RGB')
+        img.thumbnail((PREVIEW_WIDTH, img.height), Image.Resampling.LANCZOS)
+        img.save(thumb_path, format="JPEG", quality=75, optimize=True, progressive=True)
+        cleanup_previews()
+        cleanup_derivatives()
+    return {"hash": r_hash, "path": full_path, "thumb": thumb_path}
+
+def cleanup_previews(keep=PREVIEW_KEEP):
+    fulls = sorted(PREVIEW_DIR.glob("preview_*_sm.jpg"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for thumb in fulls[keep:]:
+        for p in (thumb, thumb.with_name(thumb.name.replace("_sm.jpg", ".jpg")), thumb.with_name(thumb.name.replace("_sm.jpg", ".webp"))):
+            try: p.unlink()
+            except: pass
 
+# ==========================================
+# --- スマホ向け HTML版 機器情報ページ ---
+# ==========================================
+VIEWER_WIDTHS = (720, 1440)
+
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body {{ margin: 0; font-family: "Meiryo", "Hiragino Kaku Gothic ProN", "Noto Sans JP", sans-serif; color: #111; background: #fff; }}
+header .bar {{ background: #ffd700; padding: 10px 16px; text-align: right; font-size: 15px; }}
+header h1 {{ margin: 16px; font-size: 26px; }}
+header .power {{ margin: 0 16px 16px; padding: 8px 12px; background: #f29b21; color: #fff; font-size: 17px; }}
+section {{ margin: 0 16px 24px; }}
+section h2 {{ font-size: 19px; margin: 0 0 8px; }}
+section img {{ display: block; width: 100%; height: auto; border: 2px solid #999; box-sizing: border-box; }}
+.noimg {{ border: 2px solid #999; padding: 24px; text-align: center; color: #888; }}
+.memo {{ border: 4px solid #f29b21; padding: 12px 16px; white-space: pre-wrap; word-break: break-all; font-size: 17px; }}
+footer {{ margin: 0 16px 32px; font-size: 14px; }}
+</style>
+</head>
+<body>
+<header>
+<div class="bar">管理番号: {did}</div>
+<h1>{name}</h1>
+<div class="power">■ 使用電源: AC {power}</div>
+</header>
+{sections}
+<section><h2>■ メモ・備考</h2><div class="memo">{memo}</div></section>
+<footer><a href="{full_image}">1枚画像で表示する</a></footer>
+</body>
+</html>
+"""
+
+def create_manual_viewer(data, sections, output_path, profile=MANUAL_DEFAULT_PROFILE):
+    import html
+    output_path = Path(output_path)
+    stem = output_path.stem
+    out_dir = output_path.parent
+
+    # 前回生成時の不要になった区画画像を削除
+    for old in list(out_dir.glob(f"{stem}_s[0-9][0-9]_*.jpg")) + list(out_dir.glob(f"{stem}_s[0-9][0-9]_*.webp")):
+        try: old.unlink()
+        except: pass
+
+    written = []
+    blocks = []
+    img_no = 0
+    for title, pil in sections:
+        if pil is DECODE_FAILED: continue
+        t = html.escape(title)
+        if pil is None:
+            blocks.append(f'<section><h2>{t}</h2><div class="noimg">画像なし</div></section>')
+            continue
+        img_no += 1
+        srcset = []
+        largest = None
+        # 元画像に近い幅の縮小版は作らない（拡大もしない）
+        widths = [w for w in VIEWER_WIDTHS[:-1] if w < pil.width * 0.8] + [min(VIEWER_WIDTHS[-1], pil.width)]
+        for w in widths:
+            h = max(1, int(pil.height * w / pil.width))
+            fname = f"{stem}_s{img_no:02d}_{w}.jpg"
+            resized = pil if w == pil.width else pil.resize((w, h), Image.Resampling.LANCZOS)
+            written += save_manual_image(resized, out_dir / fname, profile, None)
+            srcset.append(f"{urllib.parse.quote(fname)} {w}w")
+            largest = (fname, w, h)
+        loading = 'loading="eager" fetchpriority="high"' if img_no == 1 else 'loading="lazy"'
+        blocks.append(
+            f'<section><h2>{t}</h2><img src="{urllib.parse.quote(largest[0])}" srcset="{", ".join(srcset)}" '
+            f'sizes="(max-width: 1440px) 100vw, 1440px" width="{largest[1]}" height="{largest[2]}" {loading} decoding="async" alt="{t}"></section>'
+        )
+
+    page = VIEWER_TEMPLATE.format(
+        title=html.escape(f"{data['id']} {data['name']}"), did=html.escape(str(data['id'])),
+        name=html.escape(str(data['name'])), power=html.escape(str(data['power'] or '未設定')),
+        sections="\n".join(blocks), memo=html.escape(data.get("memo") or "なし"),
+        full_image=urllib.parse.quote(output_path.name)
+    )
+    html_path = output_path.with_suffix(".html")
+    with open(html_path, "w", encoding="utf-8") as f: f.write(page)
+    written.append(html_path)
+    return written
 
 # ==========================================
 # --- 印刷用ラベル ＆ Excel台帳 処理 ---
 # ==========================================
 def create_label_image(data):
+    with span("ラベル描画"):
+        return create_label_image_raw(data)
+
+def create_label_image_raw(data):
     scale = 4; target_w_px = 350 * scale; target_h_px = 200 * scale
     try:
         font_title = ImageFont.truetype(cloud_font_path, 19 * scale) 
@@ -277,105 +1185,694 @@ def create_label_image(data):
     
     return label_img.resize((350, 200), Image.Resampling.LANCZOS)
 
-def rebuild_excel():
+def rebuild_excel(index=None):
+    with span("ラベルExcel再構築"):
+        rebuild_excel_raw(index)
+
+def rebuild_excel_raw(index=None):
+    import openpyxl
+    from openpyxl.drawing.image import Image as XLImage
+    from openpyxl.utils import get_column_letter
+
     wb = openpyxl.Workbook(); ws = wb.active; ws.title = "印刷用ラベルシート"
     ws.page_setup.orientation = ws.ORIENTATION_PORTRAIT
     ws.page_setup.paperSize = ws.PAPERSIZE_A4
     ws.page_margins.left = ws.page_margins.right = ws.page_margins.top = ws.page_margins.bottom = 0.2
     
-    history = []
-    if LABEL_HISTORY_FILE.exists():
-        try:
-            with open(LABEL_HISTORY_FILE, "r", encoding="utf-8") as f: history = json.load(f)
-        except: pass
+    with label_store()["lock"]:
+        index = index or load_label_index()
+        with label_pack_view(index) as view:
+            for count, item in enumerate(live_labels(index)):
+                c_idx = count // 13; r_idx = count % 13  
+                cell_col = c_idx + 1; cell_row = r_idx + 1
+                col_letter = get_column_letter(cell_col)
+                ws.column_dimensions[col_letter].width = 19.5
+                ws.row_dimensions[cell_row].height = 63.0 
+                xl_img = XLImage(io.BytesIO(bytes(label_bytes(view, item))))
+                xl_img.width, xl_img.height = 132, 76
+                xl_img.anchor = f"{col_letter}{cell_row}"
+                ws.add_image(xl_img)
+        wb.save(EXCEL_LABEL_PATH)
 
-    for count, item in enumerate(history):
-        img_path = TEMP_LABEL_DIR / item["img_filename"]
-        if not img_path.exists(): continue
-        c_idx = count // 13; r_idx = count % 13  
-        cell_col = c_idx + 1; cell_row = r_idx + 1
-        col_letter = get_column_letter(cell_col)
-        ws.column_dimensions[col_letter].width = 19.5
-        ws.row_dimensions[cell_row].height = 63.0 
-        xl_img = XLImage(str(img_path))
-        xl_img.width = 132; xl_img.height = 76
-        xl_img.anchor = f"{col_letter}{cell_row}"
-        ws.add_image(xl_img)
-    wb.save(EXCEL_LABEL_PATH)
+# ==========================================
+# --- ラベル画像の格納（追記型のパックファイル＋索引） ---
+# ==========================================
+# 発行したラベルのPNGは temp_labels/labels_<世代>.pack に追記し、索引 label_index.json に
+# (ラベルID, 機器名, 位置, 長さ, 描画内容のハッシュ) を発行順に記録する。
+# 読み出しはパックを mmap したメモリビューの切り出しで行い、ラベルを1枚ずつファイルとして開かない。
+# 削除は索引に削除済みの印を付けるだけにし、削除済みの分がたまったら有効な分だけを次の世代のパックへ
+# 書き直す（索引の置き換えで切り替えるため、途中で止まっても前の世代のまま読める）。
+# 旧形式（temp_labels/*.png ＋ label_history.json）は最初に読み込んだときにパックへ移行する。
+LABEL_INDEX_FILE = Path("label_index.json")
+LABEL_PACK_COMPACT_RATIO = 0.5
+LABEL_PACK_COMPACT_MIN_BYTES = 512 * 1024
 
-def add_label_to_history(name, label_img):
-    history = []
-    if LABEL_HISTORY_FILE.exists():
-        try:
-            with open(LABEL_HISTORY_FILE, "r", encoding="utf-8") as f: history = json.load(f)
-        except: pass
-    fname = f"label_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.png"
-    label_img.save(TEMP_LABEL_DIR / fname, format='PNG')
-    history.append({"name": name, "img_filename": fname})
-    with open(LABEL_HISTORY_FILE, "w", encoding="utf-8") as f: json.dump(history, f, ensure_ascii=False, indent=2)
-    rebuild_excel()
+@st.cache_resource
+def label_store():
+    # Streamlit は再実行のたびにスクリプトを読み直すため、全セッション・登録の段階で共有する錠と mmap はここに持つ
+    return {"lock": threading.RLock(), "map": None, "map_key": None}
 
-def delete_label_from_history(index):
-    history = []
-    if LABEL_HISTORY_FILE.exists():
+def new_label_index(gen=1):
+    return {"version": 1, "gen": gen, "pack": f"labels_{gen:04d}.pack", "next_id": 1, "labels": []}
+
+def label_pack_path(index):
+    return TEMP_LABEL_DIR / index["pack"]
+
+class LabelIndexError(RuntimeError):
+    pass
+
+def next_label_gen():
+    gens = [int(p.stem.split("_")[-1]) for p in TEMP_LABEL_DIR.glob("labels_*.pack") if p.stem.split("_")[-1].isdigit()]
+    return max(gens, default=0) + 1
+
+def load_label_index():
+    # 索引が読めないときは新しい索引を作らずに止める（作り直すと発行済みのラベルが索引から外れる）
+    with label_store()["lock"]:
+        if LABEL_INDEX_FILE.exists():
+            try:
+                with open(LABEL_INDEX_FILE, "r", encoding="utf-8") as f: return json.load(f)
+            except (OSError, ValueError) as e:
+                raise LabelIndexError(f"ラベルの索引（{LABEL_INDEX_FILE}）を読み込めません: {e}。発行済みのラベルを守るため、ラベルの追加・削除を止めています。ファイルを修復するか、バックアップから復元してください") from e
+        if LABEL_HISTORY_FILE.exists():
+            return migrate_legacy_labels()
+        if any(TEMP_LABEL_DIR.glob("labels_*.pack")):
+            raise LabelIndexError(f"ラベルの索引（{LABEL_INDEX_FILE}）がありませんが、{TEMP_LABEL_DIR} にラベルのパックが残っています。索引を戻すか、バックアップから復元してください")
+        return new_label_index()
+
+def save_label_index(index):
+    write_atomic(LABEL_INDEX_FILE, json.dumps(index, ensure_ascii=False).encode("utf-8"))
+
+def live_labels(index):
+    return [e for e in index["labels"] if not e.get("deleted")]
+
+def pack_append(f, index, name, png):
+    f.seek(0, os.SEEK_END)
+    index["labels"].append({"id": index["next_id"], "name": name, "offset": f.tell(), "length": len(png), "hash": hashlib.sha256(png).hexdigest()[:16]})
+    index["next_id"] += 1
+    f.write(png)
+
+def append_labels(items):
+    # items: [(機器名, PNGのバイト列)]。パックへ追記し終えてから索引を書き換える
+    with label_store()["lock"]:
+        index = load_label_index()
+        with open(label_pack_path(index), "ab") as f:
+            for name, png in items: pack_append(f, index, name, png)
+            f.flush(); os.fsync(f.fileno())
+        save_label_index(index)
+        return index
+
+def label_pack_view(index):
+    # パックを読み取り専用で mmap したメモリビュー。追記・世代の切り替えでファイルが変わったら張り直す
+    path = label_pack_path(index)
+    store = label_store()
+    with store["lock"]:
+        try:
+            st_ = os.stat(path)
+            key = (str(path), st_.st_size, st_.st_mtime_ns)
+        except FileNotFoundError:
+            key = (str(path), 0, 0)
+        if store["map_key"] != key:
+            release_label_map()
+            if key[1]:
+                with open(path, "rb") as f: store["map"] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            store["map_key"] = key
+        mm = store["map"]
+    # 使い終わったら解放できるよう with 文で使う（memoryview は with を抜けると release される）
+    return memoryview(mm) if mm is not None else memoryview(b"")
+
+def label_bytes(view, entry):
+    return view[entry["offset"]:entry["offset"] + entry["length"]]
+
+def release_label_map():
+    store = label_store()
+    mm, store["map"], store["map_key"] = store["map"], None, None
+    if mm is not None:
+        # 切り出したビューが残っている間は閉じられない（参照が無くなった時点で解放される）
+        try: mm.close()
+        except BufferError: pass
+
+def remove_stale_label_packs(index):
+    release_label_map()
+    for p in TEMP_LABEL_DIR.glob("labels_*.pack"):
+        if p.name != index["pack"]:
+            try: p.unlink()
+            except OSError: pass  # Windows で他の画面が開いている間は消せないため、次回の整理で消す
+
+def compact_label_pack(index, force=False):
+    # 削除済みの分が一定以上たまったら、有効なラベルだけを次の世代のパックへ書き直す
+    with label_store()["lock"]:
+        path = label_pack_path(index)
+        size = path.stat().st_size if path.exists() else 0
+        live = live_labels(index)
+        dead = size - sum(e["length"] for e in live)
+        if not force and (dead < LABEL_PACK_COMPACT_MIN_BYTES or dead < size * LABEL_PACK_COMPACT_RATIO): return index
+        with span("ラベルパック整理", size):
+            new = dict(new_label_index(index["gen"] + 1), next_id=index["next_id"])
+            with label_pack_view(index) as view, open(label_pack_path(new), "wb") as f:
+                for e in live:
+                    new["labels"].append(dict(e, offset=f.tell()))
+                    f.write(label_bytes(view, e))
+                f.flush(); os.fsync(f.fileno())
+            save_label_index(new)
+            remove_stale_label_packs(new)
+        return new
+
+def migrate_legacy_labels():
+    # 旧形式の履歴をパックへ移す。索引を書き終えてから旧ファイルを消す（読めないPNGの行は台帳にも出ていなかったため捨てる）
+    with label_store()["lock"]:
+        history = []
         try:
             with open(LABEL_HISTORY_FILE, "r", encoding="utf-8") as f: history = json.load(f)
-        except: pass
-    if 0 <= index < len(history):
-        try: (TEMP_LABEL_DIR / history[index]["img_filename"]).unlink()
-        except: pass
-        history.pop(index)
+        except (OSError, ValueError): pass
+        index = new_label_index(next_label_gen())
+        with span("ラベル履歴の移行"), open(label_pack_path(index), "wb") as f:
+            for item in history:
+                try: png = (TEMP_LABEL_DIR / item.get("img_filename", "")).read_bytes()
+                except OSError: continue
+                pack_append(f, index, item.get("name", ""), png)
+            f.flush(); os.fsync(f.fileno())
+        save_label_index(index)
+        remove_legacy_labels()
+        remove_stale_label_packs(index)
+        return index
+
+def remove_legacy_labels():
+    for p in [LABEL_HISTORY_FILE, *TEMP_LABEL_DIR.glob("*.png")]:
+        try: p.unlink()
+        except OSError: pass
+
+def install_label_pack(pack_path, entries):
+    # バックアップから戻したパックを次の世代として使い始める（pack_path=None ならラベルなし）
+    with label_store()["lock"]:
+        # 今の索引が壊れていても復元できるよう、世代はパックのファイル名から決める
+        index = dict(new_label_index(next_label_gen()), labels=list(entries))
+        index["next_id"] = max([e["id"] for e in entries], default=0) + 1
+        if pack_path: os.replace(pack_path, label_pack_path(index))
+        else: label_pack_path(index).write_bytes(b"")
+        save_label_index(index)
+        remove_legacy_labels()
+        remove_stale_label_packs(index)
+        rebuild_excel(index)
+
+def replace_labels_from_legacy(history):
+    # 旧形式のバックアップの復元用：展開済みの temp_labels/*.png と履歴で、今のラベルを置き換える
+    with label_store()["lock"]:
+        try: LABEL_INDEX_FILE.unlink()
+        except OSError: pass
         with open(LABEL_HISTORY_FILE, "w", encoding="utf-8") as f: json.dump(history, f, ensure_ascii=False, indent=2)
-        rebuild_excel()
+        index = migrate_legacy_labels()
+        remove_stale_label_packs(index)
+        rebuild_excel(index)
+
+def add_label_to_history(name, label_img):
+    # label_img は PIL 画像か、エンコード済みのPNG
+    if isinstance(label_img, (bytes, bytearray)): png = bytes(label_img)
+    else:
+        buf = io.BytesIO()
+        label_img.save(buf, format='PNG')
+        png = buf.getvalue()
+    with label_store()["lock"]:
+        rebuild_excel(append_labels([(name, png)]))
+
+def delete_label_from_history(index_no):
+    with label_store()["lock"]:
+        index = load_label_index()
+        live = live_labels(index)
+        if 0 <= index_no < len(live):
+            live[index_no]["deleted"] = True
+            save_label_index(index)
+            rebuild_excel(compact_label_pack(index))
 
 def clear_history():
-    try: EXCEL_LABEL_PATH.unlink()
-    except: pass
-    try: LABEL_HISTORY_FILE.unlink()
-    except: pass
-    for f in TEMP_LABEL_DIR.glob("*.png"):
-        try: f.unlink()
-        except: pass
+    # 空の索引へ切り替えてから古いパックを消す（消せずに残ったパックは次回の整理で消す）
+    with label_store()["lock"]:
+        try: EXCEL_LABEL_PATH.unlink()
+        except OSError: pass
+        remove_legacy_labels()
+        index = new_label_index(next_label_gen())
+        save_label_index(index)
+        remove_stale_label_packs(index)
+
+# ==========================================
+# --- GitHub 接続先（社内の代替サーバー・検証用スタブにも切り替え可能） ---
+# ==========================================
+GITHUB_API_URL = os.environ.get("QR_GITHUB_API_URL", "https://api.github.com").rstrip("/")
+GITHUB_BRANCH = "main"
+CDN_BASE_URL = os.environ.get("QR_CDN_BASE_URL", "https://cdn.jsdelivr.net/gh").rstrip("/")
+CDN_PURGE_URL = os.environ.get("QR_CDN_PURGE_URL", "https://purge.jsdelivr.net/gh").rstrip("/")
+GITHUB_TIMEOUT = 30
+
+def github_contents_url(repo, path):
+    return f"{GITHUB_API_URL}/repos/{repo}/contents/{urllib.parse.quote(path)}"
+
+def cdn_url(repo, path):
+    # アップロード前でも確定する公開URL（QRコードは送信完了を待たずに発行できる）
+    return f"{CDN_BASE_URL}/{repo}@{GITHUB_BRANCH}/{urllib.parse.quote(path)}"
+
+def cdn_url_from_html(html_url):
+    return html_url.replace("https://github.com/", f"{CDN_BASE_URL}/").replace("/blob/", "@")
+
+def github_put_file(repo, token, path, data, message, sha=None, span_name="GitHubアップロード"):
+    # 応答の content（sha, html_url, path）を返す。既存ファイルの sha が無い・古い（409/422）
+    # ときだけ最新の sha を取り直して1回やり直す
+    api_url = github_contents_url(repo, path)
+
+    def put(cur_sha):
+        payload = {"message": message, "content": base64.b64encode(data).decode("utf-8"), "branch": GITHUB_BRANCH}
+        if cur_sha: payload["sha"] = cur_sha
+        req = urllib.request.Request(api_url, data=json.dumps(payload).encode("utf-8"), method="PUT")
+        req.add_header("Authorization", f"token {token}")
+        req.add_header("Content-Type", "application/json")
+        with span(span_name, len(data)), urllib.request.urlopen(req, timeout=GITHUB_TIMEOUT) as res:
+            content = json.loads(res.read().decode("utf-8"))["content"]
+        content["overwritten"] = bool(cur_sha)
+        return content
+
+    try:
+        return put(sha)
+    except urllib.error.HTTPError as e:
+        if e.code not in (409, 422): raise
+    req_check = urllib.request.Request(api_url)
+    req_check.add_header("Authorization", f"token {token}")
+    try:
+        with urllib.request.urlopen(req_check, timeout=GITHUB_TIMEOUT) as res:
+            sha = json.loads(res.read().decode("utf-8"))["sha"]
+    except urllib.error.HTTPError as e:
+        if e.code != 404: raise
+        sha = None
+    return put(sha)
+
+# ==========================================
+# --- アップロード待ち行列（ネットワーク断でも登録を止めない） ---
+# ==========================================
+# GitHub へのアップロードは outbox/ に「データ(.bin)＋宛先(.json)」として保存してすぐに戻り、
+# バックグラウンドのスレッドがまとめて送信する。失敗した分は間隔を延ばしながら再試行する。
+# 公開URLはアップロード前に確定するため、機器の登録・QR発行は待たずに完了する。
+# 送信後に GitHub が返したURLが予定と異なる場合（リポジトリ名の変更など）は台帳の行を書き換える。
+OUTBOX_POLL = 5
+OUTBOX_MAX_BACKOFF = 300
+
+def write_atomic(path, data, fsync=True):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        if fsync: f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def outbox_entries():
+    entries = []
+    for meta_path in sorted(OUTBOX_DIR.glob("*.json")):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f: entries.append(json.load(f))
+        except (OSError, ValueError): pass
+    return entries
+
+def enqueue_upload(repo, path, data, message, device=None, purge=False):
+    OUTBOX_DIR.mkdir(exist_ok=True)
+    # 同じ宛先への未送信分は最新のデータで置き換える（再生成した機器情報ページ等）
+    for old in outbox_entries():
+        if old["repo"] == repo and old["path"] == path: remove_outbox_entry(old["id"])
+    eid = f"{time.time_ns()}_{os.urandom(3).hex()}"
+    meta = {
+        "id": eid, "repo": repo, "path": path, "url": cdn_url(repo, path), "message": message, "device": device, "purge": purge,
+        "created": time.time(), "attempts": 0, "next_try": 0, "last_error": None, "bytes": len(data)
+    }
+    # データを先に書き、宛先ファイルの存在をもって登録完了とする
+    write_atomic(OUTBOX_DIR / f"{eid}.bin", data)
+    write_atomic(OUTBOX_DIR / f"{eid}.json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+    outbox_worker()["event"].set()
+    return meta["url"]
+
+def remove_outbox_entry(eid):
+    for ext in (".json", ".bin"):
+        try: (OUTBOX_DIR / f"{eid}{ext}").unlink()
+        except FileNotFoundError: pass
+
+def outbox_pending_files():
+    # 送信待ちの {URL: 手元のデータ}。多数のURLを調べるときは1回だけ作って使い回す
+    if not OUTBOX_DIR.exists(): return {}
+    pending = {}
+    for meta in outbox_entries():
+        path = OUTBOX_DIR / f"{meta['id']}.bin"
+        if path.exists(): pending[meta["url"]] = path
+    return pending
+
+def outbox_local_file(url, pending=None):
+    # 未送信の画像は手元のデータから読む（プレビュー・機器情報ページの描画用）
+    return (outbox_pending_files() if pending is None else pending).get(url)
+
+@st.cache_resource
+def outbox_worker():
+    state = {"event": threading.Event(), "creds": {}, "last_error": None, "last_flush": None, "force": False, "lock": threading.Lock()}
+    # 送信スレッドは画面のコンテキストを持たないため、使う共有のリソースはこの（画面の）スレッドで用意しておく
+    metrics_store(); device_db_cache(); ledger_publisher()
+    threading.Thread(target=outbox_loop, args=(state,), daemon=True).start()
+    return state
+
+def outbox_set_credentials(repo, token):
+    if repo and token: outbox_worker()["creds"][repo] = token
+
+def outbox_token(state, repo):
+    token = state["creds"].get(repo) or os.environ.get("QR_GITHUB_TOKEN", "")
+    if not token:
+        try: token = st.secrets.get("github_token", "")
+        except Exception: pass
+    return token
+
+def rewrite_device_refs(did, old_url, new_url):
+    df = load_devices()
+    match = df[df["ID"].astype(str) == str(did)]
+    if match.empty: return
+    row = {k: v for k, v in match.iloc[-1].to_dict().items() if not (isinstance(v, float) and v != v)}
+    changed = False
+    for key, val in row.items():
+        if isinstance(val, str) and old_url in val:
+            row[key] = val.replace(old_url, new_url); changed = True
+    if changed: put_device(row)
+
+def flush_outbox(state, force=False):
+    # 1回の呼び出しで送信可能なものをまとめて送る。接続自体ができない場合は残りを次回に回す
+    sent = 0
+    with state["lock"]:
+        for meta in outbox_entries():
+            if not force and meta["next_try"] > time.time(): continue
+            token = outbox_token(state, meta["repo"])
+            if not token: continue
+            try:
+                with open(OUTBOX_DIR / f"{meta['id']}.bin", "rb") as f: data = f.read()
+                content = github_put_file(meta["repo"], token, meta["path"], data, meta["message"])
+            except FileNotFoundError:
+                remove_outbox_entry(meta["id"]); continue
+            except Exception as e:
+                meta["attempts"] += 1
+                meta["next_try"] = time.time() + min(OUTBOX_MAX_BACKOFF, OUTBOX_POLL * 2 ** meta["attempts"])
+                meta["last_error"] = f"{type(e).__name__}: {e}"
+                state["last_error"] = meta["last_error"]
+                write_atomic(OUTBOX_DIR / f"{meta['id']}.json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+                if isinstance(e, urllib.error.URLError) and not isinstance(e, urllib.error.HTTPError): break
+                continue
+
+            final_url = cdn_url_from_html(content["html_url"]) if content.get("html_url") else meta["url"]
+            if final_url != meta["url"] and meta.get("device"):
+                rewrite_device_refs(meta["device"], meta["url"], final_url)
+            if meta.get("purge") and content.get("overwritten"):
+                # 上書きした場合は CDN のキャッシュを破棄する（失敗しても数時間後には反映される）
+                try: urllib.request.urlopen(final_url.replace(CDN_BASE_URL, CDN_PURGE_URL, 1), timeout=10).close()
+                except Exception: pass
+            remove_outbox_entry(meta["id"])
+            sent += 1
+        if sent: state["last_error"] = None
+        state["last_flush"] = time.time()
+    return sent
+
+def outbox_loop(state):
+    while True:
+        state["event"].wait(OUTBOX_POLL)
+        state["event"].clear()
+        force, state["force"] = state["force"], False
+        try:
+            if OUTBOX_DIR.exists(): flush_outbox(state, force)
+        except Exception as e:
+            print(f"アップロード待ち行列の送信エラー: {e}")
+
+def drain_outbox(timeout=300):
+    # コマンドラインから使う：待ち行列が空になるか timeout 秒経つまで送信を繰り返す
+    state = outbox_worker()
+    deadline = time.time() + timeout
+    while outbox_entries() and time.time() < deadline:
+        flush_outbox(state, force=True)
+        if outbox_entries(): time.sleep(min(OUTBOX_POLL, max(0, deadline - time.time())))
+    return len(outbox_entries())
 
 # ==========================================
 # --- ストレージ保存処理 ---
 # ==========================================
 def save_image_to_storage(file_obj, did, suffix, mode, repo, token, local_path):
     if not file_obj: return ""
-    comp_data = compress_image(file_obj)
+    if hasattr(file_obj, "getvalue") and derivative_info(file_obj) is None:
+        # 派生画像もこの後で作るため、先に1回だけデコードしておき圧縮と共用する
+        load_source_image(file_obj)
+    comp_data = compress_image(file_obj, compress_profile_for_slot(suffix))
     if not comp_data: return ""
     
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     fname = f"{safe_filename(did)}_{suffix}_{timestamp}.jpg"
     
     if mode == "2. 全自動（データベース保存）":
-        encoded = base64.b64encode(comp_data).decode("utf-8")
-        api_url = f"https://api.github.com/repos/{repo}/contents/images/{fname}"
-        payload = {"message": f"Upload {fname}", "content": encoded, "branch": "main"}
-        req = urllib.request.Request(api_url, data=json.dumps(payload).encode("utf-8"), method="PUT")
-        req.add_header("Authorization", f"token {token}")
-        req.add_header("Content-Type", "application/json")
-        try:
-            with urllib.request.urlopen(req) as res:
-                res_data = json.loads(res.read().decode("utf-8"))
-                raw_url = res_data["content"]["html_url"]
-                return raw_url.replace("https://github.com/", "https://cdn.jsdelivr.net/gh/").replace("/blob/", "@")
-        except: return ""
+        outbox_set_credentials(repo, token)
+        with span("アップロード待ち行列へ保存", len(comp_data)):
+            url = enqueue_upload(repo, f"images/{fname}", comp_data, f"Upload {fname}", device=str(did))
+        register_upload_derivative(file_obj, url)
+        return url
         
     elif mode == "3. 社内共有フォルダへ自動保存":
         base_dir = Path(local_path) / "images"
         base_dir.mkdir(parents=True, exist_ok=True)
         out_path = base_dir / fname
-        with open(out_path, "wb") as f: f.write(comp_data)
-        return str(out_path).replace("\\", "/")
+        with span("共有フォルダ保存", len(comp_data)):
+            with open(out_path, "wb") as f: f.write(comp_data)
+        stored = str(out_path).replace("\\", "/")
+        register_upload_derivative(file_obj, stored)
+        return stored
     
     return ""
 
+def manual_public_url(manual_path, mode, repo, with_viewer=False):
+    # 公開後のURLは保存先とファイル名だけで決まる（公開の完了を待たずにQRコードを作れる）
+    manual_path = Path(manual_path)
+    if mode == "2. 全自動（データベース保存）":
+        return cdn_url(repo, f"manuals/{manual_path.name}")
+    elif mode == "3. 社内共有フォルダへ自動保存":
+        published_name = manual_path.with_suffix(".html").name if with_viewer else manual_path.name
+        return f"{get_manual_server_base_url()}/{urllib.parse.quote(published_name)}"
+    return ""
+
+def publish_manual_files(manual_path, manual_files, mode, repo, token, local_path, with_viewer=False, device=None):
+    # 生成済みの機器情報ページを保存先へ公開し、QRコードに載せるURLを返す。
+    # 同じファイル名で公開し直すと既存のQRコードのまま内容だけが更新される
+    manual_path = Path(manual_path)
+    file_name = manual_path.name
+    if mode == "2. 全自動（データベース保存）":
+        outbox_set_credentials(repo, token)
+        with open(manual_path, "rb") as f: data = f.read()
+        with span("アップロード待ち行列へ保存", len(data)):
+            return enqueue_upload(repo, f"manuals/{file_name}", data, f"Upload Manual {file_name}", device=device, purge=True)
+
+    elif mode == "3. 社内共有フォルダへ自動保存":
+        target_dir = Path(local_path) / "manuals"
+        target_dir.mkdir(parents=True, exist_ok=True)
+        if manual_path.resolve() != (target_dir / file_name).resolve():
+            with span("共有フォルダ保存", sum(os.path.getsize(mf) for mf in manual_files)):
+                for mf in manual_files: shutil.copy(mf, target_dir / Path(mf).name)
+        return manual_public_url(manual_path, mode, repo, with_viewer)
+
+    return ""
+
+# ==========================================
+# --- 公開状態の記録（変更のない登録は再生成・再アップロードしない） ---
+# ==========================================
+# 機器ごとに「最後に公開した入力内容の指紋（機器情報・画像の参照・追加画像・テンプレート
+# バージョン・出力設定）」と、そのときの機器情報ページURL・QRコードのURLを記録する。
+# 同じ内容のアップロード画像は、前回保存した参照先をそのまま使う。
+PUBLISH_STATE_FILE = Path("publish_state.json")
+PUBLISH_KEEP_IMAGE_REFS = 50
+
+def load_publish_state():
+    if PUBLISH_STATE_FILE.exists():
+        try:
+            with open(PUBLISH_STATE_FILE, "r", encoding="utf-8") as f: return json.load(f)
+        except Exception: pass
+    return {}
+
+def update_publish_state(did, rec=None):
+    # rec=None で削除。複数の画面から同時に更新されても壊れないよう DB と同じロックで書き換える
+    with device_db_lock():
+        state = load_publish_state()
+        if rec is None: state.pop(str(did), None)
+        else: state[str(did)] = rec
+        tmp = PUBLISH_STATE_FILE.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, PUBLISH_STATE_FILE)
+
+def stored_ref_alive(ref):
+    return bool(ref) and (ref.startswith("http") or os.path.exists(ref))
+
+def device_row_unchanged(did, new_row):
+    # 更新日時以外が同じなら台帳への書き込み（と台帳Excelの再作成）は不要
+    df = load_devices()
+    match = df[df["ID"].astype(str) == str(did)]
+    if match.empty: return False
+    old = match.iloc[-1]
+    norm = lambda v: "" if v is None or (isinstance(v, float) and v != v) else str(v)
+    return all(norm(old.get(k)) == norm(v) for k, v in new_row.items() if k != "Updated")
+
+# ==========================================
+# --- 機器データベース（追記型ジャーナル＋スナップショット） ---
+# ==========================================
+# 保存・削除は devices.journal.jsonl へ1行追記するだけにし（ロックファイルで排他）、
+# 一定量たまったら devices.csv（スナップショット）へ一時ファイル＋置き換えでまとめる。
+# 読み込みはスナップショット＋ジャーナル末尾から現在の状態を組み立てる。
+# まとめ済みのジャーナルは devices_history.jsonl に残り、機器ごとの変更履歴になる。
+DB_COLUMNS = ["ID", "Name", "Power", "URL", "Updated", "memo", "is_related_loto", "img_exterior", "img_outlet", "img_label", "img_loto1", "img_loto2", "extra_images"]
+DB_JOURNAL = Path("devices.journal.jsonl")
+DB_HISTORY = Path("devices_history.jsonl")
+DB_LOCK_FILE = Path("devices.csv.lock")
+DB_LOCK_TIMEOUT = 15
+DB_LOCK_STALE = 120
+DB_COMPACT_BYTES = 512 * 1024
+
+@contextlib.contextmanager
+def device_db_lock(timeout=DB_LOCK_TIMEOUT):
+    # O_EXCL によるロックファイル（Windows の共有フォルダ上でも動作する）。
+    # 保持したまま異常終了したロックは DB_LOCK_STALE 秒で破棄する
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(DB_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(DB_LOCK_FILE) > DB_LOCK_STALE:
+                    os.remove(DB_LOCK_FILE)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError("機器データベースが他の画面で更新中です。しばらくしてから再度お試しください。")
+            time.sleep(0.05)
+    try:
+        os.write(fd, f"{os.getpid()} {datetime.now().isoformat(timespec='seconds')}".encode("utf-8"))
+        os.close(fd)
+        yield
+    finally:
+        try: os.remove(DB_LOCK_FILE)
+        except FileNotFoundError: pass
+
+def read_device_journal(path=DB_JOURNAL, offset=0):
+    # 書き込み途中の最終行（改行なし）は読まずに残し、次回その位置から読み直す
+    if not path.exists(): return [], 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        raw = f.read()
+    end = raw.rfind(b"\n") + 1
+    records = []
+    for line in raw[:end].splitlines():
+        try: records.append(json.loads(line))
+        except ValueError: pass
+    return records, offset + end
+
+def append_device_journal(rec):
+    line = (json.dumps(rec, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    with span("DB書き込み", len(line)), device_db_lock():
+        with open(DB_JOURNAL, "ab") as f:
+            if f.tell() > 0:
+                with open(DB_JOURNAL, "rb") as r:
+                    r.seek(-1, os.SEEK_END)
+                    if r.read(1) != b"\n": f.write(b"\n")
+            f.write(line)
+            f.flush(); os.fsync(f.fileno())
+            size = f.tell()
+        if size > DB_COMPACT_BYTES: compact_devices_locked()
+
+def put_device(row):
+    JST = timezone(timedelta(hours=9))
+    append_device_journal({"op": "put", "id": str(row["ID"]), "at": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"), "row": row})
+
+def delete_device(did):
+    JST = timezone(timedelta(hours=9))
+    append_device_journal({"op": "delete", "id": str(did), "at": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")})
+
+@st.cache_resource
+def device_db_cache():
+    # スナップショットが変わらない間は、前回読んだ位置以降のジャーナルだけを反映する
+    return {"lock": threading.Lock(), "snap_key": None, "rows": None, "columns": None, "offset": 0}
+
+def device_snapshot_key():
+    try:
+        st_ = os.stat(DB_CSV)
+        return (st_.st_mtime_ns, st_.st_size, st_.st_ino)
+    except FileNotFoundError:
+        return None
+
+def load_devices():
+    cache = device_db_cache()
+    with cache["lock"]:
+        for _ in range(5):
+            key = device_snapshot_key()
+            if cache["rows"] is None or key != cache["snap_key"]:
+                rows, columns, offset = {}, list(DB_COLUMNS), 0
+                if key is not None:
+                    df = pd.read_csv(DB_CSV)
+                    columns += [c for c in df.columns if c not in columns]
+                    for r in df.to_dict("records"): rows[str(r.get("ID"))] = r
+            else:
+                rows, columns, offset = cache["rows"], cache["columns"], cache["offset"]
+                if DB_JOURNAL.exists() and DB_JOURNAL.stat().st_size < offset:
+                    cache["rows"] = None; continue
+            records, offset = read_device_journal(DB_JOURNAL, offset)
+            # 読んでいる間にまとめ処理が走った場合は最初から読み直す
+            if device_snapshot_key() != key:
+                cache["rows"] = None; continue
+            for rec in records:
+                rows.pop(rec.get("id"), None)
+                if rec.get("op") == "put":
+                    rows[rec["id"]] = rec["row"]
+                    columns += [c for c in rec["row"] if c not in columns]
+            cache.update(snap_key=key, rows=rows, columns=columns, offset=offset)
+            break
+        return pd.DataFrame(list(rows.values()), columns=columns)
+
+def write_devices_snapshot_locked(src):
+    # src は DataFrame かスナップショットとして置くファイル。ジャーナルは履歴へ移して空にする
+    tmp = DB_CSV.with_name(DB_CSV.name + ".tmp")
+    if isinstance(src, (str, Path)):
+        os.replace(src, tmp)
+    else:
+        src.to_csv(tmp, index=False)
+    with open(tmp, "rb+") as f: os.fsync(f.fileno())
+    os.replace(tmp, DB_CSV)
+    if DB_JOURNAL.exists():
+        with open(DB_JOURNAL, "rb") as src_f, open(DB_HISTORY, "ab") as dst:
+            shutil.copyfileobj(src_f, dst)
+            dst.flush(); os.fsync(dst.fileno())
+        with open(DB_JOURNAL, "wb"): pass
+
+def compact_devices_locked():
+    with span("DBスナップショット更新"):
+        write_devices_snapshot_locked(load_devices())
+
+def compact_devices():
+    with device_db_lock():
+        compact_devices_locked()
+
+def install_devices_snapshot(path):
+    # バックアップ復元用：ファイルを丸ごと新しいスナップショットにする
+    with device_db_lock():
+        write_devices_snapshot_locked(path)
+
+def device_history(did):
+    did = str(did)
+    history = []
+    seen = set()
+    for path in (DB_HISTORY, DB_JOURNAL):
+        for rec in read_device_journal(path)[0]:
+            k = (rec.get("at"), rec.get("op"), json.dumps(rec.get("row"), ensure_ascii=False, sort_keys=True, default=str))
+            if rec.get("id") == did and k not in seen:
+                seen.add(k); history.append(rec)
+    return history
+
 # ==========================================
 # --- マスター台帳Excelの自動生成・保存 ---
 # ==========================================
 def create_formatted_ledger_excel(df_csv):
-    import re 
+    with span("台帳Excel生成") as sp:
+        data = create_formatted_ledger_excel_raw(df_csv)
+        sp["bytes"] = len(data)
+    return data
+
+def create_formatted_ledger_excel_raw(df_csv):
+    import re
+    from openpyxl.styles import PatternFill, Border, Side, Alignment, Font
     
     df_export = df_csv.rename(columns={
         "ID": "管理番号", "Name": "機器名称", "Power": "使用電源",
@@ -462,64 +1959,1219 @@ def create_formatted_ledger_excel(df_csv):
                     
     return output.getvalue()
 
-def update_master_ledger_excel(df_csv, mode, repo, token, local_path):
-    try:
-        excel_data = create_formatted_ledger_excel(df_csv)
-        file_name = "機器台帳マスター.xlsx"
-        
+# ==========================================
+# --- マスター台帳の公開（まとめて・間隔を空けて） ---
+# ==========================================
+# 保存のたびに台帳Excelを作り直してアップロードするのではなく、公開要求を保存先ごとに
+# まとめ、前回の公開から LEDGER_PUBLISH_WINDOW 秒以上空けて1回だけ公開する。
+# 台帳に載る列の内容が前回公開時と同じなら Excel の生成もアップロードも行わない。
+# GitHub の sha は前回の PUT 応答から引き継ぎ、公開ごとの変更機器は ledger_changes.jsonl に追記する。
+LEDGER_FILE_NAME = "機器台帳マスター.xlsx"
+LEDGER_COLUMNS = ["ID", "Name", "Power", "URL", "Updated", "memo"]
+LEDGER_PUBLISH_WINDOW = float(os.environ.get("QR_LEDGER_PUBLISH_WINDOW", "60"))
+LEDGER_DEBOUNCE = 5
+LEDGER_STATE_FILE = Path("ledger_publish_state.json")
+LEDGER_CHANGE_LOG = Path("ledger_changes.jsonl")
+
+def ledger_dest_key(mode, repo, local_path):
+    if mode == "2. 全自動（データベース保存）": return f"github:{repo}"
+    return f"local:{Path(local_path).resolve()}"
+
+def ledger_row_hashes(df):
+    cols = [c for c in LEDGER_COLUMNS if c in df.columns]
+    return {
+        str(rec.get("ID")): hashlib.sha1(json.dumps(rec, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        for rec in df[cols].to_dict("records")
+    }
+
+def load_ledger_state():
+    if LEDGER_STATE_FILE.exists():
+        try:
+            with open(LEDGER_STATE_FILE, "r", encoding="utf-8") as f: return json.load(f)
+        except Exception: pass
+    return {}
+
+def save_ledger_state(state):
+    tmp = LEDGER_STATE_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, LEDGER_STATE_FILE)
+
+def put_ledger_to_github(repo, token, excel_data, sha, message):
+    return github_put_file(repo, token, f"ledger/{LEDGER_FILE_NAME}", excel_data, message, sha, span_name="台帳アップロード")["sha"]
+
+def publish_ledger_now(mode, repo, token, local_path, df=None):
+    # 同じ公開先への公開は1つずつ行う。公開状態ファイルは公開先をまたいで共有するため、読み書きは state_lock の下で行う
+    pub = ledger_publisher()
+    dest = ledger_dest_key(mode, repo, local_path)
+    with pub["lock"]: dest_lock = pub["dest_locks"].setdefault(dest, threading.Lock())
+    with dest_lock:
+        return publish_ledger_locked(pub, dest, mode, repo, token, local_path, df)
+
+def publish_ledger_locked(pub, dest, mode, repo, token, local_path, df):
+    if df is None: df = load_devices()
+    with pub["state_lock"]: prev = load_ledger_state().get(dest, {})
+    rows = ledger_row_hashes(df)
+    content_hash = hashlib.sha256(json.dumps(sorted(rows.items())).encode("utf-8")).hexdigest()[:24]
+    prev_rows = prev.get("rows", {})
+    change = {
+        "added": sorted(k for k in rows if k not in prev_rows),
+        "changed": sorted(k for k in rows if k in prev_rows and rows[k] != prev_rows[k]),
+        "removed": sorted(k for k in prev_rows if k not in rows),
+    }
+    JST = timezone(timedelta(hours=9))
+    log = {"at": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"), "dest": dest, "content_hash": content_hash, **change}
+
+    if content_hash == prev.get("content_hash"):
+        log["skipped"] = True
+    else:
+        excel_data = create_formatted_ledger_excel(df)
+        sha = prev.get("sha")
         if mode == "2. 全自動（データベース保存）":
-            encoded = base64.b64encode(excel_data).decode("utf-8")
-            api_url = f"https://api.github.com/repos/{repo}/contents/ledger/{urllib.parse.quote(file_name)}"
-            
-            sha = None
-            try:
-                req_check = urllib.request.Request(api_url)
-                req_check.add_header("Authorization", f"token {token}")
-                with urllib.request.urlopen(req_check) as res:
-                    sha = json.loads(res.read().decode("utf-8"))["sha"]
-            except: pass
-            
-            payload = {"message": "Update Master Ledger", "content": encoded, "branch": "main"}
-            if sha: payload["sha"] = sha
-            
-            req = urllib.request.Request(api_url, data=json.dumps(payload).encode("utf-8"), method="PUT")
-            req.add_header("Authorization", f"token {token}")
-            req.add_header("Content-Type", "application/json")
-            urllib.request.urlopen(req)
-            
+            ids = change["added"] + change["changed"] + change["removed"]
+            message = "Update Master Ledger" + (f" ({', '.join(ids[:10])}{' ...' if len(ids) > 10 else ''})" if ids else "")
+            sha = put_ledger_to_github(repo, token, excel_data, sha, message)
         elif mode == "3. 社内共有フォルダへ自動保存":
             target_dir = Path(local_path)
             target_dir.mkdir(parents=True, exist_ok=True)
-            out_path = target_dir / file_name
-            with open(out_path, "wb") as f:
-                f.write(excel_data)
+            tmp = target_dir / (LEDGER_FILE_NAME + ".tmp")
+            with open(tmp, "wb") as f: f.write(excel_data)
+            os.replace(tmp, target_dir / LEDGER_FILE_NAME)
+        with pub["state_lock"]:
+            # 他の公開先の記録を消さないよう、書き込む直前に読み直して自分の分だけ置き換える
+            state = load_ledger_state()
+            state[dest] = {"content_hash": content_hash, "sha": sha, "rows": rows, "published_at": log["at"]}
+            save_ledger_state(state)
+        log["bytes"] = len(excel_data)
+
+    with pub["state_lock"], open(LEDGER_CHANGE_LOG, "a", encoding="utf-8") as f:
+        f.write(json.dumps(log, ensure_ascii=False) + "\n")
+    return not log.get("skipped")
+
+@st.cache_resource
+def ledger_publisher():
+    pub = {"lock": threading.Lock(), "pending": {}, "timers": {}, "last": {}, "errors": {}, "dest_locks": {}, "state_lock": threading.Lock()}
+    # プロセス終了時に公開待ちが残っていれば、その場で公開する
+    atexit.register(flush_all_ledger_publishes, pub)
+    return pub
+
+def request_ledger_publish(mode, repo, token, local_path, changed_ids=()):
+    if mode not in ("2. 全自動（データベース保存）", "3. 社内共有フォルダへ自動保存"): return
+    pub = ledger_publisher()
+    dest = ledger_dest_key(mode, repo, local_path)
+    with pub["lock"]:
+        p = pub["pending"].setdefault(dest, {"ids": set(), "since": time.time()})
+        p.update(mode=mode, repo=repo, token=token, local_path=local_path)
+        p["ids"].update(str(i) for i in changed_ids)
+        if dest in pub["timers"]: return
+        delay = max(LEDGER_DEBOUNCE, pub["last"].get(dest, 0) + LEDGER_PUBLISH_WINDOW - time.time())
+        # 公開のタイマーも画面のコンテキストを持たないため、共有のリソースは呼び出し側で用意しておく
+        metrics_store(); device_db_cache()
+        t = threading.Timer(delay, flush_ledger_publish, args=(pub, dest))
+        t.daemon = True
+        p["due"] = time.time() + delay
+        pub["timers"][dest] = t
+        t.start()
+
+def flush_ledger_publish(pub, dest):
+    with pub["lock"]:
+        # 取り消された後に動き出したタイマー（flush_all_ledger_publishes と重なった場合）は何もしない
+        if pub["timers"].get(dest) is not threading.current_thread(): return
+        del pub["timers"][dest]
+        p = pub["pending"].pop(dest, None)
+        pub["last"][dest] = time.time()
+    if not p: return
+    try:
+        with metrics_run("台帳公開"):
+            publish_ledger_now(p["mode"], p["repo"], p["token"], p["local_path"])
+        pub["errors"].pop(dest, None)
     except Exception as e:
+        # 失敗した分は次の公開枠で再試行する
         print(f"Excelマスター台帳の保存エラー: {e}")
+        pub["errors"][dest] = str(e)
+        request_ledger_publish(p["mode"], p["repo"], p["token"], p["local_path"], p["ids"])
+
+def flush_all_ledger_publishes(pub):
+    # 公開待ちとタイマーを一緒に取り出すので、この後の公開依頼は新しいタイマーで公開される
+    with pub["lock"]:
+        pending, pub["pending"] = pub["pending"], {}
+        for t in pub["timers"].values(): t.cancel()
+        pub["timers"].clear()
+        now = time.time()
+        for dest in pending: pub["last"][dest] = now
+    for dest, p in pending.items():
+        try:
+            with metrics_run("台帳公開"):
+                publish_ledger_now(p["mode"], p["repo"], p["token"], p["local_path"])
+            pub["errors"].pop(dest, None)
+        except Exception as e:
+            print(f"Excelマスター台帳の保存エラー: {e}")
+            pub["errors"][dest] = str(e)
+
+def ledger_publish_status():
+    pub = ledger_publisher()
+    with pub["lock"]:
+        return [{"dest": d, "devices": len(p["ids"]), "due_in": max(0, p.get("due", 0) - time.time())} for d, p in pub["pending"].items()], dict(pub["errors"])
+
+# ==========================================
+# --- 静的ポータル（Streamlit・GitHub Pages の無い現場向け） ---
+# ==========================================
+# devices.csv と manuals/ から、検索付きの機器一覧（index.html）・機器ごとのページ（d/）・
+# 機器情報ページ画像（manuals/）・サムネイル（thumbs/）を PORTAL_DIR に書き出す。
+# 既定の出力先は manuals/portal なので、社内Wi-Fi用サーバーでは http://<IP>:8000/portal/ で開ける。
+# 中身は静的ファイルだけなので、フォルダごと別のファイルサーバーに置いても動く。
+# 機器ごとの指紋を .portal_state.json に記録し、変わった機器のページ・サムネイルだけを書き直す。
+PORTAL_DIR = MANUAL_DIR / "portal"
+PORTAL_STATE_NAME = ".portal_state.json"
+PORTAL_VERSION = 1
+PORTAL_THUMB_SIZE = 320
+PORTAL_THUMB_SOURCES = ("img_exterior", "img_outlet", "img_label")
+
+PORTAL_CSS = """body { margin: 0; font-family: "Meiryo", "Hiragino Kaku Gothic ProN", "Noto Sans JP", sans-serif; color: #111; background: #fff; }
+header { background: #ffd700; padding: 10px 16px; }
+header h1 { margin: 0; font-size: 22px; }
+main { margin: 16px; }
+a { color: #0b57d0; }
+#q { width: 100%; box-sizing: border-box; font-size: 18px; padding: 10px; margin-bottom: 8px; border: 2px solid #999; border-radius: 5px; }
+ul.devices { list-style: none; padding: 0; margin: 0; }
+ul.devices li a { display: flex; align-items: center; gap: 12px; padding: 8px 0; border-bottom: 1px solid #ddd; text-decoration: none; color: #111; }
+ul.devices img, ul.devices .noimg { width: 96px; height: 72px; object-fit: cover; flex-shrink: 0; background: #eee; border: 1px solid #ccc; }
+.did { font-weight: bold; color: #8a6d00; }
+.power { display: inline-block; margin: 8px 0; padding: 6px 10px; background: #f29b21; color: #fff; }
+.memo { border: 4px solid #f29b21; padding: 12px 16px; white-space: pre-wrap; word-break: break-all; }
+.manual { display: block; width: 100%; max-width: 1000px; height: auto; border: 2px solid #999; box-sizing: border-box; }
+footer { margin: 16px; font-size: 13px; color: #666; }
+"""
+
+PORTAL_INDEX_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>機器情報ポータル</title>
+<link rel="stylesheet" href="portal.css">
+</head>
+<body>
+<header><h1>機器情報ポータル（{count} 台）</h1></header>
+<main>
+<input id="q" type="search" placeholder="管理番号・機器名称・メモで検索" autofocus>
+<p id="hits"></p>
+<ul class="devices" id="list">
+{items}
+</ul>
+</main>
+<footer>更新: {updated}</footer>
+<script>
+var q = document.getElementById("q"), items = document.querySelectorAll("#list li"), hits = document.getElementById("hits");
+function filter() {{
+  var words = q.value.toLowerCase().split(/\\s+/).filter(Boolean), n = 0;
+  for (var i = 0; i < items.length; i++) {{
+    var t = items[i].getAttribute("data-s"), ok = words.every(function (w) {{ return t.indexOf(w) >= 0; }});
+    items[i].style.display = ok ? "" : "none"; if (ok) n++;
+  }}
+  hits.textContent = words.length ? n + " 件" : "";
+}}
+q.addEventListener("input", filter);
+if (location.hash.length > 1) {{ q.value = decodeURIComponent(location.hash.slice(1)); filter(); }}
+</script>
+</body>
+</html>
+"""
+
+PORTAL_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{did} {name}</title>
+<link rel="stylesheet" href="../portal.css">
+</head>
+<body>
+<header><h1><span class="did">{did}</span> {name}</h1></header>
+<main>
+<p><a href="../index.html">← 機器一覧へ</a></p>
+<div class="power">■ 使用電源: AC {power}</div>
+{manual}
+<h2>■ メモ・備考</h2>
+<div class="memo">{memo}</div>
+</main>
+<footer>更新: {updated}</footer>
+</body>
+</html>
+"""
+
+def portal_cell(row, key):
+    v = row.get(key)
+    if v is None or (isinstance(v, float) and v != v): return ""
+    return str(v)
+
+def portal_local_manual(url):
+    # 機器情報ページのURLが manuals/ 内のファイルを指していれば、その1枚画像のパスを返す
+    if not url: return None
+    name = urllib.parse.unquote(Path(urllib.parse.urlparse(url).path).name)
+    if not name: return None
+    path = MANUAL_DIR / Path(name).with_suffix(".jpg").name
+    return path if path.is_file() else None
+
+def portal_thumb_source(row, pending=None):
+    # サムネイルの元画像：派生画像 → 共有フォルダの画像 → 送信待ちの画像 の順に、手元にあるものだけ使う
+    # pending は outbox_pending_files() の結果（全機器の分をまとめて調べるときに渡す）
+    for key in PORTAL_THUMB_SOURCES:
+        ref = portal_cell(row, key)
+        if not ref: continue
+        der_key = derivative_key(ref)
+        if der_key and (DERIVATIVE_DIR / f"{der_key}.jpg").is_file(): return DERIVATIVE_DIR / f"{der_key}.jpg"
+        if not ref.startswith("http") and os.path.isfile(ref): return Path(ref)
+        local = outbox_local_file(ref, pending) if ref.startswith("http") else None
+        if local is not None: return local
+    return None
+
+def file_stamp(path):
+    if path is None: return None
+    try:
+        st_ = os.stat(path)
+        return f"{st_.st_size}:{st_.st_mtime_ns}"
+    except OSError:
+        return None
+
+def make_portal_thumb(src, dest):
+    with Image.open(src) as im:
+        if im.format == "JPEG": im.draft("RGB", (PORTAL_THUMB_SIZE, PORTAL_THUMB_SIZE))
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        im.thumbnail((PORTAL_THUMB_SIZE, PORTAL_THUMB_SIZE), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=80, optimize=True)
+    write_atomic(dest, buf.getvalue(), fsync=False)
+
+def link_or_copy(src, dest):
+    tmp = dest.with_name(dest.name + ".tmp")
+    try: tmp.unlink()
+    except FileNotFoundError: pass
+    try: os.link(src, tmp)
+    except OSError: shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def render_portal_page(row, manual_href, manual_is_image, updated):
+    import html
+    did, name = portal_cell(row, "ID"), portal_cell(row, "Name")
+    if manual_href and manual_is_image:
+        manual = f'<p><a href="{html.escape(manual_href)}"><img class="manual" src="{html.escape(manual_href)}" loading="lazy" alt="機器情報ページ"></a></p>'
+    elif manual_href:
+        manual = f'<p><a href="{html.escape(manual_href)}">機器情報ページを開く</a></p>'
+    else:
+        manual = "<p>機器情報ページは登録されていません。</p>"
+    return PORTAL_PAGE_TEMPLATE.format(
+        did=html.escape(did), name=html.escape(name), power=html.escape(portal_cell(row, "Power") or "未設定"),
+        manual=manual, memo=html.escape(portal_cell(row, "memo") or "なし"), updated=html.escape(updated),
+    )
+
+def render_portal_index(entries):
+    import html
+    items = []
+    for e in entries:
+        thumb = f'<img src="{html.escape(e["thumb"])}" loading="lazy" alt="">' if e["thumb"] else '<span class="noimg"></span>'
+        search = html.escape(" ".join([e["id"], e["name"], e["memo"]]).lower())
+        items.append(
+            f'<li data-s="{search}"><a href="{html.escape(e["page"])}">{thumb}'
+            f'<span><span class="did">{html.escape(e["id"])}</span> {html.escape(e["name"])}<br><small>{html.escape(e["power"])}　{html.escape(e["updated"])}</small></span></a></li>'
+        )
+    return PORTAL_INDEX_TEMPLATE.format(count=len(entries), items="\n".join(items), updated=datetime.now().strftime("%Y-%m-%d %H:%M"))
+
+@st.cache_resource
+def portal_refresher():
+    # 画面の「更新」ボタンと、登録・削除のたびの裏での更新が同じ出力先へ同時に書かないようにする
+    ref = {"lock": threading.Lock(), "build": threading.Lock(), "ids": set(), "all": False, "thread": None}
+    # プロセス終了時に裏での更新が残っていれば、終わるまで待つ
+    atexit.register(wait_portal_refresh, ref, 60)
+    return ref
+
+def build_portal(out_dir=PORTAL_DIR, devices=None, force=False, workers=None, changed_ids=None):
+    with portal_refresher()["build"]:
+        return build_portal_locked(out_dir, devices, force, workers, changed_ids)
+
+def build_portal_locked(out_dir, devices, force, workers, changed_ids):
+    # 変わった機器だけを書き直し、一覧は毎回作り直す（数千台でも文字列の組み立てだけ）。
+    # changed_ids を渡したときはその機器だけ指紋を計算し直し、他の機器は .portal_state.json の記録を使う
+    t0 = time.perf_counter()
+    out_dir = Path(out_dir)
+    for sub in ("d", "thumbs", "manuals"): (out_dir / sub).mkdir(parents=True, exist_ok=True)
+    state_path = out_dir / PORTAL_STATE_NAME
+    state = {}
+    if state_path.exists() and not force:
+        try:
+            with open(state_path, "r", encoding="utf-8") as f: state = json.load(f)
+        except (OSError, ValueError): state = {}
+    if state.get("version") != PORTAL_VERSION: state = {"version": PORTAL_VERSION, "devices": {}}
+    old = state["devices"]
+    df = load_devices() if devices is None else devices
+    rows = df.to_dict("records") if len(df) else []
+
+    with span("ポータル: 指紋計算"):
+        plans = {}
+        changed = None if changed_ids is None or force else {str(i) for i in changed_ids}
+        pending = None
+        for row in rows:
+            did = portal_cell(row, "ID")
+            if not did: continue
+            sid = safe_filename(did) or hashlib.sha1(did.encode("utf-8")).hexdigest()[:12]
+            if changed is not None and did not in changed and did in old:
+                plans[did] = {"sid": sid, "row": row, "thumb": old[did].get("thumb"), "reuse": old[did]}
+                continue
+            if pending is None: pending = outbox_pending_files()
+            manual = portal_local_manual(portal_cell(row, "URL"))
+            thumb_src = portal_thumb_source(row, pending)
+            thumb_fp = f"{thumb_src}:{file_stamp(thumb_src)}" if thumb_src else None
+            thumb = f"thumbs/{sid}_{hashlib.sha1(thumb_fp.encode('utf-8')).hexdigest()[:10]}.jpg" if thumb_fp else None
+            page_fp = hashlib.sha1(json.dumps(
+                [PORTAL_VERSION, {k: portal_cell(row, k) for k in sorted(row)}, str(manual), file_stamp(manual), thumb],
+                ensure_ascii=False).encode("utf-8")).hexdigest()
+            plans[did] = {"sid": sid, "row": row, "manual": manual, "thumb_src": thumb_src, "thumb": thumb, "fp": page_fp}
+
+    stats = {"devices": len(plans), "pages": 0, "thumbs": 0, "manuals": 0, "removed": 0}
+    new_state = {}
+
+    def thumb_job(plan):
+        dest = out_dir / plan["thumb"]
+        if dest.exists() and not force: return False  # 同じ元画像のサムネイルは別の機器と共有できる
+        make_portal_thumb(plan["thumb_src"], dest)
+        return True
+
+    with span("ポータル: サムネイル"):
+        jobs = [p for did, p in plans.items() if "reuse" not in p and p["thumb"] and (force or old.get(did, {}).get("thumb") != p["thumb"] or not (out_dir / p["thumb"]).exists())]
+        if jobs:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 2))) as pool:
+                for p, res in zip(jobs, pool.map(lambda p: safe_call(thumb_job, p), jobs)):
+                    if res is None: p["thumb"] = None
+                    elif res: stats["thumbs"] += 1
+
+    with span("ポータル: 機器ページ"):
+        updated = datetime.now().strftime("%Y-%m-%d %H:%M")
+        for did, p in plans.items():
+            if "reuse" in p:
+                new_state[did] = p["reuse"]
+                continue
+            prev = old.get(did, {})
+            page_rel = f"d/{p['sid']}.html"
+            manual_rel = f"manuals/{p['manual'].name}" if p["manual"] else None
+            if manual_rel and (force or prev.get("manual_stamp") != file_stamp(p["manual"]) or not (out_dir / manual_rel).exists()):
+                link_or_copy(p["manual"], out_dir / manual_rel)
+                stats["manuals"] += 1
+            if force or prev.get("fp") != p["fp"] or not (out_dir / page_rel).exists():
+                url = portal_cell(p["row"], "URL")
+                href = f"../{urllib.parse.quote(manual_rel)}" if manual_rel else url
+                is_image = bool(manual_rel) or Path(urllib.parse.urlparse(url).path).suffix.lower() in (".jpg", ".jpeg", ".png", ".webp")
+                write_atomic(out_dir / page_rel, render_portal_page(p["row"], href, is_image, portal_cell(p["row"], "Updated") or updated).encode("utf-8"), fsync=False)
+                stats["pages"] += 1
+            new_state[did] = {"fp": p["fp"], "page": page_rel, "thumb": p["thumb"], "manual": manual_rel, "manual_stamp": file_stamp(p["manual"])}
+
+    with span("ポータル: 不要ファイル削除"):
+        live = {v for rec in new_state.values() for v in (rec["page"], rec["thumb"], rec["manual"]) if v}
+        stale = {v for rec in old.values() for v in (rec.get("page"), rec.get("thumb"), rec.get("manual")) if v} - live
+        for rel in stale:
+            try: (out_dir / rel).unlink(); stats["removed"] += 1
+            except FileNotFoundError: pass
+
+    with span("ポータル: 一覧"):
+        entries = [{
+            "id": portal_cell(p["row"], "ID"), "name": portal_cell(p["row"], "Name"), "memo": portal_cell(p["row"], "memo"),
+            "power": portal_cell(p["row"], "Power"), "updated": portal_cell(p["row"], "Updated"),
+            "page": new_state[did]["page"], "thumb": p["thumb"],
+        } for did, p in sorted(plans.items(), key=lambda kv: kv[0])]
+        css = out_dir / "portal.css"
+        if not css.exists() or css.read_text(encoding="utf-8") != PORTAL_CSS:
+            write_atomic(css, PORTAL_CSS.encode("utf-8"), fsync=False)
+        write_atomic(out_dir / "index.html", render_portal_index(entries).encode("utf-8"), fsync=False)
+        write_atomic(state_path, json.dumps({"version": PORTAL_VERSION, "devices": new_state}, ensure_ascii=False).encode("utf-8"), fsync=False)
+
+    stats["sec"] = round(time.perf_counter() - t0, 3)
+    return stats
+
+def safe_call(func, *args):
+    # サムネイルが作れない機器（壊れた画像など）はサムネイル無しで続ける
+    try: return func(*args)
+    except Exception as e:
+        print(f"ポータルのサムネイル作成エラー: {e}")
+        return None
+
+def update_portal_if_enabled(changed_ids=None):
+    # 一度でもポータルを作成していれば、登録・削除のたびに変わった機器の分だけ裏で更新する（保存は待たせない）。
+    # 更新中に来た依頼はまとめて、終わった後にもう1回だけ更新する
+    if not (PORTAL_DIR / "index.html").exists(): return False
+    # 更新のスレッドは画面のコンテキストを持たないため、共有のリソースはこの（呼び出し元の）スレッドで用意しておく
+    ref = portal_refresher(); metrics_store(); device_db_cache()
+    with ref["lock"]:
+        if changed_ids is None: ref["all"] = True
+        else: ref["ids"].update(str(i) for i in changed_ids)
+        t = ref["thread"]
+        if t is not None and t.is_alive(): return True
+        t = ref["thread"] = threading.Thread(target=portal_refresh_loop, args=(ref,), daemon=True, name="portal-refresh")
+    t.start()
+    return True
+
+def portal_refresh_loop(ref):
+    while True:
+        with ref["lock"]:
+            ids, refresh_all = ref["ids"], ref["all"]
+            if not ids and not refresh_all:
+                ref["thread"] = None
+                return
+            ref["ids"], ref["all"] = set(), False
+        try:
+            with metrics_run("静的ポータル更新"): build_portal(changed_ids=None if refresh_all else ids)
+        except Exception as e:
+            print(f"静的ポータルの更新エラー: {e}")
+
+def wait_portal_refresh(ref=None, timeout=None):
+    # 裏での更新が終わるまで待つ（プロセス終了時・負荷試験用）
+    t = (ref or portal_refresher())["thread"]
+    if t is not None: t.join(timeout)
+
+# ==========================================
+# --- 登録処理の段階実行（依存関係グラフ） ---
+# ==========================================
+# 全自動の登録を「必要な入力・作る出力」を宣言した段階に分け、入力の揃った段階から並列に実行する。
+# 画像の保存・機器情報ページの描画・QRコードとラベルの作成は互いを待たない（QRコードに載せるURLは公開前に決まる）。
+# どこかの段階が失敗したら新しい段階は始めず、失敗した段階名と実行されなかった段階を StageError で返す。
+# 計測中なら、全体の所要時間を決めた段階の連なり（クリティカルパス）を実行の記録に残す。
+STAGE_WORKERS = 6
+REGISTER_IMG_FIELDS = {"ext": "img_exterior", "out": "img_outlet", "lab": "img_label", "lo1": "img_loto1", "lo2": "img_loto2"}
+
+class StageError(Exception):
+    def __init__(self, stage, cause, skipped=()):
+        super().__init__(f"「{stage}」で失敗しました: {cause}")
+        self.stage = stage
+        self.cause = cause
+        self.skipped = list(skipped)
+
+def stage(name, func, needs=(), gives=()):
+    # func は needs の値をキーワード引数で受け取り、gives の値を dict で返す
+    return {"name": name, "func": func, "needs": tuple(needs), "gives": tuple(gives)}
+
+def stage_context():
+    # 段階のスレッドには計測とアップロードメモの変数だけを引き継ぐ（画面のコンテキストは持ち込まない）
+    ctx = contextvars.Context()
+    for var in (current_metrics_run, current_metrics_span, current_upload_memo):
+        ctx.run(var.set, var.get())
+    return ctx
+
+def stage_thread_initializer():
+    # 段階のスレッドは画面のスレッドが待っている間だけ動くため、画面の ScriptRunContext を付けて
+    # st の呼び出し（キャッシュの作成時のスピナー等）が画面のスレッドと同じように動くようにする
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None: return None  # 負荷試験などの画面の無い実行
+    return lambda: add_script_run_ctx(threading.current_thread(), ctx)
+
+def stage_dependencies(stages, values):
+    producer = {}
+    for s in stages:
+        for key in s["gives"]:
+            if key in producer or key in values: raise ValueError(f"段階の出力が重複しています: {key}")
+            producer[key] = s["name"]
+    deps = {}
+    for s in stages:
+        if s["name"] in deps: raise ValueError(f"段階名が重複しています: {s['name']}")
+        missing = [k for k in s["needs"] if k not in producer and k not in values]
+        if missing: raise ValueError(f"「{s['name']}」の入力がありません: {', '.join(missing)}")
+        deps[s["name"]] = {producer[k] for k in s["needs"] if k in producer}
+    # 入力の揃った段階から順に取り除き、残ったら循環している
+    left = {n: set(d) for n, d in deps.items()}
+    while left:
+        ready = [n for n, d in left.items() if not d]
+        if not ready: raise ValueError(f"段階の依存関係が循環しています: {', '.join(left)}")
+        for n in ready: del left[n]
+        for d in left.values(): d.difference_update(ready)
+    return deps
+
+def stage_critical_path(deps, times, graph_start):
+    # 最後に終わった段階から、入力元のうち最後に終わった段階をたどる（wait_ms は入力が揃ってから始まるまでの待ち）
+    name = max(times, key=lambda n: times[n][1])
+    path = []
+    while name:
+        start, end = times[name]
+        prev = max((d for d in deps[name] if d in times), key=lambda d: times[d][1], default=None)
+        ready_at = times[prev][1] if prev else graph_start
+        path.append({"stage": name, "dur_ms": round(end - start, 1), "wait_ms": round(start - ready_at, 1)})
+        name = prev
+    return path[::-1]
+
+def run_stage_graph(stages, values=None, max_workers=STAGE_WORKERS):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    values = dict(values or {})
+    deps = stage_dependencies(stages, values)
+    by_name = {s["name"]: s for s in stages}
+    waiting = {n: set(d) for n, d in deps.items()}
+    run = current_metrics_run.get()
+    t0 = run.t0 if run is not None else time.perf_counter()
+    to_ms = lambda t: (t - t0) * 1000
+    graph_start = to_ms(time.perf_counter())
+    times, recs, failed = {}, {}, None
+
+    def call(s):
+        with span(f"段階:{s['name']}") as rec:
+            start = time.perf_counter()
+            out = s["func"](**{k: values[k] for k in s["needs"]}) or {}
+            missing = [k for k in s["gives"] if k not in out]
+            if missing: raise ValueError(f"出力がありません: {', '.join(missing)}")
+        return out, rec, (to_ms(start), to_ms(time.perf_counter()))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage", initializer=stage_thread_initializer()) as pool:
+        futures = {}
+
+        def submit_ready():
+            for name in [n for n, d in waiting.items() if not d]:
+                del waiting[name]
+                futures[pool.submit(stage_context().run, call, by_name[name])] = name
+
+        submit_ready()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = futures.pop(fut)
+                try:
+                    out, recs[name], times[name] = fut.result()
+                except Exception as e:
+                    if failed is None: failed = (name, e)
+                    continue
+                values.update((k, out[k]) for k in by_name[name]["gives"])
+                for d in waiting.values(): d.discard(name)
+            # 失敗した後は実行中の段階の終了だけを待ち、新しい段階は始めない
+            if failed is None: submit_ready()
+
+    if times and run is not None:
+        path = stage_critical_path(deps, times, graph_start)
+        for c in path: recs[c["stage"]]["critical"] = True
+        with run.lock: run.critical_path = path
+    if failed is not None:
+        name, e = failed
+        raise StageError(name, e, [n for n in deps if n not in times and n != name]) from e
+    return values
+
+def register_device_auto(req):
+    # 全自動の登録・ラベル発行（画面と負荷試験で共通）。req のキー:
+    #   did/name/power/memo/is_related_loto、slots（枠ごとの (アップロード, 削除, 既存の参照)）、extras（追加画像）、
+    #   mode/repo/token/local_path、profile/budget_kb/with_viewer、use_permalink、print_label
+    did, mode, repo, token, local_path = req["did"], req["mode"], req["repo"], req["token"], req["local_path"]
+    with_viewer = req["with_viewer"]
+    s_id = safe_filename(did)
+    JST = timezone(timedelta(hours=9))
+    prev_pub = load_publish_state().get(str(did), {})
+    known_refs = prev_pub.get("images", {})
+    # セッションの外（負荷試験など）でも、1回の登録の中ではデコード・圧縮を共有する
+    memo_token = current_upload_memo.set(upload_memo() or {"files": {}, "blobs": collections.OrderedDict()})
+    try:
+        values, uploads, shas, extra_keys = {}, {}, {}, []
+
+        def plan_image(key, f_obj, fallback):
+            # 前回と同じ内容の画像は前回の参照先を使い、それ以外だけを保存の段階にする
+            if not f_obj:
+                values[key] = fallback
+                return
+            sha = upload_blob(f_obj)["sha"] if hasattr(f_obj, "getvalue") else None
+            if sha: shas[key] = sha
+            if sha and stored_ref_alive(known_refs.get(sha)): values[key] = known_refs[sha]
+            else: uploads[key] = f_obj
+
+        # 機器情報ページは保存の完了を待たず、手元のアップロードから描画する
+        render_data = {"id": did, "name": req["name"], "power": req["power"], "memo": req["memo"], "is_related_loto": req["is_related_loto"]}
+        for slot, field in REGISTER_IMG_FIELDS.items():
+            f_obj, d_flag, e_path = req["slots"][slot]
+            if d_flag: f_obj, e_path = None, ""
+            plan_image(f"ref_{slot}", f_obj, e_path)
+            render_data[field] = f_obj or e_path or None
+        render_extras = []
+        for item in req["extras"]:
+            if item["file"]:
+                suffix = f"ex_{item['index']}" if item["type"] == "existing" else f"ex_new_{item['index']}"
+                plan_image(f"ref_{suffix}", item["file"], "")
+                extra_keys.append((f"ref_{suffix}", item["title"], False))
+                render_extras.append((item["file"], item["title"]))
+            elif item["type"] == "existing":
+                values[f"ref_ex_{item['index']}"] = item["url"]
+                extra_keys.append((f"ref_ex_{item['index']}", item["title"], True))
+                render_extras.append((item["url"], item["title"]))
+        ref_keys = [f"ref_{slot}" for slot in REGISTER_IMG_FIELDS] + [k for k, _, _ in extra_keys]
+
+        def stored_inputs(refs):
+            data = dict(render_data, **{field: refs[f"ref_{slot}"] or None for slot, field in REGISTER_IMG_FIELDS.items()})
+            extras = [(refs[k], title) for k, title, keep_empty in extra_keys if keep_empty or refs[k]]
+            return data, extras
+
+        # 社内配信のURLはサーバーのアドレスを含むため、アドレスが変わったら公開し直す
+        server_base = get_manual_server_base_url() if mode == "3. 社内共有フォルダへ自動保存" else ""
+        fingerprint_of = lambda data, extras: hash_manual_inputs(data, extras, req["profile"], req["budget_kb"], with_viewer, mode, repo, local_path, server_base)
+        prev_manual = prev_pub.get("manual_file")
+        reused = bool(
+            not uploads and prev_pub.get("fingerprint") == fingerprint_of(*stored_inputs(values)) and prev_pub.get("manual_url")
+            and (mode != "3. 社内共有フォルダへ自動保存" or (prev_manual and (MANUAL_DIR / prev_manual).exists()))
+        )
+
+        def upload_stage(key, f_obj):
+            suffix = key[len("ref_"):]
+            return stage(f"画像保存:{suffix}", lambda: {key: save_image_to_storage(f_obj, did, suffix, mode, repo, token, local_path)}, gives=[key])
+
+        stages = [upload_stage(key, f_obj) for key, f_obj in uploads.items()]
+        if reused:
+            values.update(manual_file=prev_manual, manual_url=prev_pub["manual_url"])
+            planned_url = prev_pub["manual_url"]
+        else:
+            manual_path = MANUAL_DIR / f"{s_id}_{datetime.now(JST).strftime('%H%M')}.jpg"
+            values["manual_file"] = manual_path.name
+            planned_url = manual_public_url(manual_path, mode, repo, with_viewer)
+            stages.append(stage("機器情報ページ作成", lambda: {"manual_files": create_manual_image_extended(
+                render_data, render_extras, manual_path, req["profile"], req["budget_kb"], with_viewer=with_viewer)}, gives=["manual_files"]))
+            stages.append(stage("公開", lambda manual_files: {"manual_url": publish_manual_files(
+                manual_path, manual_files, mode, repo, token, local_path, with_viewer, device=s_id)}, needs=["manual_files"], gives=["manual_url"]))
+
+        qr_path = QR_DIR / f"{s_id}_qr.png"
+        qr_url = permalink_url(did) if req["use_permalink"] else planned_url
+        qr_reused = prev_pub.get("qr_url") == qr_url and qr_path.exists()
+
+        def make_qr():
+            if qr_reused:
+                img_qr = Image.open(qr_path)
+                img_qr.load()
+            else:
+                img_qr = make_optimized_qr(qr_url, shorten=not req["use_permalink"])
+                img_qr.save(qr_path)
+            return {"img_qr": img_qr}
+
+        def make_label(img_qr):
+            label_img = create_label_image({"name": req["name"], "power": req["power"], "img_qr": img_qr})
+            buf = io.BytesIO()
+            label_img.save(buf, format="PNG")
+            return {"label_png": buf.getvalue()}
+
+        def add_history(label_png):
+            add_label_to_history(req["name"], label_png)
+
+        def write_db(manual_url, **refs):
+            _, extras = stored_inputs(refs)
+            new_row = {
+                "ID": did, "Name": req["name"], "Power": req["power"], "URL": manual_url, "Updated": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"),
+                "memo": req["memo"], "is_related_loto": req["is_related_loto"], **{field: refs[f"ref_{slot}"] for slot, field in REGISTER_IMG_FIELDS.items()},
+                "extra_images": json.dumps([{"title": t, "url": u} for u, t in extras], ensure_ascii=False)
+            }
+            changed = not device_row_unchanged(did, new_row)
+            if changed: put_device(new_row)
+            return {"db_changed": changed}
+
+        def schedule_ledger(db_changed):
+            if db_changed: request_ledger_publish(mode, repo, token, local_path, [did])
+
+        def record_publish_state(manual_url, manual_file, db_changed, **refs):
+            data, extras = stored_inputs(refs)
+            live_refs = {r for r in [data[f] for f in REGISTER_IMG_FIELDS.values()] + [u for u, _ in extras] if r}
+            all_refs = dict(known_refs, **{shas[k]: refs[k] for k in uploads if k in shas and refs[k]})
+            kept_refs = {k: v for k, v in all_refs.items() if v in live_refs}
+            update_publish_state(did, {
+                "fingerprint": fingerprint_of(data, extras), "manual_file": manual_file, "manual_url": manual_url, "qr_url": qr_url,
+                "images": dict(list(kept_refs.items())[-PUBLISH_KEEP_IMAGE_REFS:]), "at": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+        stages += [
+            stage("QRコード", make_qr, gives=["img_qr"]),
+            stage("ラベル作成", make_label, needs=["img_qr"], gives=["label_png"]),
+            stage("台帳書き込み", write_db, needs=["manual_url", *ref_keys], gives=["db_changed"]),
+            stage("台帳の公開予約", schedule_ledger, needs=["db_changed"]),
+            stage("公開状態の記録", record_publish_state, needs=["manual_url", "manual_file", "db_changed", *ref_keys]),
+            stage("ポータル更新", lambda db_changed: db_changed and update_portal_if_enabled([did]) and {}, needs=["db_changed"]),
+        ]
+        if req["print_label"]: stages.append(stage("ラベル履歴追加", add_history, needs=["label_png"]))
+
+        # 段階のスレッドから使う共有のリソースは、呼び出し元（画面）のスレッドで先に用意しておく
+        render_cache(); derivative_index(); metrics_store(); ledger_publisher(); portal_refresher(); label_store(); load_devices()
+        if mode == "2. 全自動（データベース保存）": outbox_worker()
+        values = run_stage_graph(stages, values)
+        return {"manual_url": values["manual_url"], "qr_url": qr_url, "label_png": values["label_png"], "reused": reused, "qr_reused": qr_reused}
+    finally:
+        current_upload_memo.reset(memo_token)
+
+# ==========================================
+# --- ワークスペース バックアップ（ZIP形式） ---
+# ==========================================
+BACKUP_FORMAT = "qr-manager-workspace"
+BACKUP_VERSION = 4
+BACKUP_IMG_SLOTS = ["ext", "out", "lab", "lo1", "lo2"]
+BACKUP_INDEX_FILE = Path("backup_index.json")
+BACKUP_CHUNK = 1024 * 1024
+
+def load_backup_index():
+    if BACKUP_INDEX_FILE.exists():
+        try:
+            with open(BACKUP_INDEX_FILE, "r", encoding="utf-8") as f: return json.load(f)
+        except: pass
+    return {"snapshots": {}, "last_full": None, "hash_cache": {}}
+
+def save_backup_index(index):
+    tmp = BACKUP_INDEX_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, BACKUP_INDEX_FILE)
+
+def file_sha256(path, hash_cache=None):
+    # (サイズ, 更新時刻) が変わっていないファイルは前回のハッシュを再利用する
+    st_ = os.stat(path)
+    key = str(Path(path).resolve())
+    stamp = [st_.st_size, st_.st_mtime_ns]
+    if hash_cache is not None and key in hash_cache and hash_cache[key][:2] == stamp:
+        return hash_cache[key][2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK), b""): h.update(chunk)
+    digest = h.hexdigest()
+    if hash_cache is not None: hash_cache[key] = stamp + [digest]
+    return digest
+
+def write_workspace_backup(out_file, form_values, form_imgs, form_ex_imgs, incremental=False):
+    # ファイル本体は blobs/<sha256> に格納し、差分バックアップでは前回のフルバックアップに無い blob だけを含める
+    # form_imgs: {スロット: (UploadedFile or None, 既存パス)} / form_ex_imgs: [{"file", "url", "title"}]
+    JST = timezone(timedelta(hours=9))
+    index = load_backup_index()
+    hash_cache = index.setdefault("hash_cache", {})
+    base_id = index.get("last_full") if incremental else None
+    if incremental and base_id not in index["snapshots"]:
+        raise ValueError("差分の基準となるフルバックアップがありません")
+    base_blobs = set(index["snapshots"][base_id]["blobs"]) if base_id else set()
+
+    files = {}    # 論理名 -> {"sha", "size"}
+    sources = {}  # sha -> パス or bytes
+
+    def add_path(name, path):
+        sha = file_sha256(path, hash_cache)
+        files[name] = {"sha": sha, "size": os.path.getsize(path)}
+        sources.setdefault(sha, path)
+
+    def add_bytes(name, data, sha=None):
+        sha = sha or hashlib.sha256(data).hexdigest()
+        files[name] = {"sha": sha, "size": len(data)}
+        sources.setdefault(sha, data)
+
+    def add_upload(name, f_obj):
+        blob = upload_blob(f_obj)
+        add_bytes(name, blob["raw"], blob["sha"])
+
+    def image_entry(f_obj, e_path, name):
+        if f_obj:
+            name += Path(getattr(f_obj, "name", "") or "").suffix.lower() or ".jpg"
+            add_upload(name, f_obj)
+            return {"type": "file", "data": name}
+        elif e_path:
+            return {"type": "path", "data": str(e_path)}
+        return None
+
+    form = dict(form_values)
+    form["existing_imgs"] = {slot: image_entry(*form_imgs.get(slot, (None, "")), f"form/{slot}") for slot in BACKUP_IMG_SLOTS}
+    form["existing_ex_imgs"] = [
+        {"title": item.get("title", ""), "img_data": image_entry(item.get("file"), item.get("url", ""), f"form/ex_{i}")}
+        for i, item in enumerate(form_ex_imgs)
+    ]
+
+    # ジャーナルをスナップショットへまとめてから devices.csv を格納する
+    compact_devices()
+    if DB_CSV.exists(): add_path("workspace/devices.csv", DB_CSV)
+    # ラベルはパックを1つの blob として格納し、索引は manifest に入れる（索引が指す範囲までを切り出す）
+    with label_store()["lock"]:
+        label_index = compact_label_pack(load_label_index())
+        label_entries = live_labels(label_index)
+        if label_entries:
+            with label_pack_view(label_index) as view:
+                add_bytes("workspace/labels.pack", bytes(view[:max(e["offset"] + e["length"] for e in label_entries)]))
+
+    snapshot_id = datetime.now(JST).strftime("%Y%m%d%H%M%S") + "-" + os.urandom(3).hex()
+    with zipfile.ZipFile(out_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for sha, src in sources.items():
+            if sha in base_blobs: continue
+            # 画像は圧縮済みのため無圧縮で格納する
+            ctype = zipfile.ZIP_DEFLATED if sha == files.get("workspace/devices.csv", {}).get("sha") else zipfile.ZIP_STORED
+            if isinstance(src, bytes): zf.writestr(f"blobs/{sha}", src, compress_type=ctype)
+            else: zf.write(src, f"blobs/{sha}", compress_type=ctype)
+
+        manifest = {
+            "format": BACKUP_FORMAT, "version": BACKUP_VERSION,
+            "snapshot": snapshot_id, "base": base_id,
+            "created": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"),
+            "form": form,
+            "files": files,
+            "workspace": {"label_index": label_entries}
+        }
+        zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    index["snapshots"][snapshot_id] = {"created": manifest["created"], "base": base_id, "blobs": sorted(sources)}
+    if not incremental: index["last_full"] = snapshot_id
+    # 差分の基準になり得るのは直近のフルバックアップのみ
+    keep = {index.get("last_full")}
+    index["snapshots"] = {k: v for k, v in index["snapshots"].items() if k in keep or v.get("base") in keep}
+    live = {str(DB_CSV.resolve())}
+    index["hash_cache"] = {k: v for k, v in hash_cache.items() if k in live}
+    save_backup_index(index)
+    return out_file
+
+def build_workspace_backup(form_values, form_imgs, form_ex_imgs, incremental=False):
+    out = tempfile.TemporaryFile()
+    write_workspace_backup(out, form_values, form_imgs, form_ex_imgs, incremental)
+    out.seek(0)
+    return out
+
+def restore_workspace_zip(file_obj):
+    # 各エントリはディスクへ直接ストリーム展開し、既に同じ内容のファイルがあれば展開を省略する
+    with zipfile.ZipFile(file_obj) as zf:
+        manifest = json.loads(zf.read("manifest.json").decode("utf-8"))
+        if manifest.get("format") != BACKUP_FORMAT:
+            raise ValueError("ワークスペースのバックアップファイルではありません")
+        if manifest.get("version", 2) < 3:
+            return restore_workspace_zip_v2(zf, manifest)
+
+        names = set(zf.namelist())
+        files = manifest.get("files", {})
+        form = manifest.get("form", {})
+        workspace = manifest.get("workspace", {})
+        ts = datetime.now().strftime('%H%M%S%f')
+
+        def target_for(name):
+            if name == "workspace/devices.csv": return DB_CSV
+            if name == "workspace/labels.pack": return TEMP_LABEL_DIR / "restored.pack"
+            if name.startswith("workspace/labels/"): return TEMP_LABEL_DIR / Path(name).name
+            if name.startswith("form/"): return DRAFT_IMG_DIR / f"restored_{Path(name).stem}_{ts}{Path(name).suffix}"
+            return None
+
+        # 差分バックアップに含まれない blob は、手元にある同一内容のファイルから補う
+        compact_devices()
+        index = load_backup_index()
+        hash_cache = index.setdefault("hash_cache", {})
+        local_by_sha = {}
+        for p in [DB_CSV, *TEMP_LABEL_DIR.glob("labels_*.pack"), *DRAFT_IMG_DIR.glob("restored_*")]:
+            if p.exists(): local_by_sha.setdefault(file_sha256(p, hash_cache), p)
+        if "label_history" in workspace:
+            # 旧形式（ラベル1枚ずつ）の差分バックアップは、手元のパック内のラベルからも補う（索引が読めなければ補わない）
+            with label_store()["lock"]:
+                try: label_index = load_label_index()
+                except LabelIndexError: label_index = new_label_index()
+                with label_pack_view(label_index) as view:
+                    for e in live_labels(label_index):
+                        png = bytes(label_bytes(view, e))
+                        local_by_sha.setdefault(hashlib.sha256(png).hexdigest(), png)
+
+        plan = []
+        missing = []
+        restored_paths = {}
+        for name, meta in files.items():
+            target = target_for(name)
+            if target is None: continue
+            sha = meta["sha"]
+            if name.startswith("form/") and sha in local_by_sha:
+                restored_paths[name] = local_by_sha[sha]; continue
+            if target.exists() and file_sha256(target, hash_cache) == sha: continue
+            if f"blobs/{sha}" in names: plan.append((name, target, sha, "zip"))
+            elif sha in local_by_sha: plan.append((name, target, sha, "local"))
+            else: missing.append(name)
+        if missing:
+            raise ValueError(f"基準のフルバックアップ（{manifest.get('base')}）を先に復元してください。不足: {', '.join(missing[:5])}")
+
+        for name, target, sha, origin in plan:
+            tmp = target.with_name(target.name + ".part")
+            h = hashlib.sha256()
+            local = local_by_sha.get(sha)
+            with (zf.open(f"blobs/{sha}") if origin == "zip" else io.BytesIO(local) if isinstance(local, bytes) else open(local, "rb")) as src, open(tmp, "wb") as dst:
+                for chunk in iter(lambda: src.read(BACKUP_CHUNK), b""):
+                    h.update(chunk); dst.write(chunk)
+            if h.hexdigest() != sha:
+                tmp.unlink()
+                raise ValueError(f"バックアップ内のファイルが破損しています: {name}")
+            if target == DB_CSV: install_devices_snapshot(tmp)
+            else: os.replace(tmp, target)
+            restored_paths[name] = target
+        save_backup_index(index)
+
+        if "label_index" in workspace:
+            pack = restored_paths.get("workspace/labels.pack")
+            if pack is None and "workspace/labels.pack" in files: pack = target_for("workspace/labels.pack")  # 展開済みのものが残っていた
+            install_label_pack(pack, workspace["label_index"])
+        else: replace_labels_from_legacy(workspace.get("label_history", []))
+
+        def restore_img(img_dict):
+            if not img_dict: return ""
+            if img_dict["type"] == "path": return img_dict["data"]
+            if img_dict["type"] == "file":
+                p = restored_paths.get(img_dict["data"])
+                return str(p) if p else ""
+            return ""
+
+        restored_imgs = {slot: restore_img(form.get("existing_imgs", {}).get(slot)) for slot in BACKUP_IMG_SLOTS}
+        restored_ex = [{"title": ex.get("title", ""), "url": restore_img(ex.get("img_data"))} for ex in form.get("existing_ex_imgs", [])]
+    return form, restored_imgs, restored_ex
+
+def restore_workspace_zip_v2(zf, manifest):
+    names = set(zf.namelist())
+    workspace = manifest.get("workspace", {})
+
+    def extract_to(arcname, dest):
+        with zf.open(arcname) as src, open(dest, "wb") as dst: shutil.copyfileobj(src, dst, BACKUP_CHUNK)
+
+    csv_name = workspace.get("devices_csv")
+    if csv_name and csv_name in names:
+        tmp = DB_CSV.with_name(DB_CSV.name + ".part")
+        extract_to(csv_name, tmp)
+        install_devices_snapshot(tmp)
+    for img_name in workspace.get("label_images", []):
+        arcname = f"workspace/labels/{img_name}"
+        if arcname in names: extract_to(arcname, TEMP_LABEL_DIR / Path(img_name).name)
+    replace_labels_from_legacy(workspace.get("label_history", []))
+
+    def restore_img(img_dict, prefix):
+        if not img_dict: return ""
+        if img_dict["type"] == "path": return img_dict["data"]
+        if img_dict["type"] == "file" and img_dict["data"] in names:
+            temp_path = DRAFT_IMG_DIR / f"restored_{prefix}_{datetime.now().strftime('%H%M%S%f')}{Path(img_dict['data']).suffix}"
+            extract_to(img_dict["data"], temp_path)
+            return str(temp_path)
+        return ""
+
+    form = manifest.get("form", {})
+    restored_imgs = {slot: restore_img(form.get("existing_imgs", {}).get(slot), slot) for slot in BACKUP_IMG_SLOTS}
+    restored_ex = [{"title": ex.get("title", ""), "url": restore_img(ex.get("img_data"), f"ex_{i}")} for i, ex in enumerate(form.get("existing_ex_imgs", []))]
+    return form, restored_imgs, restored_ex
+
+def restore_workspace_json(raw_bytes):
+    # 旧形式（.json, 画像はbase64埋め込み）のバックアップ
+    loaded_data = json.loads(raw_bytes.decode("utf-8"))
+
+    form_data = loaded_data.get("form", loaded_data)
+    workspace_data = loaded_data.get("workspace", {})
+
+    if workspace_data:
+        if "devices_csv" in workspace_data and workspace_data["devices_csv"]:
+            tmp = DB_CSV.with_name(DB_CSV.name + ".part")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(workspace_data["devices_csv"])
+            install_devices_snapshot(tmp)
+
+        label_imgs = workspace_data.get("label_images", {})
+        for img_name, b64_str in label_imgs.items():
+            try:
+                with open(TEMP_LABEL_DIR / img_name, "wb") as f:
+                    f.write(base64.b64decode(b64_str))
+            except: pass
+
+        replace_labels_from_legacy(workspace_data.get("label_history", []))
+
+    def decode_img(img_dict, prefix):
+        if not img_dict: return ""
+        if img_dict["type"] == "path": return img_dict["data"]
+        if img_dict["type"] == "base64":
+            try:
+                b_data = base64.b64decode(img_dict["data"])
+                temp_path = DRAFT_IMG_DIR / f"restored_{prefix}_{datetime.now().strftime('%H%M%S%f')}.jpg"
+                with open(temp_path, "wb") as f: f.write(b_data)
+                return str(temp_path)
+            except: return ""
+        return ""
+
+    d_imgs = form_data.get("existing_imgs", {})
+    restored_imgs = {slot: decode_img(d_imgs.get(slot), slot) for slot in BACKUP_IMG_SLOTS}
+    restored_ex = []
+    for i, ex in enumerate(form_data.get("existing_ex_imgs", [])):
+        path = decode_img(ex.get("img_data"), f"ex_{i}")
+        restored_ex.append({"title": ex.get("title", ""), "url": path})
+    return form_data, restored_imgs, restored_ex
 
 import socket
-import threading
 import http.server
-import socketserver
 import functools
+import email.utils
+import re
+import sys
 
 # --- 社内Wi-Fi用 ミニWebサーバー機能 ---
+MANUAL_SERVER_BIND = os.environ.get("QR_MANUAL_SERVER_BIND", "")
+MANUAL_SERVER_PORT = int(os.environ.get("QR_MANUAL_SERVER_PORT", "8000"))
+MANUAL_SERVER_ACCESS_LOG = os.environ.get("QR_MANUAL_SERVER_ACCESS_LOG", "")
+
+# ファイル名に14桁のタイムスタンプを含むファイル（HTML版の区画画像を含む）は上書きされないため長期キャッシュさせる
+IMMUTABLE_NAME_RE = re.compile(r"_\d{14}(_s\d{2}_\d+)?\.[A-Za-z0-9]+$")
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+_access_log_lock = threading.Lock()
+
+class ManualRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    extensions_map = {**http.server.SimpleHTTPRequestHandler.extensions_map, ".webp": "image/webp"}
+    timeout = 30  # 放置されたKeep-Alive接続を切断する
+
+    def handle_one_request(self):
+        self._t0 = time.perf_counter()
+        self._status = None
+        self._sent = 0
+        self._range = None
+        self.path_is_jpeg = False
+        super().handle_one_request()
+        if self._status is not None:
+            ms = (time.perf_counter() - self._t0) * 1000
+            self.log_message('"%s" %s %d %.1fms', self.requestline, self._status, self._sent, ms)
+
+    def log_request(self, code='-', size='-'):
+        # アクセスログはレスポンス送信完了後にレイテンシ付きでまとめて出力する
+        self._status = code.value if hasattr(code, 'value') else code
+
+    def log_message(self, format, *args):
+        line = "%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), format % args)
+        with _access_log_lock:
+            if MANUAL_SERVER_ACCESS_LOG:
+                with open(MANUAL_SERVER_ACCESS_LOG, "a", encoding="utf-8") as f: f.write(line)
+            else:
+                sys.stderr.write(line)
+
+    def send_cache_headers(self, path, etag, last_modified):
+        immutable = IMMUTABLE_NAME_RE.search(os.path.basename(path))
+        self.send_header("Cache-Control", CACHE_IMMUTABLE if immutable else CACHE_REVALIDATE)
+        if self.path_is_jpeg: self.send_header("Vary", "Accept")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+
+    def is_not_modified(self, etag, mtime):
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(",")]
+            return "*" in tags or etag in tags or f"W/{etag}" in tags
+        ims = self.headers.get("If-Modified-Since")
+        if ims is not None:
+            try:
+                ims_dt = email.utils.parsedate_to_datetime(ims)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if ims_dt.tzinfo is None: ims_dt = ims_dt.replace(tzinfo=timezone.utc)
+            return int(mtime) <= ims_dt.timestamp()
+        return False
+
+    def negotiate_variant(self, path):
+        # JPEGの要求に対し、WebPを受け付けるクライアントには同名の新しいWebP版を返す
+        if not self.path_is_jpeg or "image/webp" not in self.headers.get("Accept", ""): return path
+        webp = os.path.splitext(path)[0] + ".webp"
+        try:
+            if os.stat(webp).st_mtime_ns >= os.stat(path).st_mtime_ns: return webp
+        except OSError:
+            pass
+        return path
+
+    def parse_range(self, size, etag, last_modified):
+        # 単一レンジ(bytes=a-b / a- / -n)のみ対応。Noneは全体送信、"invalid"は416
+        rng = self.headers.get("Range")
+        if not rng or not rng.startswith("bytes=") or "," in rng: return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range.strip() not in (etag, last_modified): return None
+        start_s, _, end_s = rng[6:].strip().partition("-")
+        try:
+            if start_s == "":
+                length = int(end_s)
+                if length <= 0: return "invalid"
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start_s)
+                end = int(end_s) if end_s else size - 1
+        except ValueError:
+            return None
+        if start >= size or start > end: return "invalid"
+        return start, min(end, size - 1)
+
+    def send_permalink(self):
+        did = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path[len(PERMALINK_PREFIX):]).strip("/")
+        target = permalink_target(did) if did else None
+        if not target:
+            self.send_error(404, "Device not found")
+            return None
+        self.send_response(302)
+        self.send_header("Location", target)
+        self.send_header("Cache-Control", "no-store")  # 転送先は機器情報ページの更新で変わる
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return None
+
+    def send_head(self):
+        if self.path.startswith(PERMALINK_PREFIX): return self.send_permalink()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()
+        if path.endswith("/"):
+            self.send_error(404, "File not found")
+            return None
+        self.path_is_jpeg = path.lower().endswith((".jpg", ".jpeg"))
+        path = self.negotiate_variant(path)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            etag = f'"{fs.st_size:x}-{fs.st_mtime_ns:x}"'
+            last_modified = self.date_time_string(int(fs.st_mtime))
+
+            if self.is_not_modified(etag, fs.st_mtime):
+                f.close()
+                self.send_response(304)
+                self.send_cache_headers(path, etag, last_modified)
+                self.end_headers()
+                return None
+
+            rng = self.parse_range(fs.st_size, etag, last_modified)
+            if rng == "invalid":
+                f.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{fs.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            if rng:
+                start, end = rng
+                self._range = (start, end - start + 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{fs.st_size}")
+                self.send_header("Content-Length", str(end - start + 1))
+            else:
+                self.send_response(200)
+                self.send_header("Content-Length", str(fs.st_size))
+            self.send_header("Content-type", self.guess_type(path))
+            self.send_cache_headers(path, etag, last_modified)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        rng = getattr(self, "_range", None)
+        if rng:
+            source.seek(rng[0])
+            remaining = rng[1]
+        else:
+            remaining = None
+        while remaining is None or remaining > 0:
+            chunk = source.read(64 * 1024 if remaining is None else min(64 * 1024, remaining))
+            if not chunk: break
+            outputfile.write(chunk)
+            self._sent += len(chunk)
+            if remaining is not None: remaining -= len(chunk)
+
+class ManualHTTPServer(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
 @st.cache_resource
-def start_local_image_server():
+def start_local_image_server(bind=MANUAL_SERVER_BIND, port=MANUAL_SERVER_PORT):
     def run_server():
         manual_dir_abs = str(MANUAL_DIR.resolve())
-        Handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=manual_dir_abs)
-        socketserver.TCPServer.allow_reuse_address = True
+        Handler = functools.partial(ManualRequestHandler, directory=manual_dir_abs)
         try:
-            with socketserver.TCPServer(("", 8000), Handler) as httpd:
+            with ManualHTTPServer((bind, port), Handler) as httpd:
                 httpd.serve_forever()
-        except:
-            pass
+        except Exception as e:
+            print(f"マニュアル配信サーバーの起動エラー: {e}")
     t = threading.Thread(target=run_server, daemon=True)
     t.start()
     return True
 
-start_local_image_server()
-
 def get_local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -530,11 +3182,84 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
+def get_manual_server_base_url():
+    host = MANUAL_SERVER_BIND if MANUAL_SERVER_BIND not in ("", "0.0.0.0") else get_local_ip()
+    return f"http://{host}:{MANUAL_SERVER_PORT}"
+
+# ==========================================
+# --- 機器ごとの固定URL（/d/{管理番号}） ---
+# ==========================================
+# QRコードには http://<IP>:8000/d/{管理番号} を載せ、配信サーバーが台帳の URL 列（現在の機器情報ページ）へ転送する。
+# 機器情報ページを作り直してもQRコードは変わらないため、ラベルの再印刷・貼り替えが要らない。
+# 転送表はメモリに持ち、台帳（スナップショット・ジャーナル）のファイルが変わったときだけ読み直す。
+PERMALINK_PREFIX = "/d/"
+
+def permalink_url(did, base=None):
+    return f"{base or get_manual_server_base_url()}{PERMALINK_PREFIX}{urllib.parse.quote(str(did), safe='')}"
+
+# 配信サーバーのスレッドから参照するため、Streamlit のキャッシュではなくモジュール変数に持つ
+_permalink_table = {"lock": threading.Lock(), "key": None, "urls": {}}
+
+def device_db_change_key():
+    try:
+        j = os.stat(DB_JOURNAL)
+        journal_key = (j.st_size, j.st_mtime_ns)
+    except FileNotFoundError:
+        journal_key = None
+    return device_snapshot_key(), journal_key
+
+def permalink_target(did):
+    table = _permalink_table
+    with table["lock"]:
+        key = device_db_change_key()
+        if key != table["key"]:
+            df = load_devices() if key[0] is not None or key[1] is not None else pd.DataFrame(columns=["ID", "URL"])
+            table["urls"] = {str(i): u for i, u in zip(df["ID"], df["URL"]) if isinstance(u, str) and u.startswith(("http://", "https://")) and PERMALINK_PREFIX not in u}
+            table["key"] = key
+        url = table["urls"].get(str(did))
+    if not url: return None
+    # このサーバーから配信している機器情報ページは、登録時のIPアドレスに関わらず同じサーバー上のパスへ転送する。
+    # GitHub 保存で送信待ちの間は、手元に残っている同名のページを返す
+    parsed = urllib.parse.urlparse(url)
+    name = urllib.parse.unquote(Path(parsed.path).name)
+    local = name and (MANUAL_DIR / name).is_file()
+    if local and (parsed.port == MANUAL_SERVER_PORT or outbox_local_file(url) is not None):
+        return "/" + urllib.parse.quote(name)
+    return url
+
+# ==========================================
+# --- 画面の区画ごとの再実行 ---
+# ==========================================
+# 区画内の操作では区画の関数だけが再実行される（st.fragment）。全体の再実行の中では span として、
+# 区画だけの再実行は「再実行:区画名」として診断に記録する
+def panel_fragment(name):
+    def deco(func):
+        def wrapper(*args, **kwargs):
+            if current_metrics_run.get() is not None:
+                with span(f"断片:{name}"): return func(*args, **kwargs)
+            with metrics_run(f"再実行:{name}", st.session_state.get("metrics_track_memory", False)):
+                return func(*args, **kwargs)
+        wrapper.__name__ = wrapper.__qualname__ = func.__name__
+        return st.fragment(wrapper)
+    return deco
+
+@st.cache_resource
+def icon_base64_cached(path, mtime_ns):
+    with open(path, "rb") as f: return base64.b64encode(f.read()).decode("utf-8")
+
+def icon_base64(path="icon.ico"):
+    try: return icon_base64_cached(path, os.stat(path).st_mtime_ns)
+    except OSError: return ""
+
 # ==========================================
 # --- メインアプリ ---
 # ==========================================
 def main():
     st.set_page_config(page_title="機器情報ページ ＆ QR管理システム", page_icon="icon.ico", layout="wide", initial_sidebar_state="expanded")
+    ensure_work_dirs()
+    start_local_image_server()
+    outbox_worker()
+    prune_upload_memo(active_uploads())
     
     # 【追加・修正】英数字と漢字のバランスを整えるCSS ＆ ボタンはみ出し修正CSS
     st.markdown("""
@@ -573,17 +3298,9 @@ def main():
     </style>
     """, unsafe_allow_html=True)
 
-    db_columns = ["ID", "Name", "Power", "URL", "Updated", "memo", "is_related_loto", "img_exterior", "img_outlet", "img_label", "img_loto1", "img_loto2", "extra_images"]
-    if not DB_CSV.exists():
-        pd.DataFrame(columns=db_columns).to_csv(DB_CSV, index=False)
-    else:
-        df_init = pd.read_csv(DB_CSV)
-        needs_save = False
-        for col in db_columns:
-            if col not in df_init.columns:
-                df_init[col] = ""
-                needs_save = True
-        if needs_save: df_init.to_csv(DB_CSV, index=False)
+    # 旧形式の devices.csv（列が足りないもの）や未作成の場合はスナップショットを作り直す
+    if not DB_CSV.exists() or any(c not in pd.read_csv(DB_CSV, nrows=0).columns for c in DB_COLUMNS):
+        compact_devices()
 
     if "input_did" not in st.session_state: st.session_state.input_did = ""
     if "input_name" not in st.session_state: st.session_state.input_name = ""
@@ -597,14 +3314,12 @@ def main():
 
     if "current_db_sel" not in st.session_state: st.session_state.current_db_sel = "✨ 新規登録 (クリア)"
 
-    if "preview_b64" not in st.session_state: st.session_state.preview_b64 = None
     if "preview_file" not in st.session_state: st.session_state.preview_file = None
     if "label_img_data" not in st.session_state: st.session_state.label_img_data = None
     if "label_msg" not in st.session_state: st.session_state.label_msg = None
     if "label_url" not in st.session_state: st.session_state.label_url = None
 
     def clear_preview_and_label():
-        st.session_state.preview_b64 = None
         st.session_state.preview_file = None
         st.session_state.label_img_data = None
         st.session_state.label_msg = None
@@ -612,9 +3327,9 @@ def main():
 
     def delete_db_item_callback(did_to_del):
         try:
-            d_csv = pd.read_csv(DB_CSV)
-            d_csv = d_csv[d_csv["ID"].astype(str) != str(did_to_del)]
-            d_csv.to_csv(DB_CSV, index=False)
+            delete_device(did_to_del)
+            update_publish_state(did_to_del, None)
+            update_portal_if_enabled([did_to_del])
         except Exception:
             pass
             
@@ -632,64 +3347,84 @@ def main():
         st.session_state.form_reset_key += 1
         st.session_state["scroll_to_top"] = True
         st.session_state.delete_success_msg = True
+        st.session_state.picker_full_rerun = True
         clear_preview_and_label()
 
 
-    st.sidebar.header("🗄️ 登録済み機器データベース")
-    if DB_CSV.exists():
-        df = pd.read_csv(DB_CSV)
-        if not df.empty:
-            options = ["✨ 新規登録 (クリア)"] + (df["ID"].astype(str) + " : " + df["Name"]).tolist()
+    # 機器の選択・履歴の表示・削除はこの区画だけを再実行する（選択が変わったときだけ全体を再実行）
+    @panel_fragment("機器選択")
+    def device_picker_panel():
+        if st.session_state.pop("picker_full_rerun", False): st.rerun()
+        st.header("🗄️ 登録済み機器データベース")
+        if DB_CSV.exists():
+            df = load_devices()
+            if not df.empty:
+                options = ["✨ 新規登録 (クリア)"] + (df["ID"].astype(str) + " : " + df["Name"]).tolist()
             
-            c_sel = st.session_state.current_db_sel
-            sel_idx = options.index(c_sel) if c_sel in options else 0
+                c_sel = st.session_state.current_db_sel
+                sel_idx = options.index(c_sel) if c_sel in options else 0
             
-            selected_edit = st.sidebar.selectbox("編集・確認する機器を選択:", options, index=sel_idx, key="db_select_widget")
+                selected_edit = st.selectbox("編集・確認する機器を選択:", options, index=sel_idx, key="db_select_widget")
             
-            if selected_edit != st.session_state.current_db_sel:
-                st.session_state.current_db_sel = selected_edit
-                if selected_edit == "✨ 新規登録 (クリア)":
-                    st.session_state.input_did = ""
-                    st.session_state.input_name = ""
-                    st.session_state.input_power = None
-                    st.session_state.input_memo = ""
-                    st.session_state.is_related_loto = False
-                    st.session_state.existing_imgs = {}
-                    st.session_state.existing_ex_imgs = []
-                    st.session_state.extra_images_count = 0
-                else:
-                    did_str = selected_edit.split(" : ")[0]
-                    match = df[df["ID"].astype(str) == did_str]
-                    if not match.empty:
-                        row = match.iloc[-1]
-                        st.session_state.input_did = str(row["ID"])
-                        st.session_state.input_name = str(row["Name"])
-                        p_val = str(row.get("Power", "")) if pd.notna(row.get("Power")) else None
-                        st.session_state.input_power = p_val if p_val in ["100V", "200V"] else None
-                        st.session_state.input_memo = str(row.get("memo", "")) if pd.notna(row.get("memo")) else ""
-                        st.session_state.is_related_loto = bool(row.get("is_related_loto")) if pd.notna(row.get("is_related_loto")) else False
+                if selected_edit != st.session_state.current_db_sel:
+                    st.session_state.current_db_sel = selected_edit
+                    if selected_edit == "✨ 新規登録 (クリア)":
+                        st.session_state.input_did = ""
+                        st.session_state.input_name = ""
+                        st.session_state.input_power = None
+                        st.session_state.input_memo = ""
+                        st.session_state.is_related_loto = False
+                        st.session_state.existing_imgs = {}
+                        st.session_state.existing_ex_imgs = []
+                        st.session_state.extra_images_count = 0
+                        cancel_device_prefetch()
+                    else:
+                        did_str = selected_edit.split(" : ")[0]
+                        match = df[df["ID"].astype(str) == did_str]
+                        if not match.empty:
+                            row = match.iloc[-1]
+                            st.session_state.input_did = str(row["ID"])
+                            st.session_state.input_name = str(row["Name"])
+                            p_val = str(row.get("Power", "")) if pd.notna(row.get("Power")) else None
+                            st.session_state.input_power = p_val if p_val in ["100V", "200V"] else None
+                            st.session_state.input_memo = str(row.get("memo", "")) if pd.notna(row.get("memo")) else ""
+                            st.session_state.is_related_loto = bool(row.get("is_related_loto")) if pd.notna(row.get("is_related_loto")) else False
                         
-                        st.session_state.existing_imgs = {
-                            "ext": str(row.get("img_exterior", "")), "out": str(row.get("img_outlet", "")),
-                            "lab": str(row.get("img_label", "")), "lo1": str(row.get("img_loto1", "")), "lo2": str(row.get("img_loto2", ""))
-                        }
-                        ex_str = str(row.get("extra_images", "[]"))
-                        if pd.isna(row.get("extra_images")): ex_str = "[]"
-                        try: st.session_state.existing_ex_imgs = json.loads(ex_str)
-                        except: st.session_state.existing_ex_imgs = []
+                            st.session_state.existing_imgs = {
+                                "ext": str(row.get("img_exterior", "")), "out": str(row.get("img_outlet", "")),
+                                "lab": str(row.get("img_label", "")), "lo1": str(row.get("img_loto1", "")), "lo2": str(row.get("img_loto2", ""))
+                            }
+                            ex_str = str(row.get("extra_images", "[]"))
+                            if pd.isna(row.get("extra_images")): ex_str = "[]"
+                            try: st.session_state.existing_ex_imgs = json.loads(ex_str)
+                            except: st.session_state.existing_ex_imgs = []
+                            # フォームを描き直している間に、画像の取得・デコードと区画の作成を裏で始めておく
+                            start_device_prefetch(st.session_state.existing_imgs, st.session_state.existing_ex_imgs, st.session_state.is_related_loto, st.session_state.get("metrics_track_memory", False))
                 
-                clear_preview_and_label()
-                st.session_state.form_reset_key += 1
-                st.rerun()
-
-            if st.session_state.current_db_sel != "✨ 新規登録 (クリア)":
-                st.sidebar.info("💡 過去の画像とデータが呼び出されました。そのまま再発行や、一部の画像の差し替えが可能です。")
-                did_val = st.session_state.current_db_sel.split(" : ")[0]
-                st.sidebar.button("🗑️ この機器データを削除　", on_click=delete_db_item_callback, args=(did_val,))
+                    clear_preview_and_label()
+                    st.session_state.form_reset_key += 1
+                    st.rerun()
+
+                if st.session_state.current_db_sel != "✨ 新規登録 (クリア)":
+                    st.info("💡 過去の画像とデータが呼び出されました。そのまま再発行や、一部の画像の差し替えが可能です。")
+                    did_val = st.session_state.current_db_sel.split(" : ")[0]
+                    st.button("🗑️ この機器データを削除　", on_click=delete_db_item_callback, args=(did_val,))
+                    with st.expander("📜 この機器の変更履歴"):
+                        hist = device_history(did_val)
+                        if hist:
+                            st.dataframe(pd.DataFrame([
+                                {"日時": h.get("at"), "操作": "登録・更新" if h.get("op") == "put" else "削除", "機器名称": (h.get("row") or {}).get("Name", ""), "URL": (h.get("row") or {}).get("URL", "")}
+                                for h in reversed(hist)
+                            ]), hide_index=True, use_container_width=True)
+                        else:
+                            st.caption("履歴はまだありません（この仕組みの導入前の登録です）。")
                 
-            if st.session_state.get("delete_success_msg"):
-                st.sidebar.success("✅ 削除しました！")
-                st.session_state.delete_success_msg = False
+                if st.session_state.get("delete_success_msg"):
+                    st.success("✅ 削除しました！")
+                    st.session_state.delete_success_msg = False
+
+    with st.sidebar:
+        device_picker_panel()
 
     st.sidebar.markdown("---")
     st.sidebar.header("⚙️ システム詳細設定")
@@ -706,10 +3441,45 @@ def main():
             pass
             
         github_token = st.sidebar.text_input("システム接続キー (トークン)", value=default_token, type="password")
-        
+        # 送信待ちの画像・機器情報ページは、このトークンでバックグラウンド送信される（トークンはディスクに保存しない）
+        outbox_set_credentials(github_repo, github_token)
+
     elif save_mode == "3. 社内共有フォルダへ自動保存":
         local_path = st.sidebar.text_input("共有フォルダのパス", value=".")
 
+    pending_uploads = outbox_entries()
+    if pending_uploads:
+        outbox = outbox_worker()
+        st.sidebar.caption(f"📤 送信待ち: {len(pending_uploads)} 件（{sum(m['bytes'] for m in pending_uploads) / 1024:,.0f} KB）。接続が回復すると自動で送信されます。")
+        if outbox["last_error"]:
+            st.sidebar.warning(f"送信に失敗しました（自動で再試行します）: {outbox['last_error']}")
+        if st.sidebar.button("🔁 今すぐ再送", use_container_width=True):
+            outbox["force"] = True
+            outbox["event"].set()
+            time.sleep(1)
+            st.rerun()
+
+    manual_profile = st.sidebar.selectbox(
+        "機器情報ページ画像の出力形式:", list(MANUAL_ENCODE_PROFILES),
+        format_func=lambda k: MANUAL_ENCODE_PROFILES[k]["label"],
+        help="WebP版は社内共有フォルダ（社内Wi-Fi配信）利用時に、対応するスマホへ自動で配信されます。"
+    )
+    manual_budget_kb = st.sidebar.number_input("画像ファイルサイズの目標上限 (KB)", min_value=200, max_value=10000, value=MANUAL_DEFAULT_BUDGET_KB, step=100)
+    with_viewer = False
+    if save_mode == "3. 社内共有フォルダへ自動保存":
+        with_viewer = st.sidebar.checkbox(
+            "スマホ向けHTML版ページを生成し、QRコードの接続先にする", value=False,
+            help="区画ごとの画像を順次読み込むため、スマホでの表示開始が速くなります。1枚画像も同時に保存されます。"
+        )
+
+    use_permalink = False
+    if save_mode != "1. 手動ダウンロードのみ":
+        use_permalink = st.sidebar.checkbox(
+            "QRコードに機器ごとの固定URL（/d/管理番号）を使う", value=save_mode == "3. 社内共有フォルダへ自動保存",
+            help="社内Wi-Fi用サーバーが最新の機器情報ページへ転送するため、内容を更新してもQRコードは変わらず、ラベルの貼り替えが不要になります。"
+                 "スマホからこのPC（社内Wi-Fi用サーバー）に接続できる必要があります。"
+        )
+
     st.sidebar.markdown("---")
     st.sidebar.markdown("**⏬ 手動保存オプション**")
     include_equip_name = st.sidebar.checkbox(
@@ -718,13 +3488,11 @@ def main():
         help="プレビュー確認後に、手動で画像をPCへダウンロードする際のファイル名に適用されます（例: 2699_金型反転機.jpg）"
     )
     
+    track_mem = st.session_state.get("metrics_track_memory", False)
+
     st.markdown("<div id='top_anchor'></div>", unsafe_allow_html=True)
     
-    icon_path = Path("icon.ico")
-    img_base64 = ""
-    if icon_path.exists():
-        with open(icon_path, "rb") as f:
-            img_base64 = base64.b64encode(f.read()).decode("utf-8")
+    img_base64 = icon_base64()
     
     if img_base64:
         st.markdown(
@@ -774,7 +3542,14 @@ def main():
         st.markdown("<hr style='margin:10px 0;'>", unsafe_allow_html=True)
         return new_file, del_flag, existing_path if has_existing else ""
 
-    with col2:
+    # 画像の指定・差し替え・削除チェックはこの区画だけを再実行する
+    image_inputs = st.session_state.setdefault("image_inputs", {})
+
+    def add_extra_image_slot():
+        st.session_state.extra_images_count += 1
+
+    @panel_fragment("画像の指定")
+    def image_panel():
         st.header("2. 画像の指定・管理")
         imgs = st.session_state.get("existing_imgs", {})
         
@@ -823,9 +3598,25 @@ def main():
                 ex_imgs_data_preview.append((ef, t))
                 ex_imgs_to_save.append({"type": "new", "file": ef, "title": t, "index": i})
 
-        if st.button("➕ 追加枠を増やす"):
-            st.session_state.extra_images_count += 1
-            st.rerun()
+        st.button("➕ 追加枠を増やす", on_click=add_extra_image_slot)
+
+        slots = {"ext": (f_ext, d_ext, e_ext), "out": (f_out, d_out, e_out), "lab": (f_lab, d_lab, e_lab), "lo1": (f_lo1, d_lo1, e_lo1), "lo2": (f_lo2, d_lo2, e_lo2)}
+        # 区画だけが再実行された場合も、バックアップには最新の指定内容が入るよう共有の辞書を書き換える
+        image_inputs.update({
+            "slots": slots, "is_related_loto": is_related_loto, "extra_images_count": st.session_state.extra_images_count,
+            "ex_imgs_data_preview": ex_imgs_data_preview, "ex_imgs_to_save": ex_imgs_to_save,
+        })
+        return dict(image_inputs)
+
+    with col2:
+        panel = image_panel()
+    f_ext, d_ext, e_ext = panel["slots"]["ext"]
+    f_out, d_out, e_out = panel["slots"]["out"]
+    f_lab, d_lab, e_lab = panel["slots"]["lab"]
+    f_lo1, d_lo1, e_lo1 = panel["slots"]["lo1"]
+    f_lo2, d_lo2, e_lo2 = panel["slots"]["lo2"]
+    is_related_loto = panel["is_related_loto"]
+    ex_imgs_data_preview, ex_imgs_to_save = panel["ex_imgs_data_preview"], panel["ex_imgs_to_save"]
 
     def get_input_for_manual(file_obj, del_flag, existing_path):
         if del_flag: return None
@@ -838,7 +3629,7 @@ def main():
     st.header("3. 機器情報ページ プレビュー確認")
     if st.button("🔍 プレビューを作成", type="secondary"):
         if did and name and power:
-            with st.spinner("プレビュー作成中..."):
+            with st.spinner("プレビュー作成中..."), metrics_run("プレビュー", track_mem):
                 m_data = {
                     "id": did, "name": name, "power": power, "memo": memo, "is_related_loto": is_related_loto,
                     "img_exterior": get_input_for_manual(f_ext, d_ext, e_ext),
@@ -847,30 +3638,30 @@ def main():
                     "img_loto1": get_input_for_manual(f_lo1, d_lo1, e_lo1),
                     "img_loto2": get_input_for_manual(f_lo2, d_lo2, e_lo2)
                 }
-                manual_path = MANUAL_DIR / f"preview_{rk}.jpg"
-                create_manual_image_extended(m_data, ex_imgs_data_preview, manual_path)
-                if manual_path.exists():
-                    with open(manual_path, "rb") as f: 
-                        st.session_state.preview_b64 = base64.b64encode(f.read()).decode("utf-8")
-                    
+                preview = create_manual_preview(m_data, ex_imgs_data_preview, manual_profile, manual_budget_kb)
+                if preview["path"].exists():
                     s_id = safe_filename(did)
                     dl_file_name = f"{s_id}_{safe_filename(name)}.jpg" if include_equip_name else f"{s_id}.jpg"
-                    st.session_state.preview_file = {"path": manual_path, "name": dl_file_name}
+                    st.session_state.preview_file = {**preview, "name": dl_file_name}
         else:
             st.error("管理番号、機器名称、使用電源は必須です。")
 
-    if st.session_state.preview_b64:
+    pf = st.session_state.preview_file
+    if pf and Path(pf["thumb"]).exists():
         st.success("プレビュー成功！")
-        st.components.v1.html(f'<div style="height:500px; overflow-y:scroll; border:2px solid #ddd;"><img src="data:image/jpeg;base64,{st.session_state.preview_b64}" width="100%"></div>', height=520)
-        if st.session_state.preview_file:
-            with open(st.session_state.preview_file["path"], "rb") as img_file:
-                st.download_button(label="📥 完成したプレビュー画像を手動でPCに保存", data=img_file, file_name=st.session_state.preview_file["name"], mime="image/jpeg")
+        # 縮小版をファイルとして配信し、原寸画像はダウンロード時にだけ読み込む
+        with st.container(height=520, border=True):
+            st.image(str(pf["thumb"]), width="stretch")
+        st.download_button(label="📥 完成したプレビュー画像を手動でPCに保存", data=lambda p=pf["path"]: Path(p).read_bytes(), file_name=pf["name"], mime="image/jpeg")
 
     # --- 登録・発行機能 ---
     st.markdown("---")
     st.header("4. データ登録 ＆ 印刷用ラベル発行")
     
-    st.info("💡 **【重要】QRコードに関するご注意**\n\n画像や情報を更新し、ラベルを再発行するたびに、新しいURLのQRコードが発行されます。内容を更新した際は、最新のQRコードをご使用ください。")
+    if use_permalink:
+        st.info(f"💡 **QRコードは機器ごとに固定です**\n\nQRコードには固定URL（例: {permalink_url(did or '管理番号')}）が載り、常に最新の機器情報ページへ転送されます。内容を更新しても、貼付済みのラベルはそのまま使えます。")
+    else:
+        st.info("💡 **【重要】QRコードに関するご注意**\n\n画像や情報を更新し、ラベルを再発行するたびに、新しいURLのQRコードが発行されます。内容を更新した際は、最新のQRコードをご使用ください。")
     
     if save_mode == "1. 手動ダウンロードのみ":
         long_url = st.text_input("保管先等のURLを貼り付け")
@@ -887,12 +3678,10 @@ def main():
                 img_qr = make_optimized_qr(long_url)
                 img_qr.save(qr_path)
                 
-                df = pd.read_csv(DB_CSV)
-                df = df[df["ID"].astype(str) != str(did)]
                 JST = timezone(timedelta(hours=9)) 
                 new_data = {"ID": did, "Name": name, "Power": power, "URL": long_url, "Updated": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"), "memo": memo, "is_related_loto": is_related_loto}
-                df = pd.concat([df, pd.DataFrame([new_data])], ignore_index=True)
-                df.to_csv(DB_CSV, index=False)
+                put_device(new_data)
+                update_portal_if_enabled([did])
                 
                 label_img = create_label_image({"name": name, "power": power, "img_qr": img_qr})
                 
@@ -919,104 +3708,31 @@ def main():
 
         if btn_auto_print or btn_auto_save:
             if did and name and power:
-                with st.spinner("🔄 画像の圧縮とデータベース保存を実行中..."):
+                with st.spinner("🔄 画像の圧縮とデータベース保存を実行中..."), metrics_run("登録・発行", track_mem):
                     try:
-                        def process_save(f_obj, d_flag, e_path, suffix):
-                            if d_flag: return ""
-                            if f_obj: return save_image_to_storage(f_obj, did, suffix, save_mode, github_repo, github_token, local_path)
-                            return e_path
-                            
-                        fin_ext = process_save(f_ext, d_ext, e_ext, "ext")
-                        fin_out = process_save(f_out, d_out, e_out, "out")
-                        fin_lab = process_save(f_lab, d_lab, e_lab, "lab")
-                        fin_lo1 = process_save(f_lo1, d_lo1, e_lo1, "lo1")
-                        fin_lo2 = process_save(f_lo2, d_lo2, e_lo2, "lo2")
-
-                        final_extra_images_db = []
-                        for item in ex_imgs_to_save:
-                            if item["type"] == "existing":
-                                if item["file"]: 
-                                    saved_url = save_image_to_storage(item["file"], did, f"ex_{item['index']}", save_mode, github_repo, github_token, local_path)
-                                    if saved_url: final_extra_images_db.append({"title": item["title"], "url": saved_url})
-                                else: 
-                                    final_extra_images_db.append({"title": item["title"], "url": item["url"]})
-                            elif item["type"] == "new":
-                                if item["file"]: 
-                                    saved_url = save_image_to_storage(item["file"], did, f"ex_new_{item['index']}", save_mode, github_repo, github_token, local_path)
-                                    if saved_url: final_extra_images_db.append({"title": item["title"], "url": saved_url})
-
-                        m_data = {
-                            "id": did, "name": name, "power": power, "memo": memo, "is_related_loto": is_related_loto,
-                            "img_exterior": fin_ext if fin_ext else None,
-                            "img_outlet": fin_out if fin_out else None,
-                            "img_label": fin_lab if fin_lab else None,
-                            "img_loto1": fin_lo1 if fin_lo1 else None,
-                            "img_loto2": fin_lo2 if fin_lo2 else None
-                        }
-                        
-                        JST = timezone(timedelta(hours=9)) 
-                        ts_str = datetime.now(JST).strftime("%H%M")
-                        s_id = safe_filename(did)
-                        file_name_manual = f"{s_id}_{ts_str}.jpg"
-                        manual_path = MANUAL_DIR / file_name_manual
-                        
-                        create_manual_image_extended(m_data, ex_imgs_data_preview, manual_path)
-
-                        final_manual_url = ""
-                        if save_mode == "2. 全自動（データベース保存）":
-                            with open(manual_path, "rb") as f:
-                                payload = {"message": f"Upload Manual {file_name_manual}", "content": base64.b64encode(f.read()).decode("utf-8"), "branch": "main"}
-                                req = urllib.request.Request(f"https://api.github.com/repos/{github_repo}/contents/manuals/{urllib.parse.quote(file_name_manual)}", data=json.dumps(payload).encode("utf-8"), method="PUT")
-                                req.add_header("Authorization", f"token {github_token}"); req.add_header("Content-Type", "application/json")
-                                with urllib.request.urlopen(req) as res:
-                                    final_manual_url = json.loads(res.read().decode("utf-8"))["content"]["html_url"].replace("https://github.com/", "https://cdn.jsdelivr.net/gh/").replace("/blob/", "@")
-                        
-                        elif save_mode == "3. 社内共有フォルダへ自動保存":
-                            target_dir = Path(local_path) / "manuals"
-                            target_dir.mkdir(parents=True, exist_ok=True)
-                            out_manual = target_dir / file_name_manual
-                            
-                            if manual_path.resolve() != out_manual.resolve():
-                                shutil.copy(manual_path, out_manual)
-                                
-                            local_ip = get_local_ip()
-                            final_manual_url = f"http://{local_ip}:8000/{file_name_manual}"
-
-                        qr_path = QR_DIR / f"{s_id}_qr.png"
-                        img_qr = make_optimized_qr(final_manual_url)
-                        img_qr.save(qr_path)
-                        
-                        label_img = create_label_image({"name": name, "power": power, "img_qr": img_qr})
-                        
-                        buf = io.BytesIO()
-                        label_img.save(buf, format="PNG")
-                        img_bytes = buf.getvalue()
-                        
-                        if btn_auto_print:
-                            add_label_to_history(name, label_img)
-
-                        df = pd.read_csv(DB_CSV)
-                        df = df[df["ID"].astype(str) != str(did)]
-                        JST = timezone(timedelta(hours=9)) 
-                        new_row = {
-                            "ID": did, "Name": name, "Power": power, "URL": final_manual_url, "Updated": datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S"),
-                            "memo": memo, "is_related_loto": is_related_loto, "img_exterior": fin_ext, "img_outlet": fin_out, "img_label": fin_lab, "img_loto1": fin_lo1, "img_loto2": fin_lo2,
-                            "extra_images": json.dumps(final_extra_images_db, ensure_ascii=False) 
-                        }
-                        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                        df.to_csv(DB_CSV, index=False)
-
-                        update_master_ledger_excel(df, save_mode, github_repo, github_token, local_path)
-
+                        res = register_device_auto({
+                            "did": did, "name": name, "power": power, "memo": memo, "is_related_loto": is_related_loto,
+                            "slots": panel["slots"], "extras": ex_imgs_to_save,
+                            "mode": save_mode, "repo": github_repo, "token": github_token, "local_path": local_path,
+                            "profile": manual_profile, "budget_kb": manual_budget_kb, "with_viewer": with_viewer,
+                            "use_permalink": use_permalink, "print_label": btn_auto_print
+                        })
+                        final_manual_url = res["manual_url"]
+                        reuse_note = "（内容に変更がないため、既存の機器情報ページとQRコードを再利用しました）" if res["reused"] else ""
+                        if not res["reused"] and res["qr_reused"] and use_permalink:
+                            reuse_note = "（QRコードは以前と同じ固定URLのため、貼付済みのラベルはそのまま使えます）"
                         if btn_auto_print:
-                            st.session_state.label_img_data = img_bytes
-                            st.session_state.label_msg = f"✅ 登録・ラベル発行完了！ 機器情報ページURL: {final_manual_url}"
+                            st.session_state.label_img_data = res["label_png"]
+                            st.session_state.label_msg = f"✅ 登録・ラベル発行完了！{reuse_note} 機器情報ページURL: {final_manual_url}"
                         else:
                             st.session_state.label_img_data = None
-                            st.session_state.label_msg = f"✅ データ保存のみ完了！（ラベル未発行） 機器情報ページURL: {final_manual_url}"
+                            st.session_state.label_msg = f"✅ データ保存のみ完了！（ラベル未発行）{reuse_note} 機器情報ページURL: {final_manual_url}"
                             
                         st.session_state.label_url = final_manual_url
                         
+                    except StageError as e:
+                        skipped = f"（未実行: {', '.join(e.skipped)}）" if e.skipped else ""
+                        st.error(f"エラーが発生しました（{e.stage}）: {e.cause}{skipped}")
                     except Exception as e:
                         st.error(f"エラーが発生しました: {str(e)}")
 
@@ -1052,28 +3768,10 @@ def main():
         uploaded_file = st.session_state.get(f"backup_up_{current_rk}")
         if uploaded_file is not None:
             try:
-                loaded_data = json.loads(uploaded_file.getvalue().decode("utf-8"))
-                
-                form_data = loaded_data.get("form", loaded_data) 
-                workspace_data = loaded_data.get("workspace", {})
-
-                if workspace_data:
-                    if "devices_csv" in workspace_data and workspace_data["devices_csv"]:
-                        with open(DB_CSV, "w", encoding="utf-8") as f:
-                            f.write(workspace_data["devices_csv"])
-                    
-                    label_imgs = workspace_data.get("label_images", {})
-                    for img_name, b64_str in label_imgs.items():
-                        try:
-                            with open(TEMP_LABEL_DIR / img_name, "wb") as f:
-                                f.write(base64.b64decode(b64_str))
-                        except: pass
-
-                    label_hist = workspace_data.get("label_history", [])
-                    with open(LABEL_HISTORY_FILE, "w", encoding="utf-8") as f:
-                        json.dump(label_hist, f, ensure_ascii=False, indent=2)
-                    
-                    rebuild_excel()
+                if zipfile.is_zipfile(uploaded_file):
+                    form_data, restored_imgs, restored_ex = restore_workspace_zip(uploaded_file)
+                else:
+                    form_data, restored_imgs, restored_ex = restore_workspace_json(uploaded_file.getvalue())
 
                 st.session_state.input_did = form_data.get("did", "")
                 st.session_state.input_name = form_data.get("name", "")
@@ -1081,32 +3779,8 @@ def main():
                 st.session_state.input_power = p_val if p_val in ["100V", "200V"] else None
                 st.session_state.input_memo = form_data.get("memo", "")
                 st.session_state.is_related_loto = form_data.get("is_related_loto", False)
-                
-                def decode_img(img_dict, prefix):
-                    if not img_dict: return ""
-                    if img_dict["type"] == "path": return img_dict["data"]
-                    if img_dict["type"] == "base64":
-                        try:
-                            b_data = base64.b64decode(img_dict["data"])
-                            temp_path = DRAFT_IMG_DIR / f"restored_{prefix}_{datetime.now().strftime('%H%M%S%f')}.jpg"
-                            with open(temp_path, "wb") as f: f.write(b_data)
-                            return str(temp_path)
-                        except: return ""
-                    return ""
-
-                restored_imgs = {}
-                d_imgs = form_data.get("existing_imgs", {})
-                restored_imgs["ext"] = decode_img(d_imgs.get("ext"), "ext")
-                restored_imgs["out"] = decode_img(d_imgs.get("out"), "out")
-                restored_imgs["lab"] = decode_img(d_imgs.get("lab"), "lab")
-                restored_imgs["lo1"] = decode_img(d_imgs.get("lo1"), "lo1")
-                restored_imgs["lo2"] = decode_img(d_imgs.get("lo2"), "lo2")
+
                 st.session_state.existing_imgs = restored_imgs
-                
-                restored_ex = []
-                for i, ex in enumerate(form_data.get("existing_ex_imgs", [])):
-                    path = decode_img(ex.get("img_data"), f"ex_{i}")
-                    restored_ex.append({"title": ex.get("title", ""), "url": path})
                 st.session_state.existing_ex_imgs = restored_ex
                 
                 st.session_state.extra_images_count = 0
@@ -1135,75 +3809,35 @@ def main():
         st.subheader("📝 現在の作業状態をPCに保存")
         st.info("入力中の文字・画像だけでなく、左側の「データベース」や右側の「Excel台帳」も含めて、今の環境をそのままファイルとしてPCにバックアップします。")
         
-        form_draft = {
-            "did": did, "name": name, "power": power, "memo": memo, "is_related_loto": is_related_loto,
-            "existing_imgs": {}, "existing_ex_imgs": [], "extra_images_count": st.session_state.extra_images_count
-        }
-        
-        def encode_img_fixed(f_obj, e_path):
-            if f_obj:
-                try:
-                    comp_bytes = compress_image(f_obj) 
-                    if comp_bytes:
-                        return {"type": "base64", "data": base64.b64encode(comp_bytes).decode("utf-8")}
-                except: pass
-            elif e_path:
-                return {"type": "path", "data": str(e_path)}
-            return None
-
-        form_draft["existing_imgs"]["ext"] = encode_img_fixed(f_ext, e_ext)
-        form_draft["existing_imgs"]["out"] = encode_img_fixed(f_out, e_out)
-        form_draft["existing_imgs"]["lab"] = encode_img_fixed(f_lab, e_lab)
-        form_draft["existing_imgs"]["lo1"] = encode_img_fixed(f_lo1, e_lo1)
-        form_draft["existing_imgs"]["lo2"] = encode_img_fixed(f_lo2, e_lo2)
-
-        ex_imgs = []
-        for item in ex_imgs_to_save:
-            enc = encode_img_fixed(item.get("file"), item.get("url", ""))
-            ex_imgs.append({"title": item.get("title", ""), "img_data": enc})
-        form_draft["existing_ex_imgs"] = ex_imgs
-        
-        csv_data_str = ""
-        if DB_CSV.exists():
-            with open(DB_CSV, "r", encoding="utf-8") as f: csv_data_str = f.read()
-
-        label_hist_data = []
-        if LABEL_HISTORY_FILE.exists():
-            try:
-                with open(LABEL_HISTORY_FILE, "r", encoding="utf-8") as f: label_hist_data = json.load(f)
-            except: pass
-
-        label_images_b64 = {}
-        for item in label_hist_data:
-            img_name = item.get("img_filename")
-            img_p = TEMP_LABEL_DIR / img_name
-            if img_p.exists():
-                with open(img_p, "rb") as f: label_images_b64[img_name] = base64.b64encode(f.read()).decode("utf-8")
-
-        backup_data = {
-            "form": form_draft,
-            "workspace": {
-                "devices_csv": csv_data_str,
-                "label_history": label_hist_data,
-                "label_images": label_images_b64
-            }
-        }
-        
-        backup_json_str = json.dumps(backup_data, ensure_ascii=False)
+        form_values = {"did": did, "name": name, "power": power, "memo": memo}
+
+        def current_workspace_backup():
+            # 画像の区画だけが再実行された後でも、その時点の指定内容で作る
+            values = {**form_values, "is_related_loto": image_inputs["is_related_loto"], "extra_images_count": image_inputs["extra_images_count"]}
+            form_imgs = {slot: (f, e) for slot, (f, _, e) in image_inputs["slots"].items()}
+            return build_workspace_backup(values, form_imgs, list(image_inputs["ex_imgs_to_save"]), incremental)
+        has_full = load_backup_index().get("last_full") is not None
+        backup_kind = st.radio(
+            "バックアップの種類", ["フル（すべて）", "差分（前回のフル以降に変わったファイルのみ）"],
+            index=0, horizontal=True, disabled=not has_full, key="backup_kind",
+            help="差分バックアップを復元するには、先に基準となるフルバックアップを復元してください。"
+        )
+        incremental = has_full and backup_kind.startswith("差分")
         JST = timezone(timedelta(hours=9)) 
-        dl_filename = f"QR管理システムBK_{datetime.now(JST).strftime('%Y%m%d_%H%M')}.json"
-        
+        dl_filename = f"QR管理システムBK_{datetime.now(JST).strftime('%Y%m%d_%H%M')}{'_差分' if incremental else ''}.zip"
+
+        # バックアップはボタンが押されたときにだけ生成する
         st.download_button(
-            label="💾 現在の状態を【ワークスペース保存(.json)】としてPCに保存",
-            data=backup_json_str,
+            label="💾 現在の状態を【ワークスペース保存(.zip)】としてPCに保存",
+            data=current_workspace_backup,
             file_name=dl_filename,
-            mime="application/json",
+            mime="application/zip",
             use_container_width=True
         )
         
         st.markdown("---")
         st.subheader("📂 PCに保存したバックアップを復元")
-        uploaded_backup = st.file_uploader("保存したファイル(.json)を選択", type=["json"], key=f"backup_up_{rk}")
+        uploaded_backup = st.file_uploader("保存したファイル(.zip / 旧形式の.json)を選択", type=["zip", "json"], key=f"backup_up_{rk}")
         if uploaded_backup:
             st.button("🔄 このバックアップ環境を復元する", type="primary", use_container_width=True, on_click=restore_backup_callback)
             
@@ -1213,79 +3847,144 @@ def main():
 
     with col_b:
         st.subheader("🔄 登録の完了・リセット")
-        st.info("💡 **データベースと印刷用台帳はフォルダ内に自動保存されています。**\n\n※入力途中のデータはブラウザを閉じるとリセットされるため、別のPCに作業を引き継ぐ際などは、左側の「ワークスペース保存(.json)」をご活用ください。")
+        st.info("💡 **データベースと印刷用台帳はフォルダ内に自動保存されています。**\n\n※入力途中のデータはブラウザを閉じるとリセットされるため、別のPCに作業を引き継ぐ際などは、左側の「ワークスペース保存(.zip)」をご活用ください。")
         
         st.button("🔄 次の機器を入力する (クリアして上へ戻る)", type="primary", use_container_width=True, on_click=reset_form_callback)
 
     # --- サイドバー：Excel台帳状況 ---
-    st.sidebar.markdown("---")
-    st.sidebar.subheader("🖨️ 印刷用Excel台帳の状況")
-    h_list = []
-    if LABEL_HISTORY_FILE.exists():
-        try:
-            with open(LABEL_HISTORY_FILE, "r", encoding="utf-8") as f: h_list = json.load(f)
-        except: pass
+    # ラベルの削除・台帳のリセットはこの区画だけを再実行する。Excel はダウンロード時にだけ読み込む
+    @panel_fragment("印刷用台帳")
+    def label_sheet_panel():
+        st.markdown("---")
+        st.subheader("🖨️ 印刷用Excel台帳の状況")
+        try: h_list = live_labels(load_label_index())
+        except LabelIndexError as e:
+            st.error(str(e))
+            return
     
-    c_len = len(h_list)
-    if c_len == 0: st.sidebar.info("🈳 現在、台帳は白紙です。")
-    else:
-        st.sidebar.success(f"✅ 合計 {c_len} 枚のラベルを配置済み")
-        cols = ((c_len - 1) // 13) + 1
-        grid_html = "<div style='background:#f0f2f6;padding:10px;border-radius:5px;font-size:13px;line-height:1.2;text-align:left;'>"
-        for r in range(13):
-            line = ""
-            for c in range(cols):
-                idx = c * 13 + r
-                if idx < c_len:
-                    num_icon = chr(9311 + idx + 1) if idx < 20 else f"({idx+1})"
-                    line += f"<span style='display:inline-block;width:26px;text-align:center;font-weight:bold;color:#d4af37;'>{num_icon}</span>"
-                else: line += "<span style='display:inline-block;width:26px;text-align:center;color:#ccc;'>⬜</span>"
-            grid_html += line + "<br>"
-        st.sidebar.markdown(grid_html + "</div>", unsafe_allow_html=True)
+        c_len = len(h_list)
+        if c_len == 0: st.info("🈳 現在、台帳は白紙です。")
+        else:
+            st.success(f"✅ 合計 {c_len} 枚のラベルを配置済み")
+            cols = ((c_len - 1) // 13) + 1
+            grid_html = "<div style='background:#f0f2f6;padding:10px;border-radius:5px;font-size:13px;line-height:1.2;text-align:left;'>"
+            for r in range(13):
+                line = ""
+                for c in range(cols):
+                    idx = c * 13 + r
+                    if idx < c_len:
+                        num_icon = chr(9311 + idx + 1) if idx < 20 else f"({idx+1})"
+                        line += f"<span style='display:inline-block;width:26px;text-align:center;font-weight:bold;color:#d4af37;'>{num_icon}</span>"
+                    else: line += "<span style='display:inline-block;width:26px;text-align:center;color:#ccc;'>⬜</span>"
+                grid_html += line + "<br>"
+            st.markdown(grid_html + "</div>", unsafe_allow_html=True)
         
-        for i, obj in enumerate(h_list):
-            cb1, cb2 = st.sidebar.columns([5, 1])
-            icon = chr(9311 + i + 1) if i < 20 else f"({i+1})"
-            cb1.markdown(f"<div style='display: flex; align-items: center; height: 32px; font-size: 15px;'>{icon} {obj['name']}</div>", unsafe_allow_html=True)
-            if cb2.button("❌", key=f"d_itm_{i}"): delete_label_from_history(i); st.rerun()
+            for i, obj in enumerate(h_list):
+                cb1, cb2 = st.columns([5, 1])
+                icon = chr(9311 + i + 1) if i < 20 else f"({i+1})"
+                cb1.markdown(f"<div style='display: flex; align-items: center; height: 32px; font-size: 15px;'>{icon} {obj['name']}</div>", unsafe_allow_html=True)
+                cb2.button("❌", key=f"d_itm_{i}", on_click=delete_label_from_history, args=(i,))
     
-    if EXCEL_LABEL_PATH.exists():
-        with open(EXCEL_LABEL_PATH, "rb") as f:
-            excel_data_labels = f.read()
-        JST = timezone(timedelta(hours=9)) 
-        st.sidebar.download_button(
-            label="📥 最新のExcelをダウンロード", 
-            data=excel_data_labels, 
-            file_name=f"印刷用Excel台帳_{datetime.now(JST).strftime('%Y%m%d_%H%M')}.xlsx", 
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
-            use_container_width=True
-        )
+        if EXCEL_LABEL_PATH.exists():
+            JST = timezone(timedelta(hours=9)) 
+            st.download_button(
+                label="📥 最新のExcelをダウンロード", 
+                data=lambda: EXCEL_LABEL_PATH.read_bytes(), 
+                file_name=f"印刷用Excel台帳_{datetime.now(JST).strftime('%Y%m%d_%H%M')}.xlsx", 
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
+                use_container_width=True
+            )
         
-        if st.sidebar.button("🗑️ 台帳をリセット", use_container_width=True):
-            clear_history()
-            st.rerun()
+            st.button("🗑️ 台帳をリセット", use_container_width=True, on_click=clear_history)
+
+    with st.sidebar:
+        label_sheet_panel()
 
     # --- マスター台帳ダウンロードボタンの追加 ---
+    # 台帳Excelは毎回の再実行では作らず、ダウンロードボタンが押されたときに作る
+    @panel_fragment("機器台帳マスター")
+    def ledger_panel():
+        st.markdown("---")
+        st.subheader("📊 機器台帳マスター")
+        if DB_CSV.exists():
+            try:
+                df_csv = load_devices()
+                if not df_csv.empty:
+                    JST = timezone(timedelta(hours=9)) 
+                    pending, errors = ledger_publish_status()
+                    for p in pending:
+                        st.caption(f"⏳ 台帳の公開待ち: {p['devices']} 件（約 {p['due_in']:.0f} 秒後にまとめて公開）")
+                    for dest, err in errors.items():
+                        st.warning(f"台帳の公開に失敗しました（次回に再試行）: {err}")
+                    st.download_button(
+                        label="📥 Excel形式でダウンロード",
+                        data=lambda: create_formatted_ledger_excel(load_devices()),
+                        file_name=f"機器台帳マスター_{datetime.now(JST).strftime('%Y%m%d_%H%M')}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        use_container_width=True
+                    )
+                else:
+                    st.info("登録されている機器がありません。")
+            except Exception as e:
+                st.error(f"台帳生成エラー: {e}")
+
+        # 静的ポータル：一度作成すると、以後は登録・削除のたびに変わった機器だけ自動で更新される
+        with st.expander("🌐 静的ポータル（一覧・検索ページ）"):
+            st.caption(f"出力先: {PORTAL_DIR}（社内Wi-Fi用サーバーでは {get_manual_server_base_url()}/portal/ ）")
+            c_p1, c_p2 = st.columns(2)
+            build = c_p1.button("更新", use_container_width=True, key="portal_build")
+            rebuild = c_p2.button("全て作り直す", use_container_width=True, key="portal_rebuild")
+            if build or rebuild:
+                try:
+                    with st.spinner("静的ポータルを作成中..."), span("静的ポータル作成"):
+                        res = build_portal(force=rebuild)
+                    st.success(f"✅ {res['devices']} 台（ページ更新 {res['pages']} / サムネイル {res['thumbs']} / 削除 {res['removed']}）{res['sec']:.1f} 秒")
+                except Exception as e:
+                    st.error(f"静的ポータルの作成エラー: {e}")
+
+    with st.sidebar:
+        ledger_panel()
+
+    # --- サイドバー：診断（処理時間・メモリ） ---
     st.sidebar.markdown("---")
-    st.sidebar.subheader("📊 機器台帳マスター")
-    if DB_CSV.exists():
-        try:
-            df_csv = pd.read_csv(DB_CSV)
-            if not df_csv.empty:
-                excel_data = create_formatted_ledger_excel(df_csv)
-                
-                JST = timezone(timedelta(hours=9)) 
-                st.sidebar.download_button(
-                    label="📥 Excel形式でダウンロード",
-                    data=excel_data,
-                    file_name=f"機器台帳マスター_{datetime.now(JST).strftime('%Y%m%d_%H%M')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True
-                )
-            else:
-                st.sidebar.info("登録されている機器がありません。")
-        except Exception as e:
-            st.sidebar.error(f"台帳生成エラー: {e}")
+    with st.sidebar.expander("🩺 診断（処理時間・メモリ）"):
+        stats = startup_stats()
+        st.caption(f"起動時間: import {stats['import_ms']:.0f} ms / 初回表示 {stats['first_run_ms'] or 0:.0f} ms　フォント: {stats['font']}")
+        st.checkbox("ピークメモリも計測する（処理が少し遅くなります）", key="metrics_track_memory")
+        st.checkbox("次の再実行をプロファイルする（cProfile）", key="profile_next_rerun")
+        if st.session_state.get("last_profile_path") and Path(st.session_state.last_profile_path).exists():
+            prof_path = Path(st.session_state.last_profile_path)
+            st.caption(f"プロファイル保存先: {prof_path}")
+            st.download_button("📥 プロファイル(.prof)をダウンロード", data=lambda p=prof_path: p.read_bytes(), file_name=prof_path.name, mime="application/octet-stream", use_container_width=True)
+
+        runs = get_metrics_runs()
+        kinds = sorted({r["kind"] for r in runs})
+        sel_kinds = st.multiselect("対象", kinds, default=[k for k in kinds if not k.startswith("再実行")] or kinds, key="metrics_kinds")
+        sel_runs = [r for r in runs if r["kind"] in sel_kinds]
+        if sel_runs:
+            st.caption(f"直近 {len(sel_runs)} 回の実行（最大 {METRICS_KEEP_RUNS} 回まで保持）")
+            st.dataframe(pd.DataFrame(summarize_stage_metrics(sel_runs)), hide_index=True, use_container_width=True)
+            last_cp = next((r for r in reversed(sel_runs) if r.get("critical_path")), None)
+            if last_cp:
+                st.caption("直近の登録で所要時間を決めた段階（クリティカルパス）: " + " → ".join(f"{c['stage']} {c['dur_ms']:.0f} ms" for c in last_cp["critical_path"]))
+            JST = timezone(timedelta(hours=9))
+            ts = datetime.now(JST).strftime('%Y%m%d_%H%M')
+            st.download_button("📥 計測データ(JSON)", data=lambda r=sel_runs: json.dumps(r, ensure_ascii=False, indent=1), file_name=f"metrics_{ts}.json", mime="application/json", use_container_width=True)
+            st.download_button("📥 Chromeトレース形式", data=lambda r=sel_runs: json.dumps(metrics_to_chrome_trace(r)), file_name=f"trace_{ts}.json", mime="application/json", use_container_width=True)
+        else:
+            st.info("まだ計測データがありません。")
+
+def run_app():
+    stats = startup_stats()
+    track_mem = st.session_state.get("metrics_track_memory", False)
+    with metrics_run("再実行", track_mem):
+        main()
+    if stats["first_run_ms"] is None:
+        stats["first_run_ms"] = round((time.perf_counter() - APP_IMPORT_STARTED) * 1000, 1)
 
 if __name__ == "__main__":
-    main()
+    if st.session_state.get("profile_next_rerun"):
+        st.session_state.profile_next_rerun = False
+        run_profiled(run_app)
+    else:
+        run_app()
@@ -0,0 +1,50 @@
+# ==========================================
+# --- 静的ポータルの書き出し（コマンドライン） ---
+# ==========================================
+# devices.csv と manuals/ から、検索付きの機器一覧・機器ごとのページ・サムネイルを書き出す。
+# 出力はただのファイルなので、社内Wi-Fi用サーバー（http://<IP>:8000/portal/）でも、
+# 任意のファイルサーバー・共有フォルダにコピーしてもそのまま開ける。
+#
+# 使い方:
+#   python export_portal.py                          # manuals/portal に差分だけ書き出す
+#   python export_portal.py --out \\\\server\\share\\portal
+#   python export_portal.py --force                  # 全ページ・サムネイルを作り直す
+#
+# 機器ごとの指紋（機器情報・機器情報ページ画像・サムネイル元画像）を出力先の .portal_state.json に
+# 記録し、前回から変わっていない機器のページは書き直さない。
+import argparse
+import os
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+
+
+def load_app():
+    sys.path.insert(0, str(REPO_DIR))
+    os.environ.setdefault("QR_MANUAL_SERVER_PORT", "0")  # 起動中のアプリとポートが衝突しないようにする
+    import equipment_qr_manager as app
+    app.ensure_work_dirs()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="機器情報の静的ポータルを書き出す")
+    parser.add_argument("--workdir", default=".", help="devices.csv のある作業フォルダ")
+    parser.add_argument("--out", default=None, help="出力先フォルダ（既定: manuals/portal）")
+    parser.add_argument("--force", action="store_true", help="変更が無くても全て作り直す")
+    parser.add_argument("--workers", type=int, default=None, help="サムネイル作成の並列数")
+    args = parser.parse_args()
+
+    os.chdir(args.workdir)
+    app = load_app()
+    if not app.DB_CSV.exists():
+        sys.exit(f"{app.DB_CSV} が見つかりません（--workdir を確認してください）")
+    out = Path(args.out) if args.out else app.PORTAL_DIR
+    res = app.build_portal(out, force=args.force, workers=args.workers)
+    print(f"{res['devices']} 台: ページ更新 {res['pages']} / サムネイル {res['thumbs']} / 画像 {res['manuals']} / 削除 {res['removed']}  ({res['sec']:.2f} 秒)")
+    print(f"出力先: {out.resolve() / 'index.html'}")
+
+
+if __name__ == "__main__":
+    main()
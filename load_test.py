@@ -0,0 +1,344 @@
+# ==========================================
+# --- 負荷試験（QR読み取りの集中 ＋ 同時登録） ---
+# ==========================================
+# 交代時に多数のスマホが一斉にQRコードを読み取る状況を、手元で再現する。
+# 社内Wi-Fi用サーバーへの N 台分の読み取りと、M 人分の同時登録（画像圧縮→機器情報ページ作成→公開→
+# QR→ラベル→台帳）を同じプロセス内で同時に流し、スループット・遅延の分布・エラー数・メモリを表示する。
+# GitHub / CDN / 短縮URL は stub_servers.py のスタブに置き換えるため、外部には一切接続しない。
+#
+# 使い方:
+#   python load_test.py                                   # 読み取り 50 台 × 20 秒、同時登録 4 人 × 3 件
+#   python load_test.py --scanners 100 --duration 60 --think 0.5
+#   python load_test.py --mode github --fail-rate 0.2 --latency 0.3    # GitHub 保存（送信待ち行列）で試す
+#   python load_test.py --json load_results.json          # 結果を保存（変更前後の比較用）
+#
+# 作業ファイルは一時ディレクトリに作られ、リポジトリ内のデータは変更しない。
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+CORPUS_DIR = REPO_DIR / "images"
+SAVE_MODES = {"github": "2. 全自動（データベース保存）", "shared": "3. 社内共有フォルダへ自動保存"}
+STUB_REPO = "load-test/qr-manager"
+ASSET_RE = re.compile(r'(?:src|href)="([^"#?]+\.(?:jpg|jpeg|webp|png))"', re.IGNORECASE)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def load_app(workdir, port):
+    os.chdir(workdir)
+    os.environ["QR_MANUAL_SERVER_PORT"] = str(port)
+    os.environ["QR_MANUAL_SERVER_BIND"] = "127.0.0.1"
+    os.environ.setdefault("QR_MANUAL_SERVER_ACCESS_LOG", str(Path(workdir) / "access.log"))  # 1リクエスト1行の表示で結果が埋もれないようにする
+    sys.path.insert(0, str(REPO_DIR))
+    import equipment_qr_manager as app
+    app.ensure_work_dirs()
+    return app
+
+
+def rss_mb():
+    # プロセス全体の常駐メモリ。psutil が無ければ /proc（Linux）、それも無ければ計測しない
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class UploadFile(io.BytesIO):
+    # Streamlit の UploadedFile の代わり（getvalue / name / file_id だけを使う）
+    def __init__(self, path, file_id):
+        super().__init__(Path(path).read_bytes())
+        self.name = Path(path).name
+        self.file_id = file_id
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}   # 種類 -> [(完了時刻, ms, bytes, ok)]
+        self.errors = {}    # 種類 -> {内容: 件数}
+
+    def add(self, kind, ms, nbytes=0, error=None):
+        with self.lock:
+            self.samples.setdefault(kind, []).append((time.perf_counter(), ms, nbytes, error is None))
+            if error is not None:
+                errs = self.errors.setdefault(kind, {})
+                errs[error] = errs.get(error, 0) + 1
+
+    def summary(self, kind, elapsed):
+        ss = self.samples.get(kind, [])
+        durs = sorted(ms for _, ms, _, ok in ss if ok)
+        pct = lambda p: round(durs[max(0, min(len(durs) - 1, int(round(p / 100 * len(durs) + 0.5)) - 1))], 1) if durs else None
+        return {
+            "count": len(ss), "ok": len(durs), "errors": len(ss) - len(durs),
+            "per_sec": round(len(durs) / elapsed, 1) if elapsed else None,
+            "mb_per_sec": round(sum(b for _, _, b, ok in ss if ok) / elapsed / 1024 / 1024, 2) if elapsed else None,
+            "p50_ms": pct(50), "p90_ms": pct(90), "p95_ms": pct(95), "p99_ms": pct(99), "max_ms": round(durs[-1], 1) if durs else None,
+            "mean_ms": round(statistics.fmean(durs), 1) if durs else None,
+            "error_kinds": dict(sorted(self.errors.get(kind, {}).items(), key=lambda kv: -kv[1])),
+        }
+
+
+def pad(text, width, right=False):
+    # 全角文字を2桁として数え、表の列を揃える
+    w = sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in str(text))
+    fill = " " * max(0, width - w)
+    return fill + str(text) if right else str(text) + fill
+
+
+def fetch(url, timeout):
+    t = time.perf_counter()
+    try:
+        req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0 (load_test)"})
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            body = res.read()
+            final_url = res.geturl()  # 固定URL（/d/…）は転送先
+        return (time.perf_counter() - t) * 1000, body, None, final_url
+    except urllib.error.HTTPError as e:
+        return (time.perf_counter() - t) * 1000, b"", f"HTTP {e.code}", url
+    except Exception as e:
+        return (time.perf_counter() - t) * 1000, b"", type(e).__name__, url
+
+
+# ==========================================
+# --- 準備：読み取り対象の機器情報ページ ---
+# ==========================================
+def seed_devices(app, n, images, with_viewer_ratio, permalink=False):
+    # 読み取り対象の機器情報ページを社内配信フォルダ（manuals/）に作っておく
+    targets = []
+    for i in range(n):
+        img = str(images[i % len(images)])
+        data = {"id": f"SCAN{i:03d}", "name": f"読み取り試験機 {i}", "power": "200V", "memo": "負荷試験用", "is_related_loto": False,
+                "img_exterior": img, "img_outlet": str(images[(i + 1) % len(images)]), "img_label": None, "img_loto1": None, "img_loto2": None}
+        with_viewer = i < n * with_viewer_ratio
+        out = app.MANUAL_DIR / f"SCAN{i:03d}_0800.jpg"
+        app.create_manual_image_extended(data, [(str(images[(i + 2) % len(images)]), "追加画像")], out, with_viewer=with_viewer)
+        published = out.with_suffix(".html").name if with_viewer else out.name
+        url = f"{app.get_manual_server_base_url()}/{urllib.parse.quote(published)}"
+        app.put_device({"ID": data["id"], "Name": data["name"], "Power": data["power"], "URL": url,
+                        "Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "memo": data["memo"], "img_exterior": img})
+        targets.append(app.permalink_url(data["id"]) if permalink else url)
+    return targets
+
+
+# ==========================================
+# --- 読み取り（スマホ1台 = 1スレッド） ---
+# ==========================================
+def scanner(targets, rec, stop, think, timeout, rng):
+    # QRを読む → ページを開く → HTML版ならページ内の画像も読む、を繰り返す。
+    # よく使う機器ほど読まれるよう、先頭側に偏らせて選ぶ
+    while not stop.is_set():
+        url = targets[min(len(targets) - 1, int(rng.expovariate(4.0 / len(targets))))]
+        t = time.perf_counter()
+        ms, body, err, page_url = fetch(url, timeout)
+        rec.add("ページ", ms, len(body), err)
+        if err is None and page_url.endswith(".html"):
+            for src in dict.fromkeys(ASSET_RE.findall(body.decode("utf-8", "replace"))):
+                ms, abody, aerr, _ = fetch(urllib.parse.urljoin(page_url, src), timeout)
+                rec.add("ページ内画像", ms, len(abody), aerr)
+                err = err or aerr
+        rec.add("読み取り1回（画像込み）", (time.perf_counter() - t) * 1000, 0, err)
+        if think: stop.wait(rng.uniform(0, 2 * think))
+
+
+# ==========================================
+# --- 登録（画面の「画像保存＆ラベル発行（全自動）」と同じ処理順） ---
+# ==========================================
+def register_device(app, did, image_paths, mode, repo, token, local_path, with_viewer):
+    # 画面の「全自動」登録と同じ段階実行の処理を呼ぶ
+    with app.metrics_run("負荷試験:登録"):
+        slots = {slot: (None, False, "") for slot in app.REGISTER_IMG_FIELDS}
+        for slot, path in zip(("ext", "out", "lab"), image_paths):
+            slots[slot] = (UploadFile(path, f"{did}-{slot}"), False, "")
+        res = app.register_device_auto({
+            "did": did, "name": f"同時登録 {did}", "power": "100V", "memo": "負荷試験で登録", "is_related_loto": False,
+            "slots": slots, "extras": [], "mode": mode, "repo": repo, "token": token, "local_path": local_path,
+            "profile": app.MANUAL_DEFAULT_PROFILE, "budget_kb": app.MANUAL_DEFAULT_BUDGET_KB, "with_viewer": with_viewer,
+            "use_permalink": False, "print_label": True
+        })
+        return res["manual_url"]
+
+
+def registration_worker(app, jobs, rec, args, images, local_path, token):
+    while True:
+        try: n = jobs.pop()
+        except IndexError: return
+        paths = [images[(n * 3 + k) % len(images)] for k in range(3)]
+        t = time.perf_counter()
+        try:
+            register_device(app, f"LT{n:04d}", paths, SAVE_MODES[args.mode], STUB_REPO, token, local_path, n % 2 == 0)
+            rec.add("登録", (time.perf_counter() - t) * 1000)
+        except Exception as e:
+            rec.add("登録", (time.perf_counter() - t) * 1000, error=f"{type(e).__name__}: {e}"[:120])
+
+
+# ==========================================
+# --- 実行と結果表示 ---
+# ==========================================
+def memory_sampler(stop, out, interval=0.2):
+    while not stop.is_set():
+        v = rss_mb()
+        if v is not None: out.append(v)
+        stop.wait(interval)
+
+
+def run(args, workdir):
+    from stub_servers import start_stub_servers, stub_env
+    stub, stub_base = start_stub_servers(fail_rate=args.fail_rate, latency=args.latency)
+    os.environ.update(stub_env(stub_base))
+    port = args.port or free_port()
+    app = load_app(workdir, port)
+    images = sorted(CORPUS_DIR.glob("*.jpg"))
+    if not images: sys.exit(f"{CORPUS_DIR} に試験用の写真（*.jpg）がありません")
+    local_path = str(Path(workdir) / "share")
+    token = "load-test-token"
+    app.outbox_set_credentials(STUB_REPO, token)
+
+    print(f"準備: 読み取り対象 {args.devices} 台分の機器情報ページを作成中...", flush=True)
+    t = time.perf_counter()
+    targets = seed_devices(app, args.devices, images, args.viewer_ratio, args.permalink)
+    app.start_local_image_server("127.0.0.1", port)
+    print(f"  {time.perf_counter() - t:.1f} 秒  配信: {app.get_manual_server_base_url()}  スタブ: {stub_base}", flush=True)
+    for _ in range(50):
+        if fetch(targets[0], 2)[2] is None: break
+        time.sleep(0.1)
+
+    if args.mode == "github": app.outbox_worker()
+    if args.trace_memory: tracemalloc.start()
+    rec, mem = Recorder(), []
+    stop, mem_stop = threading.Event(), threading.Event()
+    threading.Thread(target=memory_sampler, args=(mem_stop, mem), daemon=True).start()
+    rss_before = rss_mb()
+    jobs = list(range(args.registrations))[::-1]
+
+    print(f"実行: 読み取り {args.scanners} 台 × {args.duration} 秒 / 同時登録 {args.workers} 人 × 計 {args.registrations} 件（{args.mode}）", flush=True)
+    t0 = time.perf_counter()
+    scan_pool = ThreadPoolExecutor(args.scanners, thread_name_prefix="scan")
+    for i in range(args.scanners):
+        scan_pool.submit(scanner, targets, rec, stop, args.think, args.timeout, random.Random(args.seed + i))
+    reg_pool = ThreadPoolExecutor(max(1, args.workers), thread_name_prefix="reg")
+    reg_futs = [reg_pool.submit(registration_worker, app, jobs, rec, args, images, local_path, token) for _ in range(args.workers)]
+    time.sleep(args.duration)
+    for f in reg_futs: f.result()  # 登録が残っていれば終わるまで読み取りも続ける
+    stop.set()
+    scan_pool.shutdown(wait=True)
+    reg_pool.shutdown(wait=True)
+    elapsed = time.perf_counter() - t0
+    mem_stop.set()
+    heap_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if args.trace_memory else None
+    if args.trace_memory: tracemalloc.stop()
+
+    drain = None
+    if args.mode == "github":
+        t = time.perf_counter()
+        left = app.drain_outbox(args.drain_timeout)
+        drain = {"sec": round(time.perf_counter() - t, 2), "left": left}
+    pub = app.ledger_publisher()
+    app.flush_all_ledger_publishes(pub)
+
+    labels = len(app.live_labels(app.load_label_index()))
+    registered = app.load_devices()["ID"].astype(str).str.startswith("LT").sum()
+    stage_rows = app.summarize_stage_metrics([r for r in app.get_metrics_runs() if r["kind"] == "負荷試験:登録"])
+    return {
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "args": {k: v for k, v in vars(args).items() if k not in ("json", "keep")},
+        "elapsed_sec": round(elapsed, 2),
+        "requests": {kind: rec.summary(kind, elapsed) for kind in ("ページ", "ページ内画像", "読み取り1回（画像込み）", "登録")},
+        "stages": stage_rows,
+        "consistency": {"expected": args.registrations, "devices_saved": int(registered), "labels_in_history": labels},
+        "memory_mb": {"rss_before": round(rss_before, 1) if rss_before else None, "rss_peak": round(max(mem), 1) if mem else None,
+                      "rss_end": round(mem[-1], 1) if mem else None, "python_heap_peak": round(heap_peak, 1) if heap_peak is not None else None},
+        "outbox": drain,
+        "stub_calls": dict(stub.stub.calls),
+    }
+
+
+def print_report(res):
+    print(f"\n=== 結果（{res['elapsed_sec']} 秒） ===")
+    print(pad("種類", 24) + "".join(pad(h, w, True) for h, w in [("件数", 7), ("エラー", 7), ("件/秒", 8), ("MB/秒", 8), ("p50", 9), ("p90", 9), ("p95", 9), ("p99", 9), ("最大", 9)]) + "  (ms)")
+    for kind, s in res["requests"].items():
+        if not s["count"]: continue
+        cols = [s[k] if s[k] is not None else "-" for k in ("p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(f"{pad(kind, 24)}{s['count']:>7}{s['errors']:>7}{s['per_sec']:>8}{s['mb_per_sec']:>8}" + "".join(f"{c:>9}" for c in cols))
+        for err, n in list(s["error_kinds"].items())[:5]:
+            print(f"    {n:>5} × {err}")
+    if res["stages"]:
+        print("\n登録の内訳（p50 / p95 ms）:")
+        for r in res["stages"][:12]:
+            print(f"  {pad(r['処理'], 30)}{r['回数']:>5} 回 {r['p50 (ms)']:>9} {r['p95 (ms)']:>9}")
+    c = res["consistency"]
+    mark = "OK" if c["expected"] == c["devices_saved"] == c["labels_in_history"] else "不一致"
+    print(f"\n整合性: 登録 {c['expected']} 件 → 台帳 {c['devices_saved']} 件 / ラベル履歴 {c['labels_in_history']} 件  [{mark}]")
+    m = res["memory_mb"]
+    print(f"メモリ (MB): 開始 {m['rss_before']} / ピーク {m['rss_peak']} / 終了 {m['rss_end']}" + (f" / Pythonヒープのピーク {m['python_heap_peak']}" if m["python_heap_peak"] is not None else ""))
+    if res["outbox"]:
+        print(f"送信待ち: 送り切るまで {res['outbox']['sec']} 秒（残り {res['outbox']['left']} 件）")
+    print(f"スタブへの呼び出し: {res['stub_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="社内Wi-Fi用サーバーへの読み取り集中と同時登録の負荷試験")
+    parser.add_argument("--scanners", type=int, default=50, help="同時に読み取るスマホの台数")
+    parser.add_argument("--duration", type=float, default=20, help="読み取りを続ける秒数（登録が残っていれば終わるまで延長）")
+    parser.add_argument("--think", type=float, default=0.0, help="1台が次に読み取るまでの平均待ち秒数（0 = 連続）")
+    parser.add_argument("--devices", type=int, default=20, help="読み取り対象の機器数")
+    parser.add_argument("--permalink", action="store_true", help="固定URL（/d/管理番号）から転送させて読み取る")
+    parser.add_argument("--viewer-ratio", type=float, default=0.5, help="読み取り対象のうち HTML版ページの割合")
+    parser.add_argument("--workers", type=int, default=4, help="同時に登録する人数")
+    parser.add_argument("--registrations", type=int, default=12, help="登録する件数の合計")
+    parser.add_argument("--mode", choices=list(SAVE_MODES), default="shared", help="登録の保存先（shared / github）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="スタブの API 呼び出しを失敗させる確率")
+    parser.add_argument("--latency", type=float, default=0.0, help="スタブの API 応答の平均遅延 (秒)")
+    parser.add_argument("--drain-timeout", type=int, default=120, help="github モードで送信待ちを送り切るまで待つ秒数")
+    parser.add_argument("--timeout", type=float, default=10, help="読み取り1リクエストのタイムアウト (秒)")
+    parser.add_argument("--port", type=int, default=0, help="配信サーバーのポート（既定: 空きポート）")
+    parser.add_argument("--trace-memory", action="store_true", help="Pythonヒープのピークも計測する（遅くなる）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default=None, help="結果を保存する JSON ファイル")
+    parser.add_argument("--keep", action="store_true", help="作業用の一時ディレクトリを削除しない")
+    args = parser.parse_args()
+    json_path = Path(args.json).resolve() if args.json else None
+
+    workdir = tempfile.mkdtemp(prefix="qr_load_")
+    try:
+        res = run(args, workdir)
+        print_report(res)
+        if json_path:
+            with open(json_path, "w", encoding="utf-8") as f: json.dump(res, f, ensure_ascii=False, indent=1)
+            print(f"\n保存: {json_path}")
+    finally:
+        os.chdir(REPO_DIR)
+        if args.keep: print(f"作業ディレクトリ: {workdir}")
+        else: shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
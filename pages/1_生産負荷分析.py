@@ -0,0 +1,86 @@
+import streamlit as st
+import pandas as pd
+import plotly.express as px
+
+import production_analytics as pa
+from equipment_qr_manager import load_devices, DB_CSV
+
+# ==========================================
+# --- 生産負荷ダッシュボード ---
+# ==========================================
+st.set_page_config(page_title="生産負荷分析", page_icon="icon.ico", layout="wide")
+st.title("📈 生産負荷分析（成形機トン数別）")
+
+if not pa.PRODUCTS_JSON.exists():
+    st.error(f"{pa.PRODUCTS_JSON} が見つかりません。")
+    st.stop()
+
+devices = load_devices() if DB_CSV.exists() else None
+try:
+    result = pa.analyze(devices)
+except Exception as e:
+    st.error(f"{pa.PRODUCTS_JSON} の読み込みエラー: {e}")
+    st.stop()
+
+products = result["products"]
+load = result["tonnage"]
+totals = result["totals"]
+
+c1, c2, c3, c4 = st.columns(4)
+c1.metric("品番数", f"{totals['parts']:,}")
+c2.metric("機械稼働時間（1ロット分合計）", f"{totals['machine_hours']:,.1f} h")
+c3.metric("測定数合計", f"{totals['measurements']:,.0f}")
+c4.metric("登録機器（トン数判明）", f"{int(result['devices']['tonnage'].notna().sum())} 台")
+
+if result["unmatched_tonnage"]:
+    st.warning("登録機器が見つからないトン数クラス: " + "、".join(f"{t}t" for t in result["unmatched_tonnage"]) + "（機器名称にトン数を含めると紐付けられます）")
+
+load_view = load.assign(クラス=load["tonnage"].astype(str) + "t")
+
+st.subheader("トン数クラス別の負荷")
+g1, g2 = st.columns(2)
+with g1:
+    fig = px.bar(load_view, x="クラス", y="machine_hours", color="measurements_per_hour",
+                 labels={"machine_hours": "稼働時間 (h)", "measurements_per_hour": "測定数/h"},
+                 title="稼働時間（色: 稼働1時間あたりの測定数）")
+    st.plotly_chart(fig, use_container_width=True)
+with g2:
+    fig = px.bar(load_view, x="クラス", y="hours_per_device", text="devices",
+                 labels={"hours_per_device": "1台あたり稼働時間 (h)", "devices": "登録台数"},
+                 title="登録機器1台あたりの稼働時間（数字: 登録台数）")
+    st.plotly_chart(fig, use_container_width=True)
+
+st.dataframe(load_view.rename(columns={
+    "parts": "品番数", "total_qty": "ロット数合計", "machine_hours": "稼働時間(h)", "mean_cycle": "平均サイクル(秒)",
+    "measurements": "測定数", "devices": "登録台数", "share": "稼働比率", "hours_per_device": "1台あたり(h)", "measurements_per_hour": "測定数/h",
+}).drop(columns=["tonnage"]).set_index("クラス"), use_container_width=True)
+
+st.subheader("品番別")
+fig = px.scatter(products.dropna(subset=["machine_hours"]), x="cycle", y="qty", size="machine_hours", color="machine", hover_name="part",
+                 labels={"cycle": "サイクル (秒)", "qty": "ロット数", "machine": "成形機"}, title="サイクルとロット数（円の大きさ: 稼働時間）")
+st.plotly_chart(fig, use_container_width=True)
+
+# --- 登録機器との紐付け ---
+st.subheader("登録機器ごとの負荷")
+dev = result["devices"]
+if dev.empty:
+    st.info("登録されている機器がありません。")
+else:
+    options = (dev["ID"] + " : " + dev["Name"].astype(str)).tolist()
+    sel = st.selectbox("機器を選択:", options)
+    row = dev.iloc[options.index(sel)]
+    if pd.isna(row["tonnage"]):
+        st.info("機器名称からトン数を判別できません（例: 「160t取出機」）。")
+    else:
+        t = int(row["tonnage"])
+        m1, m2, m3 = st.columns(3)
+        m1.metric("トン数クラス", f"{t}t")
+        m2.metric("同クラスの登録台数", f"{int(row['devices'])} 台")
+        m3.metric("1台あたり稼働時間", f"{row['hours_per_device']:,.1f} h" if pd.notna(row["hours_per_device"]) else "-")
+        parts = pa.parts_for_tonnage(products, t)
+        if parts.empty:
+            st.caption("このトン数クラスの品番はありません。")
+        else:
+            st.dataframe(parts.rename(columns={"part": "品番", "machine": "成形機", "qty": "ロット数", "cycle": "サイクル(秒)", "measurements": "測定数", "machine_hours": "稼働時間(h)", "measurements_per_hour": "測定数/h"}).drop(columns=["tonnage"]), hide_index=True, use_container_width=True)
+    with st.expander("全機器の一覧"):
+        st.dataframe(dev.rename(columns={"tonnage": "トン数", "parts": "品番数", "machine_hours": "クラス稼働時間(h)", "devices": "同クラス台数", "hours_per_device": "1台あたり(h)", "measurements": "クラス測定数", "measurements_per_device": "1台あたり測定数"}), hide_index=True, use_container_width=True)
@@ -0,0 +1,106 @@
+# ==========================================
+# --- 生産負荷分析（mfr_products.json） ---
+# ==========================================
+# mfr_products.json（品番 → 成形機トン数 machine / ロット数 qty / サイクル秒 cycle / 測定数 measurements）
+# から、品番ごとの機械稼働時間と、トン数クラスごとの負荷・測定工数を集計する。
+# 計算はすべて列単位（pandas / NumPy）で行い、JSON の更新時刻とサイズが変わったときだけ読み直す。
+# 機器台帳とは機器名称に含まれるトン数（例: "160t取出機" → 160）で結び付ける。
+import functools
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PRODUCTS_JSON = Path("mfr_products.json")
+TONNAGE_RE = r"(\d+)\s*[tT]"
+PRODUCT_COLUMNS = ["part", "machine", "tonnage", "qty", "cycle", "measurements", "machine_hours", "measurements_per_hour"]
+
+
+def products_frame(raw):
+    # 品番ごとの辞書を1つの表にまとめ、数値化できない値は NaN として扱う
+    df = pd.DataFrame.from_dict(raw, orient="index")
+    if df.empty:
+        return pd.DataFrame(columns=PRODUCT_COLUMNS)
+    df = df.rename_axis("part").reset_index()
+    for col in ("machine", "qty", "cycle", "measurements"):
+        if col not in df.columns: df[col] = np.nan
+    df["machine"] = df["machine"].astype(str)
+    df["tonnage"] = pd.to_numeric(df["machine"].str.extract(TONNAGE_RE, expand=False), errors="coerce").astype("Int64")
+    for col in ("qty", "cycle", "measurements"):
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    # 1ロットあたりの機械稼働時間（時間）と、稼働1時間あたりの測定数
+    df["machine_hours"] = df["qty"] * df["cycle"] / 3600.0
+    df["measurements_per_hour"] = df["measurements"] / df["machine_hours"].replace(0, np.nan)
+    return df[PRODUCT_COLUMNS]
+
+
+@functools.lru_cache(maxsize=8)
+def cached_products(path, mtime_ns, size):
+    with open(path, "r", encoding="utf-8") as f:
+        return products_frame(json.load(f))
+
+
+def load_products(path=PRODUCTS_JSON):
+    # ファイルの (更新時刻, サイズ) をキャッシュキーにするため、内容が変わった時だけ再計算される
+    st_ = os.stat(path)
+    return cached_products(str(Path(path).resolve()), st_.st_mtime_ns, st_.st_size).copy()
+
+
+def devices_with_tonnage(devices):
+    # 機器台帳の機器名称からトン数を取り出す（"550t金型反転機" → 550）
+    if devices is None or devices.empty:
+        return pd.DataFrame(columns=["ID", "Name", "tonnage"])
+    out = devices[["ID", "Name"]].copy()
+    out["ID"] = out["ID"].astype(str)
+    out["tonnage"] = pd.to_numeric(out["Name"].astype(str).str.extract(TONNAGE_RE, expand=False), errors="coerce").astype("Int64")
+    return out
+
+
+def tonnage_load(products, devices=None):
+    # トン数クラスごとの品番数・稼働時間・測定数と、登録機器1台あたりの稼働時間
+    grouped = products.dropna(subset=["tonnage"]).groupby("tonnage", sort=True).agg(
+        parts=("part", "count"), total_qty=("qty", "sum"), machine_hours=("machine_hours", "sum"),
+        mean_cycle=("cycle", "mean"), measurements=("measurements", "sum"),
+    )
+    dev = devices_with_tonnage(devices)
+    counts = dev.dropna(subset=["tonnage"]).groupby("tonnage").size().rename("devices")
+    result = grouped.join(counts, how="outer").fillna({"parts": 0, "total_qty": 0, "machine_hours": 0.0, "measurements": 0, "devices": 0})
+    result["devices"] = result["devices"].astype(int)
+    result["parts"] = result["parts"].astype(int)
+    total_hours = result["machine_hours"].sum()
+    result["share"] = result["machine_hours"] / total_hours if total_hours else 0.0
+    result["hours_per_device"] = result["machine_hours"] / result["devices"].replace(0, np.nan)
+    result["measurements_per_hour"] = result["measurements"] / result["machine_hours"].replace(0, np.nan)
+    return result.reset_index().rename(columns={"index": "tonnage"})
+
+
+def device_load(products, devices):
+    # 登録機器ごとに、同じトン数クラスの負荷を台数で等分した値を割り当てる
+    dev = devices_with_tonnage(devices)
+    load = tonnage_load(products, devices)[["tonnage", "parts", "machine_hours", "devices", "hours_per_device", "measurements"]]
+    out = dev.merge(load, on="tonnage", how="left")
+    out["measurements_per_device"] = out["measurements"] / out["devices"].replace(0, np.nan)
+    return out
+
+
+def parts_for_tonnage(products, tonnage):
+    return products[products["tonnage"] == tonnage].sort_values("machine_hours", ascending=False)
+
+
+def analyze(devices=None, path=PRODUCTS_JSON):
+    products = load_products(path)
+    load = tonnage_load(products, devices)
+    unmatched = load[(load["parts"] > 0) & (load["devices"] == 0)]["tonnage"].tolist()
+    return {
+        "products": products,
+        "tonnage": load,
+        "devices": device_load(products, devices),
+        "unmatched_tonnage": unmatched,
+        "totals": {
+            "parts": int(len(products)),
+            "machine_hours": float(products["machine_hours"].sum()),
+            "measurements": float(products["measurements"].sum()),
+        },
+    }
@@ -0,0 +1,195 @@
+# ==========================================
+# --- 機器情報ページの一括再生成（コマンドライン） ---
+# ==========================================
+# レイアウトや文言を変更したときに、devices.csv の全機器の機器情報ページを作り直す。
+# 公開済みのファイル名（devices.csv の URL 列）へ上書き公開するため、貼付済みのQRコードはそのまま使える。
+#
+# 使い方:
+#   python regenerate_manuals.py --mode shared --local-path "\\\\server\\share\\qr"
+#   python regenerate_manuals.py --mode github --repo equipment-portal/qr-manager   # トークンは QR_GITHUB_TOKEN
+#   python regenerate_manuals.py --since 2026-01-01 --ids 12HR 15 --workers 4
+#   python regenerate_manuals.py --dry-run                                          # 対象の確認のみ
+#
+# 入力内容（機器情報・画像・テンプレートバージョン・出力設定・公開先）のハッシュを
+# manual_regen_state.json に記録し、前回から変わっていない機器はスキップする（--force で全件）。
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+STATE_FILE = Path("manual_regen_state.json")
+SAVE_MODES = {"github": "2. 全自動（データベース保存）", "shared": "3. 社内共有フォルダへ自動保存"}
+
+
+def load_app():
+    sys.path.insert(0, str(REPO_DIR))
+    import equipment_qr_manager as app
+    app.ensure_work_dirs()
+    return app
+
+
+def cell(row, key):
+    v = row.get(key)
+    if v is None or (isinstance(v, float) and v != v): return ""
+    return str(v)
+
+
+def row_to_job(app, row, profile, budget_kb, target):
+    # 公開先URLのファイル名が本アプリの命名（{ID}_....jpg / .html）でない行は、手動登録などで
+    # 別の場所を指しているため再生成しても反映できない
+    did = cell(row, "ID")
+    url = cell(row, "URL")
+    published = urllib.parse.unquote(Path(urllib.parse.urlparse(url).path).name) if url else ""
+    prefix = app.safe_filename(did) + "_"
+    if not published.startswith(prefix) or Path(published).suffix.lower() not in (".jpg", ".html"):
+        return None, "公開先URLが機器情報ページではありません"
+
+    with_viewer = published.lower().endswith(".html")
+    try:
+        extras = [(e.get("url"), e.get("title", "")) for e in json.loads(cell(row, "extra_images") or "[]")]
+    except ValueError:
+        extras = []
+    data = {
+        "id": did, "name": cell(row, "Name"), "power": cell(row, "Power"), "memo": cell(row, "memo"),
+        "is_related_loto": cell(row, "is_related_loto").lower() in ("true", "1"),
+        "img_exterior": cell(row, "img_exterior") or None, "img_outlet": cell(row, "img_outlet") or None,
+        "img_label": cell(row, "img_label") or None, "img_loto1": cell(row, "img_loto1") or None,
+        "img_loto2": cell(row, "img_loto2") or None,
+    }
+    file_name = str(Path(published).with_suffix(".jpg"))
+    # 公開先（リポジトリ・共有フォルダ）を変えたときは、内容が同じでも新しい公開先へ出し直す
+    return {
+        "id": did, "data": data, "extras": extras, "file_name": file_name, "with_viewer": with_viewer,
+        "profile": profile, "budget_kb": budget_kb,
+        "hash": app.hash_manual_inputs(data, extras, profile, budget_kb, with_viewer, file_name, target),
+    }, None
+
+
+def render_job(job):
+    # ワーカープロセス側：画像の取得・描画・エンコードだけを行い、公開は親プロセスでまとめて行う
+    app = load_app()
+    t = time.perf_counter()
+    try:
+        out = app.MANUAL_DIR / job["file_name"]
+        files = app.create_manual_image_extended(job["data"], job["extras"], out, job["profile"], job["budget_kb"], with_viewer=job["with_viewer"])
+        return {"id": job["id"], "files": [str(f) for f in files], "bytes": sum(os.path.getsize(f) for f in files), "sec": time.perf_counter() - t, "error": None}
+    except Exception as e:
+        return {"id": job["id"], "files": [], "bytes": 0, "sec": time.perf_counter() - t, "error": f"{type(e).__name__}: {e}"}
+
+
+def load_state():
+    if STATE_FILE.exists():
+        try:
+            with open(STATE_FILE, "r", encoding="utf-8") as f: return json.load(f)
+        except Exception:
+            pass
+    return {}
+
+
+def save_state(state):
+    tmp = STATE_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, STATE_FILE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="機器情報ページを devices.csv から一括再生成する")
+    parser.add_argument("--workdir", default=".", help="devices.csv のある作業フォルダ")
+    parser.add_argument("--mode", choices=list(SAVE_MODES), default="shared", help="公開先（github / shared）")
+    parser.add_argument("--repo", default="equipment-portal/qr-manager", help="github モードのリポジトリ")
+    parser.add_argument("--token", default=os.environ.get("QR_GITHUB_TOKEN", ""), help="github モードのトークン（既定: 環境変数 QR_GITHUB_TOKEN）")
+    parser.add_argument("--local-path", default=".", help="shared モードの共有フォルダ")
+    parser.add_argument("--profile", default=None, help="出力形式（既定: アプリの既定値）")
+    parser.add_argument("--budget-kb", type=int, default=None, help="画像ファイルサイズの目標上限 (KB)")
+    parser.add_argument("--since", default=None, help="Updated がこの日時以降の機器だけ対象にする（例: 2026-01-01 / 2026-01-01T09:00）")
+    parser.add_argument("--ids", nargs="*", default=None, help="対象の管理番号")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="並列プロセス数")
+    parser.add_argument("--force", action="store_true", help="変更が無くても再生成する")
+    parser.add_argument("--drain-timeout", type=int, default=300, help="github モードで送信待ちを送り切るまで待つ秒数")
+    parser.add_argument("--dry-run", action="store_true", help="対象を表示するだけで生成・公開しない")
+    args = parser.parse_args()
+
+    os.chdir(args.workdir)
+    app = load_app()
+    if not app.DB_CSV.exists():
+        sys.exit(f"{app.DB_CSV} が見つかりません（--workdir を確認してください）")
+    mode = SAVE_MODES[args.mode]
+    if mode == SAVE_MODES["github"] and not args.token:
+        sys.exit("github モードではトークンが必要です（--token または QR_GITHUB_TOKEN）")
+    app.outbox_set_credentials(args.repo, args.token)
+    profile = args.profile or app.MANUAL_DEFAULT_PROFILE
+    if profile not in app.MANUAL_ENCODE_PROFILES:
+        sys.exit(f"出力形式が不明です: {profile}（{', '.join(app.MANUAL_ENCODE_PROFILES)}）")
+    budget_kb = args.budget_kb or app.MANUAL_DEFAULT_BUDGET_KB
+    target = app.ledger_dest_key(mode, args.repo, args.local_path)
+
+    df = app.load_devices()
+    if args.ids:
+        df = df[df["ID"].astype(str).isin(args.ids)]
+    if args.since:
+        since = datetime.fromisoformat(args.since)
+        df = df[app.pd.to_datetime(df["Updated"], errors="coerce") >= since]
+
+    state = load_state()
+    jobs, skipped, unsupported = [], 0, []
+    for row in df.to_dict("records"):
+        job, reason = row_to_job(app, row, profile, budget_kb, target)
+        if job is None:
+            unsupported.append((cell(row, "ID"), reason)); continue
+        if not args.force and state.get(job["id"], {}).get("hash") == job["hash"]:
+            skipped += 1; continue
+        jobs.append(job)
+
+    print(f"対象 {len(df)} 件: 再生成 {len(jobs)} / 変更なし {skipped} / 対象外 {len(unsupported)}")
+    for did, reason in unsupported:
+        print(f"  対象外 {did}: {reason}")
+    if args.dry_run:
+        for job in jobs: print(f"  再生成予定 {job['id']} → {job['file_name']}{' (+HTML版)' if job['with_viewer'] else ''}")
+        return
+
+    t0 = time.perf_counter()
+    done, failures, total_bytes = 0, [], 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(render_job, job): job for job in jobs}
+        for fut in as_completed(futures):
+            job = futures[fut]
+            res = fut.result()
+            if res["error"] is None:
+                try:
+                    url = app.publish_manual_files(app.MANUAL_DIR / job["file_name"], res["files"], mode, args.repo, args.token, args.local_path, job["with_viewer"], device=job["id"])
+                    state[job["id"]] = {"hash": job["hash"], "file": job["file_name"], "url": url, "bytes": res["bytes"], "at": datetime.now().isoformat(timespec="seconds")}
+                    save_state(state)
+                except Exception as e:
+                    res["error"] = f"公開に失敗: {type(e).__name__}: {e}"
+            if res["error"]:
+                failures.append((job["id"], res["error"]))
+                print(f"  ✗ {job['id']}: {res['error']}")
+            else:
+                done += 1; total_bytes += res["bytes"]
+                print(f"  ✓ {job['id']}  {res['bytes'] / 1024:,.0f} KB  {res['sec']:.1f}s")
+
+    if mode == SAVE_MODES["github"] and app.outbox_entries():
+        # github モードの公開は送信待ち行列を経由するため、終了前に送信し切る
+        print("送信待ちのファイルを送信中...")
+        left = app.drain_outbox(args.drain_timeout)
+        if left:
+            failures.append(("-", f"送信待ちが {left} 件残っています（outbox/ に保存済み。次回のアプリ起動時などに再送されます）"))
+    elapsed = time.perf_counter() - t0
+    print("\n--- 結果 ---")
+    print(f"再生成 {done} 件 / 失敗 {len(failures)} 件 / 変更なし {skipped} 件 / 対象外 {len(unsupported)} 件")
+    print(f"所要時間 {elapsed:.1f} 秒（{done / elapsed * 60 if elapsed else 0:.1f} 件/分, {args.workers} プロセス）")
+    print(f"書き込み {total_bytes / 1024 / 1024:,.2f} MB")
+    for did, err in failures:
+        print(f"  失敗 {did}: {err}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
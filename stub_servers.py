@@ -0,0 +1,192 @@
+# ==========================================
+# --- 検証用スタブサーバー（GitHub API / CDN / 短縮URL の代わり） ---
+# ==========================================
+# 外部サービスに接続せずに、アップロード待ち行列の再送や負荷試験を確認するための簡易サーバー。
+# GitHub の contents API（sha による上書き判定・409/422）と jsDelivr 形式の配信、短縮URLだけを真似る。
+#
+# 使い方:
+#   python stub_servers.py --port 8900 --fail-rate 0.3 --latency 0.2
+#   set QR_GITHUB_API_URL=http://127.0.0.1:8900/api
+#   set QR_CDN_BASE_URL=http://127.0.0.1:8900/cdn
+#   set QR_CDN_PURGE_URL=http://127.0.0.1:8900/purge
+#   set QR_SHORTENER_URL=http://127.0.0.1:8900/short?url=
+#
+# 障害の切り替え（接続断の再現）:
+#   curl "http://127.0.0.1:8900/_control?outage=1"    # 以後すべての API 呼び出しを切断
+#   curl "http://127.0.0.1:8900/_control?outage=0&fail_rate=0"
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, fail_rate=0.0, latency=0.0):
+        self.files = {}          # (repo, path) -> bytes
+        self.short = {}          # 短縮コード -> 元URL
+        self.renames = {}        # リポジトリ名の変更の再現: 旧 "owner/repo" -> 応答の html_url に載せる新しい名前
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.outage = False
+        self.calls = {"put": 0, "get": 0, "cdn": 0, "purge": 0, "short": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sha(data):
+        return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.stub
+
+    def reply(self, code, body=b"", ctype="application/json"):
+        if isinstance(body, (dict, list)): body = json.dumps(body).encode("utf-8")
+        elif isinstance(body, str): body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_failure(self):
+        # 障害中、または fail_rate の確率で 502 か接続断を返す
+        st = self.state
+        if st.latency: time.sleep(st.latency * random.uniform(0.5, 1.5))
+        if st.outage or random.random() < st.fail_rate:
+            with st.lock: st.calls["failed"] += 1
+            if st.outage or random.random() < 0.5:
+                self.close_connection = True
+                self.connection.shutdown(2)
+            else:
+                self.reply(502, {"message": "Bad Gateway (stub)"})
+            return True
+        return False
+
+    def contents_key(self, path):
+        # /api/repos/{owner}/{repo}/contents/{path}
+        parts = path.split("/", 6)
+        if len(parts) < 7 or parts[2] != "repos" or parts[5] != "contents": return None
+        return f"{parts[3]}/{parts[4]}", urllib.parse.unquote(parts[6])
+
+    def content_info(self, repo, path, data):
+        return {"path": path, "sha": StubState.sha(data), "size": len(data),
+                "html_url": f"https://github.com/{self.state.renames.get(repo, repo)}/blob/main/{urllib.parse.quote(path)}"}
+
+    def do_GET(self):
+        st = self.state
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/_control":
+            if "outage" in query: st.outage = query["outage"][0] == "1"
+            if "fail_rate" in query: st.fail_rate = float(query["fail_rate"][0])
+            if "latency" in query: st.latency = float(query["latency"][0])
+            return self.reply(200, {"outage": st.outage, "fail_rate": st.fail_rate, "latency": st.latency, "files": len(st.files), "calls": st.calls})
+        if url.path.startswith("/api/"):
+            if self.inject_failure(): return
+            key = self.contents_key(url.path)
+            with st.lock:
+                st.calls["get"] += 1
+                data = st.files.get(key) if key else None
+            if data is None: return self.reply(404, {"message": "Not Found"})
+            return self.reply(200, {**self.content_info(*key, data), "content": base64.b64encode(data).decode("ascii")})
+        if url.path.startswith("/cdn/") or url.path.startswith("/purge/"):
+            # /cdn/{owner}/{repo}@main/{path}
+            kind = "cdn" if url.path.startswith("/cdn/") else "purge"
+            owner, _, rest = url.path.split("/", 2)[2].partition("/")
+            repo_name, _, path = rest.partition("@main/")
+            with st.lock:
+                st.calls[kind] += 1
+                data = st.files.get((f"{owner}/{repo_name}", urllib.parse.unquote(path)))
+            if kind == "purge": return self.reply(200, {"status": "ok"})
+            if data is None: return self.reply(404, "Not Found", "text/plain")
+            ctype = "text/html; charset=utf-8" if path.endswith(".html") else "image/webp" if path.endswith(".webp") else "image/jpeg"
+            return self.reply(200, data, ctype)
+        if url.path == "/short":
+            if self.inject_failure(): return
+            long_url = query.get("url", [""])[0]
+            code = hashlib.md5(long_url.encode("utf-8")).hexdigest()[:6]
+            with st.lock:
+                st.calls["short"] += 1
+                st.short[code] = long_url
+            return self.reply(200, f"http://{self.headers.get('Host')}/s/{code}", "text/plain")
+        if url.path.startswith("/s/"):
+            target = st.short.get(url.path[3:])
+            if not target: return self.reply(404, "Not Found", "text/plain")
+            self.send_response(301)
+            self.send_header("Location", target)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.reply(404, {"message": "Not Found"})
+
+    def do_PUT(self):
+        st = self.state
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.inject_failure(): return
+        key = self.contents_key(urllib.parse.urlparse(self.path).path)
+        if key is None: return self.reply(404, {"message": "Not Found"})
+        if not self.headers.get("Authorization"): return self.reply(401, {"message": "Bad credentials"})
+        payload = json.loads(body.decode("utf-8"))
+        data = base64.b64decode(payload["content"])
+        with st.lock:
+            st.calls["put"] += 1
+            current = st.files.get(key)
+            # GitHub と同様に、既存ファイルの上書きには現在の sha が必要
+            if current is not None and not payload.get("sha"):
+                return self.reply(422, {"message": "Invalid request. \"sha\" wasn't supplied."})
+            if current is not None and payload["sha"] != StubState.sha(current):
+                return self.reply(409, {"message": "sha does not match"})
+            st.files[key] = data
+        self.reply(201 if current is None else 200, {"content": self.content_info(*key, data)})
+
+
+def start_stub_servers(port=0, fail_rate=0.0, latency=0.0, host="127.0.0.1"):
+    # 別スレッドで起動し (server, base_url) を返す。server.stub で状態を参照・変更できる
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stub = StubState(fail_rate, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def stub_env(base_url):
+    # アプリ側の接続先をスタブに向ける環境変数
+    return {
+        "QR_GITHUB_API_URL": f"{base_url}/api",
+        "QR_CDN_BASE_URL": f"{base_url}/cdn",
+        "QR_CDN_PURGE_URL": f"{base_url}/purge",
+        "QR_SHORTENER_URL": f"{base_url}/short?url=",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GitHub API / CDN / 短縮URL の検証用スタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="API 呼び出しを失敗させる確率 (0〜1)")
+    parser.add_argument("--latency", type=float, default=0.0, help="API 応答の平均遅延 (秒)")
+    args = parser.parse_args()
+    server, base_url = start_stub_servers(args.port, args.fail_rate, args.latency, args.host)
+    print(f"スタブサーバー起動: {base_url}")
+    for k, v in stub_env(base_url).items():
+        print(f"  {k}={v}")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# アップロード待ち行列（outbox）の再送・送信完了・台帳URLの書き換えを、
+# 断続的に失敗する検証用スタブサーバー（stub_servers.py）に対して確認する。
+import importlib
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+from stub_servers import start_stub_servers, stub_env
+
+REPO = "test-owner/qr-manager"
+TOKEN = "test-token"
+
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+    # 接続先は import 時に環境変数から決まるため、スタブを起動してからアプリを読み込む
+    server, base_url = start_stub_servers(fail_rate=0.4)
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    os.environ.update(stub_env(base_url))
+    os.environ["QR_MANUAL_SERVER_PORT"] = "0"
+    os.chdir(tmp_path_factory.mktemp("workspace"))
+    sys.modules.pop("equipment_qr_manager", None)
+    app = importlib.import_module("equipment_qr_manager")
+    app.ensure_work_dirs()
+    # 送信はテストから flush_outbox で行う（バックグラウンドの送信スレッドは起動しない）
+    state = {"event": app.threading.Event(), "creds": {REPO: TOKEN}, "last_error": None, "last_flush": None, "force": False, "lock": app.threading.Lock()}
+    app.outbox_worker = lambda: state
+    random.seed(42)
+    yield app, server, state
+    server.shutdown()
+    os.chdir(saved_cwd)
+    os.environ.clear()
+    os.environ.update(saved_env)
+    sys.modules.pop("equipment_qr_manager", None)
+
+
+def flush_until_empty(app, state, max_rounds=200):
+    for _ in range(max_rounds):
+        if not app.outbox_entries(): return
+        app.flush_outbox(state, force=True)
+    pytest.fail(f"待ち行列が空になりません: {len(app.outbox_entries())} 件")
+
+
+def test_retry_backoff_keeps_entry_until_sent(env):
+    app, server, state = env
+    server.stub.outage = True
+    try:
+        url = app.enqueue_upload(REPO, "images/B1_ext.jpg", b"backoff-payload", "Upload B1", device="B1")
+        t = time.time()
+        app.flush_outbox(state)
+        meta = app.outbox_entries()[0]
+        assert meta["attempts"] == 1
+        assert meta["next_try"] >= t + app.OUTBOX_POLL
+        assert meta["last_error"]
+        assert state["last_error"] == meta["last_error"]
+
+        # 待機時間中は送信を試みない
+        failed = server.stub.calls["failed"]
+        app.flush_outbox(state)
+        assert server.stub.calls["failed"] == failed
+        assert app.outbox_entries()[0]["attempts"] == 1
+    finally:
+        server.stub.outage = False
+
+    flush_until_empty(app, state)
+    assert server.stub.files[(REPO, "images/B1_ext.jpg")] == b"backoff-payload"
+    assert url == app.cdn_url(REPO, "images/B1_ext.jpg")
+
+
+def test_intermittent_failures_drain_without_loss_or_duplicates(env):
+    app, server, state = env
+    payloads = {f"images/D{i:02d}_ext.jpg": os.urandom(2048) + bytes([i]) for i in range(20)}
+    puts_before = server.stub.calls["put"]
+    for i, (path, data) in enumerate(payloads.items()):
+        app.enqueue_upload(REPO, path, data, f"Upload {path}", device=f"D{i:02d}")
+    # 同じ宛先への再登録は最新のデータで置き換わり、送信は1回だけ
+    replaced = "images/D00_ext.jpg"
+    payloads[replaced] = b"replaced-payload"
+    app.enqueue_upload(REPO, replaced, payloads[replaced], f"Upload {replaced}", device="D00")
+
+    flush_until_empty(app, state)
+
+    assert server.stub.calls["failed"] > 0
+    assert list(app.OUTBOX_DIR.iterdir()) == []
+    for path, data in payloads.items():
+        assert server.stub.files[(REPO, path)] == data
+    assert server.stub.calls["put"] - puts_before == len(payloads)
+
+
+def test_device_rows_point_at_final_cdn_urls(env):
+    app, server, state = env
+    renamed = "test-owner/qr-manager-renamed"
+    server.stub.renames[REPO] = renamed
+    try:
+        for i in range(5):
+            did = f"R{i}"
+            img_url = app.enqueue_upload(REPO, f"images/{did}_ext.jpg", b"img" + bytes([i]), f"Upload {did}", device=did)
+            manual_url = app.enqueue_upload(REPO, f"manuals/{did}_1200.jpg", b"manual" + bytes([i]), f"Upload Manual {did}", device=did, purge=True)
+            extras = app.json.dumps([{"title": "追加", "url": img_url}], ensure_ascii=False)
+            app.put_device({"ID": did, "Name": f"機器{i}", "Power": "100V", "URL": manual_url, "Updated": "2026-01-01 00:00:00",
+                            "memo": "", "is_related_loto": False, "img_exterior": img_url, "extra_images": extras})
+
+        flush_until_empty(app, state)
+    finally:
+        server.stub.renames.clear()
+
+    df = app.load_devices()
+    for i in range(5):
+        did = f"R{i}"
+        row = df[df["ID"].astype(str) == did].iloc[-1]
+        assert row["URL"] == app.cdn_url(renamed, f"manuals/{did}_1200.jpg")
+        assert row["img_exterior"] == app.cdn_url(renamed, f"images/{did}_ext.jpg")
+        assert app.cdn_url(renamed, f"images/{did}_ext.jpg") in row["extra_images"]
+        assert REPO + "@" not in "".join(str(v) for v in row.values)